@@ -5,15 +5,25 @@ import ddtrace
 from json import loads
 
 # project
-from .encoding import get_encoder, JSONEncoder
-from .compat import httplib, PYTHON_VERSION, PYTHON_INTERPRETER, get_connection_response
+from .encoding import get_encoder, JSONEncoder, StringTableMsgpackEncoder, MSGPACK_ENCODING
+from .compat import PYTHON_VERSION, PYTHON_INTERPRETER
+from .compression import get_compressor, DEFAULT_COMPRESSION_THRESHOLD
+from .transport import HTTPTransport, uds_connection_factory
 
 
 log = logging.getLogger(__name__)
 
 TRACE_COUNT_HEADER = 'X-Datadog-Trace-Count'
 
-_VERSIONS = {'v0.4': {'traces': '/v0.4/traces',
+# the trace agent rejects payloads larger than 10MB, keep a safety margin
+DEFAULT_MAX_PAYLOAD_SIZE = 8 << 20
+
+_VERSIONS = {'v0.5': {'traces': '/v0.5/traces',
+                      'services': '/v0.4/services',
+                      'compatibility_mode': False,
+                      'encoder': StringTableMsgpackEncoder,
+                      'fallback': 'v0.4'},
+             'v0.4': {'traces': '/v0.4/traces',
                       'services': '/v0.4/services',
                       'compatibility_mode': False,
                       'fallback': 'v0.3'},
@@ -48,18 +58,59 @@ def _parse_response_json(response):
         except (ValueError, TypeError) as err:
             log.debug("unable to load JSON '%s': %s" % (body, err))
 
+
+class Payload(object):
+    """
+    A chunk of traces encoded and ready to be sent to the trace agent. The
+    ``traces`` are kept, if available, so that they can be encoded again if
+    the API is downgraded.
+    """
+    __slots__ = ['data', 'traces', 'count']
+
+    def __init__(self, data, traces, count=None):
+        self.data = data
+        self.traces = traces
+        # number of traces in the payload
+        self.count = len(traces) if count is None else count
+
+
 class API(object):
     """
-    Send data to the trace agent using the HTTP protocol and JSON format
+    Send data to the trace agent using the HTTP protocol and JSON format. If
+    ``uds_path`` is set, the agent is reached through that Unix domain socket
+    instead of ``hostname:port``.
+
+    The API ``version`` defaults to ``v0.4`` when priority sampling is enabled,
+    ``v0.3`` otherwise. The ``v0.5`` version sends a string table with each payload
+    to avoid repeating the same strings, and requires the msgpack C extension. If
+    an endpoint isn't available, the API is downgraded to the previous version.
+
+    Payloads larger than ``compression_threshold`` bytes are compressed if a
+    ``compression`` algorithm is set (``gzip``, ``zstd`` or ``lz4``); the
+    ``max_payload_size`` is the size before compression.
     """
-    def __init__(self, hostname, port, headers=None, encoder=None, priority_sampling=False):
+    def __init__(self, hostname, port, headers=None, encoder=None, priority_sampling=False,
+                 connection_factory=None, uds_path=None, max_payload_size=DEFAULT_MAX_PAYLOAD_SIZE,
+                 version=None, compression=None, compression_threshold=DEFAULT_COMPRESSION_THRESHOLD):
         self.hostname = hostname
         self.port = port
+        self.uds_path = uds_path
+        self.max_payload_size = max_payload_size
+        if uds_path and connection_factory is None:
+            connection_factory = uds_connection_factory(uds_path)
+        self._transport = HTTPTransport(hostname, port, connection_factory=connection_factory)
+        self.compression = compression
+        self._compressor = get_compressor(compression)
+        self._compression_threshold = compression_threshold
 
         self._headers = headers or {}
         self._version = None
+        # the version asked for, kept when the API is downgraded
+        self.requested_version = version
 
-        if priority_sampling:
+        if version:
+            self._set_version(version, encoder=encoder)
+        elif priority_sampling:
             self._set_version('v0.4', encoder=encoder)
         else:
             self._set_version('v0.3', encoder=encoder)
@@ -74,6 +125,10 @@ class API(object):
     def _set_version(self, version, encoder=None):
         if version not in _VERSIONS:
             version = 'v0.2'
+        if version == 'v0.5' and not MSGPACK_ENCODING:
+            log.warning('the v0.5 API requires the msgpack C extension, that is not available; '
+                        'using the v0.4 API')
+            version = 'v0.4'
         if version == self._version:
             return
         self._version = version
@@ -83,6 +138,8 @@ class API(object):
         self._compatibility_mode = _VERSIONS[version]['compatibility_mode']
         if self._compatibility_mode:
             self._encoder = JSONEncoder()
+        elif 'encoder' in _VERSIONS[version]:
+            self._encoder = _VERSIONS[version]['encoder']()
         else:
             self._encoder = encoder or get_encoder()
         # overwrite the Content-type with the one chosen in the Encoder
@@ -97,22 +154,81 @@ class API(object):
         """
         self._set_version(self._fallback)
 
+    def encode_traces(self, traces):
+        """
+        Encode the given traces in a list of ``Payload``, each one smaller than
+        ``max_payload_size`` unless it contains a single trace that is larger.
+        """
+        chunks = self._encoder.encode_chunks(traces, self.max_payload_size)
+        return [Payload(data, chunk) for data, chunk in chunks]
+
+    @property
+    def encoder(self):
+        """
+        The ``Encoder`` of the current API version.
+        """
+        return self._encoder
+
+    @property
+    def payload_format(self):
+        """
+        The format of the payloads encoded by the current API version, i.e. the
+        version and the Content-Type, e.g. ``v0.4 application/msgpack``.
+        """
+        return '{} {}'.format(self._version, self._encoder.content_type)
+
+    def join_traces(self, encoded):
+        """
+        Join traces already encoded with the current ``encoder`` in a list of
+        ``Payload``, each one smaller than ``max_payload_size`` unless it contains
+        a single trace that is larger.
+        """
+        chunks = self._encoder.join_chunks(encoded, self.max_payload_size)
+        return [Payload(data, None, count) for data, count in chunks]
+
     def send_traces(self, traces):
+        """
+        Send the given traces, splitting them in multiple payloads if they are
+        larger than ``max_payload_size``. The response of the first payload that
+        failed is returned, otherwise the response of the last one.
+        """
         if not traces:
             return
         start = time.time()
-        data = self._encoder.encode_traces(traces)
-        response = self._put(self._traces, data, len(traces))
+        response = None
+        for payload in self.encode_traces(traces):
+            payload_response = self.send_payload(payload)
+            if response is None or response.status < 400:
+                response = payload_response
+
+        log.debug("reported %d traces in %.5fs", len(traces), time.time() - start)
+        return response
+
+    def send_payload(self, payload):
+        """
+        Send a single ``Payload`` returned by ``encode_traces()`` or ``join_traces()``.
+        """
+        response = self._put(self._traces, payload.data, payload.count)
 
         # the API endpoint is not available so we should downgrade the connection and re-try the call
-        if response.status in [404, 415] and self._fallback:
-            log.debug('calling endpoint "%s" but received %s; downgrading API', self._traces, response.status)
-            self._downgrade()
-            return self.send_traces(traces)
+        encoder = self._encoder
+        if self.downgrade_on(self._traces, response):
+            if payload.traces is not None:
+                return self.send_traces(payload.traces)
+            if type(self._encoder) is type(encoder):
+                return self.send_payload(payload)
+            # the traces were encoded ahead of time and they are gone
+            log.debug('dropping %d traces encoded in a format not supported by the fallback API', payload.count)
 
-        log.debug("reported %d traces in %.5fs", len(traces), time.time() - start)
         return response
 
+    def probe(self):
+        """
+        Send an empty list of traces; this is a cheap way to check that the trace
+        agent is reachable, without encoding any data.
+        """
+        return self._put(self._traces, self._encoder.encode_traces([]))
+
     def send_services(self, services):
         if not services:
             return
@@ -123,23 +239,63 @@ class API(object):
         response = self._put(self._services, data)
 
         # the API endpoint is not available so we should downgrade the connection and re-try the call
-        if response.status in [404, 415] and self._fallback:
-            log.debug('calling endpoint "%s" but received %s; downgrading API', self._services, response.status)
-            self._downgrade()
+        if self.downgrade_on(self._services, response):
             return self.send_services(services)
 
         log.debug("reported %d services", len(services))
         return response
 
+    def close(self):
+        """
+        Close the connections kept alive with the trace agent.
+        """
+        self._transport.close()
+
+    def prepare_payload(self, payload):
+        """
+        Return the ``(endpoint, body, headers)`` of the request that sends the given
+        ``Payload``, for callers that use their own HTTP client.
+        """
+        return (self._traces,) + self._prepare(payload.data, payload.count)
+
+    def prepare_services(self, services):
+        """
+        Return the ``(endpoint, body, headers)`` of the request that sends the given
+        services, or ``None`` if there is nothing to send.
+        """
+        if not services:
+            return None
+        s = {}
+        for service in services:
+            s.update(service)
+        return (self._services,) + self._prepare(self._encoder.encode_services(s))
+
+    def downgrade_on(self, endpoint, response):
+        """
+        Downgrade the API if the ``response`` of a request sent to ``endpoint`` shows
+        that the endpoint isn't available; return ``True`` if the request must be
+        prepared and sent again.
+        """
+        if response.status in [404, 415] and self._fallback:
+            log.debug('calling endpoint "%s" but received %s; downgrading API', endpoint, response.status)
+            self._downgrade()
+            return True
+        return False
+
+    def _prepare(self, data, count=0):
+        headers = self._headers
+        if count:
+            headers = dict(self._headers)
+            headers[TRACE_COUNT_HEADER] = str(count)
+
+        if self._compressor is not None and len(data) >= self._compression_threshold:
+            if not isinstance(data, bytes) and hasattr(data, 'encode'):
+                data = data.encode('utf-8')
+            data = self._compressor.compress(data)
+            headers = dict(headers)
+            headers['Content-Encoding'] = self._compressor.content_encoding
+        return data, headers
+
     def _put(self, endpoint, data, count=0):
-        conn = httplib.HTTPConnection(self.hostname, self.port)
-        try:
-            headers = self._headers
-            if count:
-                headers = dict(self._headers)
-                headers[TRACE_COUNT_HEADER] = str(count)
-
-            conn.request("PUT", endpoint, data, headers)
-            return get_connection_response(conn)
-        finally:
-            conn.close()
+        data, headers = self._prepare(data, count)
+        return self._transport.request("PUT", endpoint, data, headers)
@@ -1,5 +1,6 @@
 import sys
 import platform
+import time
 
 PYTHON_VERSION_INFO = sys.version_info
 PY2 = sys.version_info[0] == 2
@@ -44,6 +45,23 @@ except ImportError:
         return fn
 
 
+# integer clocks in nanoseconds (Python 3.7+), emulated with the float clocks before;
+# the monotonic clock falls back to the wall clock on Python 2
+if hasattr(time, 'time_ns'):
+    time_ns = time.time_ns
+else:
+    def time_ns():
+        return int(time.time() * 1e9)
+
+if hasattr(time, 'perf_counter_ns'):
+    monotonic_ns = time.perf_counter_ns
+else:
+    _monotonic = getattr(time, 'perf_counter', time.time)
+
+    def monotonic_ns():
+        return int(_monotonic() * 1e9)
+
+
 def iteritems(obj, **kwargs):
     func = getattr(obj, "iteritems", None)
     if not func:
@@ -0,0 +1,102 @@
+"""
+Compression of the payloads sent to the trace agent. It is worth enabling
+when the agent runs on another host, so that traces take less bandwidth in
+exchange for a bit of CPU on the flush thread.
+
+gzip is always available; zstd and lz4 require the ``zstandard`` and ``lz4``
+packages to be installed.
+"""
+import logging
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+
+log = logging.getLogger(__name__)
+
+# small payloads, such as services, are not worth compressing
+DEFAULT_COMPRESSION_THRESHOLD = 1 << 10
+
+
+class Compressor(object):
+    """
+    Compressor interface; ``content_encoding`` is the value of the
+    ``Content-Encoding`` header sent with compressed payloads.
+    """
+    content_encoding = ''
+
+    def compress(self, data):
+        """
+        Compress the given bytes.
+        """
+        raise NotImplementedError
+
+
+class GzipCompressor(Compressor):
+    content_encoding = 'gzip'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data):
+        # a ``wbits`` greater than 16 writes the gzip header and trailer
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+
+class ZstdCompressor(Compressor):
+    content_encoding = 'zstd'
+
+    def __init__(self, level=3):
+        self.level = level
+
+    def compress(self, data):
+        # DEV: ``ZstdCompressor`` instances must not be shared between threads
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+
+class LZ4Compressor(Compressor):
+    content_encoding = 'lz4'
+
+    def __init__(self, level=0):
+        self.level = level
+
+    def compress(self, data):
+        return lz4_frame.compress(data, compression_level=self.level)
+
+
+_COMPRESSORS = {
+    'gzip': (GzipCompressor, lambda: True),
+    'zstd': (ZstdCompressor, lambda: zstandard is not None),
+    'lz4': (LZ4Compressor, lambda: lz4_frame is not None),
+}
+
+
+def get_compressor(name, level=None):
+    """
+    Return the ``Compressor`` for the given ``Content-Encoding`` name, or ``None``
+    if no name is given or if the library it requires is not installed.
+
+    :param str name: ``gzip``, ``zstd`` or ``lz4``
+    :param int level: the compression level, the default of each algorithm if not set
+    """
+    if not name:
+        return None
+    if name not in _COMPRESSORS:
+        raise ValueError('unknown compression {!r}, expected one of: {}'.format(name, ', '.join(sorted(_COMPRESSORS))))
+
+    compressor_class, is_available = _COMPRESSORS[name]
+    if not is_available():
+        log.warning('%s compression is not available, payloads are sent uncompressed', name)
+        return None
+    if level is None:
+        return compressor_class()
+    return compressor_class(level)
@@ -1,3 +1,6 @@
 FILTERS_KEY = 'FILTERS'
 SAMPLE_RATE_METRIC_KEY = "_sample_rate"
 SAMPLING_PRIORITY_KEY = '_sampling_priority_v1'
+# the spans suppressed past the maximum number of spans of a trace, by span name
+SUPPRESSED_SPANS_COUNT_KEY = 'suppressed_spans.{}.count'
+SUPPRESSED_SPANS_DURATION_KEY = 'suppressed_spans.{}.duration'
@@ -1,7 +1,7 @@
 import logging
 import threading
 
-from .constants import SAMPLING_PRIORITY_KEY
+from .constants import SAMPLING_PRIORITY_KEY, SUPPRESSED_SPANS_COUNT_KEY, SUPPRESSED_SPANS_DURATION_KEY
 
 
 log = logging.getLogger(__name__)
@@ -33,6 +33,10 @@ class Context(object):
         self._finished_spans = 0
         self._current_span = None
         self._lock = threading.Lock()
+        # the number of spans of the trace, including the ones already sent
+        self._span_count = 0
+        # (count, duration) of the suppressed spans of the trace by name, if there are any
+        self._suppressed_spans = None
 
         self._parent_trace_id = trace_id
         self._parent_span_id = span_id
@@ -89,14 +93,20 @@ class Context(object):
         It copies everything EXCEPT the registered and finished spans.
         """
         with self._lock:
-            new_ctx = Context(
-                trace_id=self._parent_trace_id,
-                span_id=self._parent_span_id,
-                sampled=self._sampled,
-                sampling_priority=self._sampling_priority,
-            )
-            new_ctx._current_span = self._current_span
-            return new_ctx
+            return self._clone()
+
+    def _clone(self):
+        """
+        Non-safe if not used with a lock. For internal Context usage only.
+        """
+        new_ctx = self.__class__(
+            trace_id=self._parent_trace_id,
+            span_id=self._parent_span_id,
+            sampled=self._sampled,
+            sampling_priority=self._sampling_priority,
+        )
+        new_ctx._current_span = self._current_span
+        return new_ctx
 
     def get_current_root_span(self):
         """
@@ -134,10 +144,50 @@ class Context(object):
         Add a span to the context trace list, keeping it as the last active span.
         """
         with self._lock:
-            self._set_current_span(span)
+            self._add_span(span)
+
+    def _add_span(self, span):
+        """
+        Non-safe if not used with a lock. For internal Context usage only.
+        """
+        self._set_current_span(span)
+
+        self._trace.append(span)
+        self._span_count += 1
+        span._context = self
+
+    def add_suppressed_span(self, span):
+        """
+        Add a ``SuppressedSpan`` to the context: it's not part of the trace, and it
+        doesn't become the active span.
+        """
+        with self._lock:
+            self._add_suppressed_span(span)
+
+    def _add_suppressed_span(self, span):
+        """
+        Non-safe if not used with a lock. For internal Context usage only.
+        """
+        span._context = self
+        # the summary of the current trace, since the span may finish after it's sent
+        if self._suppressed_spans is None:
+            self._suppressed_spans = {}
+        span._summary = self._suppressed_spans
 
-            self._trace.append(span)
-            span._context = self
+    def close_suppressed_span(self, span):
+        """
+        Add a finished ``SuppressedSpan`` to the summary of the suppressed spans,
+        recorded on the root span when the trace is sent.
+        """
+        with self._lock:
+            self._close_suppressed_span(span)
+
+    def _close_suppressed_span(self, span):
+        """
+        Non-safe if not used with a lock. For internal Context usage only.
+        """
+        count, duration = span._summary.get(span.name, (0, 0))
+        span._summary[span.name] = (count + 1, duration + (span.duration_ns or 0))
 
     def close_span(self, span):
         """
@@ -145,23 +195,29 @@ class Context(object):
         cycles inside _trace list.
         """
         with self._lock:
-            self._finished_spans += 1
-            self._set_current_span(span._parent)
-
-            # notify if the trace is not closed properly; this check is executed only
-            # if the tracer debug_logging is enabled and when the root span is closed
-            # for an unfinished trace. This logging is meant to be used for debugging
-            # reasons, and it doesn't mean that the trace is wrongly generated.
-            # In asynchronous environments, it's legit to close the root span before
-            # some children. On the other hand, asynchronous web frameworks still expect
-            # to close the root span after all the children.
-            tracer = getattr(span, '_tracer', None)
-            if tracer and tracer.debug_logging and span._parent is None and not self._is_finished():
-                opened_spans = len(self._trace) - self._finished_spans
-                log.debug('Root span "%s" closed, but the trace has %d unfinished spans:', span.name, opened_spans)
-                spans = [x for x in self._trace if not x._finished]
-                for wrong_span in spans:
-                    log.debug('\n%s', wrong_span.pprint())
+            self._close_span(span)
+
+    def _close_span(self, span):
+        """
+        Non-safe if not used with a lock. For internal Context usage only.
+        """
+        self._finished_spans += 1
+        self._set_current_span(span._parent)
+
+        # notify if the trace is not closed properly; this check is executed only
+        # if the tracer debug_logging is enabled and when the root span is closed
+        # for an unfinished trace. This logging is meant to be used for debugging
+        # reasons, and it doesn't mean that the trace is wrongly generated.
+        # In asynchronous environments, it's legit to close the root span before
+        # some children. On the other hand, asynchronous web frameworks still expect
+        # to close the root span after all the children.
+        tracer = getattr(span, '_tracer', None)
+        if tracer and tracer.debug_logging and span._parent is None and not self._is_finished():
+            opened_spans = len(self._trace) - self._finished_spans
+            log.debug('Root span "%s" closed, but the trace has %d unfinished spans:', span.name, opened_spans)
+            spans = [x for x in self._trace if not x._finished]
+            for wrong_span in spans:
+                log.debug('\n%s', wrong_span.pprint())
 
     def is_finished(self):
         """
@@ -188,28 +244,81 @@ class Context(object):
         This operation is thread-safe.
         """
         with self._lock:
-            if self._is_finished():
-                # get the trace
-                trace = self._trace
-                sampled = self._sampled
-                sampling_priority = self._sampling_priority
-                # attach the sampling priority to the context root span
-                if sampled and sampling_priority is not None and trace:
-                    trace[0].set_metric(SAMPLING_PRIORITY_KEY, sampling_priority)
+            return self._get()
 
-                # clean the current state
-                self._trace = []
-                self._finished_spans = 0
+    def _get(self):
+        """
+        Non-safe if not used with a lock. For internal Context usage only.
+        """
+        if self._is_finished():
+            # get the trace
+            trace = self._trace
+            sampled = self._sampled
+            sampling_priority = self._sampling_priority
+            # attach the sampling priority to the context root span
+            if sampled and sampling_priority is not None and trace:
+                trace[0].set_metric(SAMPLING_PRIORITY_KEY, sampling_priority)
+            # and the summary of the spans suppressed past the maximum number of spans
+            if self._suppressed_spans is not None:
+                for name, (count, duration) in self._suppressed_spans.items():
+                    trace[0].set_metric(SUPPRESSED_SPANS_COUNT_KEY.format(name), count)
+                    trace[0].set_metric(SUPPRESSED_SPANS_DURATION_KEY.format(name), duration / 1e9)
+                self._suppressed_spans = None
+
+            # clean the current state
+            self._trace = []
+            self._finished_spans = 0
+            self._span_count = 0
+
+            self._parent_trace_id = self._root_state['parent_trace_id']
+            self._parent_span_id = self._root_state['parent_span_id']
+            self._sampled = self._root_state['sampled']
+            self._parent_service = self._root_state['parent_service']
+            self._sampling_priority = self._root_state['sampling_priority']
+
+            return trace, sampled
+        else:
+            return None, None
 
-                self._parent_trace_id = self._root_state['parent_trace_id']
-                self._parent_span_id = self._root_state['parent_span_id']
-                self._sampled = self._root_state['sampled']
-                self._parent_service = self._root_state['parent_service']
-                self._sampling_priority = self._root_state['sampling_priority']
+    def get_partial(self, min_spans):
+        """
+        Returns a tuple containing the finished spans of the current context and
+        if the context is sampled or not, once at least ``min_spans`` spans are
+        finished. The finished spans are removed from the ``Context`` while the
+        unfinished ones are kept, so that a long-running trace is sent in chunks.
+        It returns (None, None) if fewer spans are finished, and it behaves as
+        ``get()`` once all the spans are finished.
 
-                return trace, sampled
+        This operation is thread-safe.
+        """
+        with self._lock:
+            return self._get_partial(min_spans)
+
+    def _get_partial(self, min_spans):
+        """
+        Non-safe if not used with a lock. For internal Context usage only.
+        """
+        if self._is_finished():
+            return self._get()
+        if self._finished_spans < min_spans:
+            return None, None
+
+        finished = []
+        unfinished = []
+        for span in self._trace:
+            if span._finished:
+                finished.append(span)
             else:
-                return None, None
+                unfinished.append(span)
+        sampled = self._sampled
+        # the spans are kept in order so the chunk containing the root starts with it;
+        # the other chunks are tagged too so that each of them can be sampled
+        if sampled and self._sampling_priority is not None:
+            finished[0].set_metric(SAMPLING_PRIORITY_KEY, self._sampling_priority)
+
+        self._trace = unfinished
+        self._finished_spans = 0
+        return finished, sampled
 
     def _is_finished(self):
         """
@@ -218,6 +327,83 @@ class Context(object):
         num_traces = len(self._trace)
         return num_traces > 0 and num_traces == self._finished_spans
 
+    def _make_thread_safe(self):
+        """
+        Return this ``Context``, made thread-safe if it isn't, so that it can be
+        handed over to another thread. It must be called by the execution flow
+        that owns the ``Context``.
+        """
+        return self
+
+
+class LockFreeContext(Context):
+    """
+    ``Context`` without locking, for the execution flows that own their context
+    and are the only ones using it at a time, e.g. the greenlets of a gevent hub,
+    that all run in the same thread. The context providers create it only when
+    they can guarantee it, since spans are commonly finished by other threads,
+    e.g. in the callbacks of a database driver; a ``LockFreeContext`` handed over
+    to another thread must be made thread-safe with ``_make_thread_safe()`` by its
+    owner before.
+
+    This data structure is not thread-safe.
+    """
+    @property
+    def trace_id(self):
+        """Return current context trace_id."""
+        return self._parent_trace_id
+
+    @property
+    def span_id(self):
+        """Return current context span_id."""
+        return self._parent_span_id
+
+    @property
+    def service(self):
+        """Return current service."""
+        return self._parent_service
+
+    def sampled(self):
+        """Return current context sampled flag."""
+        return self._sampled
+
+    @property
+    def sampling_priority(self):
+        """Return current context sampling priority."""
+        return self._sampling_priority
+
+    @sampling_priority.setter
+    def sampling_priority(self, value):
+        """Set sampling priority."""
+        self._sampling_priority = value
+
+    def get_current_span(self):
+        """Return the last active span."""
+        return self._current_span
+
+    def is_finished(self):
+        """Returns if all the spans of the ``Context`` are finished."""
+        return self._is_finished()
+
+    def is_sampled(self):
+        """Returns if the ``Context`` contains sampled spans."""
+        return self._sampled
+
+    # the same operations as the thread-safe Context, without taking the lock
+    clone = Context._clone
+    add_span = Context._add_span
+    close_span = Context._close_span
+    get = Context._get
+    get_partial = Context._get_partial
+    add_suppressed_span = Context._add_suppressed_span
+    close_suppressed_span = Context._close_suppressed_span
+
+    def _make_thread_safe(self):
+        # the lock of the Context is already allocated, and the same methods
+        # keep working on the same state, with the lock
+        self.__class__ = Context
+        return self
+
 
 class ThreadLocalContext(object):
     """
@@ -235,7 +421,8 @@ class ThreadLocalContext(object):
     def get(self):
         ctx = getattr(self._locals, 'context', None)
         if not ctx:
-            # create a new Context if it's not available
+            # create a new Context if it's not available; other threads may
+            # still use it, e.g. to finish spans in callbacks
             ctx = Context()
             self._locals.context = ctx
 
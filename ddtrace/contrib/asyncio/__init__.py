@@ -35,6 +35,14 @@ between scheduled coroutines and ``Future`` invoked in separated threads:
       the current active ``Context`` so that generated traces in the new task
       are attached to the main trace
 
+Traces can be sent to the agent from the event loop, with non-blocking I/O,
+rather than from a separate flush thread::
+
+    tracer.configure(context_provider=context_provider, native_writer=True)
+
+    # before closing the loop, send the buffered traces
+    loop.run_until_complete(tracer.writer.flush())
+
 A ``patch(asyncio=True)`` is available if you want to automatically use above
 wrappers without changing your code. In that case, the patch method **must be
 called before** importing stdlib functions.
@@ -52,11 +60,13 @@ with require_modules(required_modules) as missing_modules:
 
         from .helpers import set_call_context, ensure_future, run_in_executor
         from .patch import patch
+        from .writer import AsyncioWriter
 
         __all__ = [
             'context_provider',
             'set_call_context',
             'ensure_future',
             'run_in_executor',
-            'patch'
+            'patch',
+            'AsyncioWriter',
         ]
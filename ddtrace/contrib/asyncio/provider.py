@@ -2,6 +2,7 @@ import asyncio
 
 from ...context import Context
 from ...provider import DefaultContextProvider
+from .writer import AsyncioWriter
 
 # Task attribute used to set/get the Context instance
 CONTEXT_ATTR = '__datadog_context'
@@ -18,6 +19,8 @@ class AsyncioContextProvider(DefaultContextProvider):
     it uses a thread-local storage when the ``Context`` is propagated to
     a different thread, than the one that is running the async loop.
     """
+    writer_class = AsyncioWriter
+
     def activate(self, context, loop=None):
         """Sets the scoped ``Context`` for the current running ``Task``.
         """
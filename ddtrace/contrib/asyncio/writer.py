@@ -0,0 +1,542 @@
+"""
+Writer that sends traces to the trace agent from the application event loop,
+instead of a flush thread doing blocking I/O. Traces are buffered per event
+loop, encoded a few at a time between the callbacks of the application, and
+sent with non-blocking connections.
+
+The module only relies on callbacks and ``asyncio.Protocol``, so that it's
+compatible with all the Python versions that provide ``asyncio``.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import time
+import weakref
+
+from ... import api
+from ...api import Payload, _parse_response_json
+from ...transport import Response
+from ...writer import (
+    AgentWriter, DEFAULT_FLUSH_INTERVAL, DEFAULT_FLUSH_SIZE, LOG_ERR_INTERVAL, MAX_SERVICES, MAX_TRACES,
+    _apply_filters, _estimate_trace_size,
+)
+
+
+log = logging.getLogger(__name__)
+
+# time spent encoding traces in a single callback, so that the loop isn't blocked
+# for too long by a large flush
+ENCODE_TIME_BUDGET = 0.001
+DEFAULT_TIMEOUT = 2
+
+_get_running_loop = getattr(asyncio, '_get_running_loop', None)
+
+
+def _running_loop():
+    """
+    Return the event loop running in the current thread, if any.
+    """
+    if _get_running_loop is not None:
+        return _get_running_loop()
+    # Python 3.4 and early 3.5 releases
+    try:
+        loop = asyncio.get_event_loop()
+    except RuntimeError:
+        return None
+    return loop if loop.is_running() else None
+
+
+class AsyncioWriter(object):
+    """
+    Writer for applications built on ``asyncio``. Traces finished in a thread
+    that runs an event loop are buffered in that loop and flushed every
+    ``flush_interval`` seconds, or as soon as ``flush_size`` traces are buffered;
+    the trace agent is reached with non-blocking connections handled by the loop.
+    Traces finished outside of an event loop, e.g. in an executor, are sent by an
+    ``AgentWriter`` with its own flush thread, that also exports the trace stats,
+    if any.
+
+    Buffered traces are not sent by a loop that is closed before they're flushed:
+    call ``flush()`` before stopping the loop. They're sent by the flush thread
+    once the loop is closed or collected, or synchronously at exit.
+
+    The writer is selected with::
+
+        from ddtrace.contrib.asyncio import context_provider
+        tracer.configure(context_provider=context_provider, native_writer=True)
+    """
+    def __init__(self, hostname='localhost', port=8126, filters=None, priority_sampler=None, uds_path=None,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, flush_size=DEFAULT_FLUSH_SIZE,
+                 max_payload_size=api.DEFAULT_MAX_PAYLOAD_SIZE, api_version=None, compression=None,
+                 timeout=DEFAULT_TIMEOUT, trace_stats=None):
+        self._filters = filters
+        self._priority_sampler = priority_sampler
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._timeout = timeout
+        self._writer_kwargs = dict(
+            hostname=hostname, port=port, filters=filters, priority_sampler=priority_sampler,
+            uds_path=uds_path, flush_interval=flush_interval, flush_size=flush_size,
+            max_payload_size=max_payload_size, api_version=api_version, compression=compression,
+            trace_stats=trace_stats,
+        )
+        self.trace_stats = trace_stats
+        self.api = api.API(
+            hostname,
+            port,
+            uds_path=uds_path,
+            priority_sampling=priority_sampler is not None,
+            max_payload_size=max_payload_size,
+            version=api_version,
+            compression=compression,
+        )
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._buffers = weakref.WeakKeyDictionary()
+        # buffers of the loops closed or collected, sent by the flush thread
+        self._orphans = []
+        self._thread_writer = None
+        self._last_error_ts = 0
+        atexit.register(self._on_shutdown)
+
+    def write(self, spans=None, services=None):
+        if self.trace_stats is not None:
+            # the stats are exported by the flush thread, even if no trace is sent with it
+            self._get_thread_writer()._reset_worker()
+        loop = _running_loop()
+        if loop is None:
+            self._get_thread_writer().write(spans=spans, services=services)
+            return
+        self._get_buffer(loop).add(spans, services)
+
+    def flush(self, loop=None):
+        """
+        Flush the traces buffered in the given event loop, by default the one of the
+        current thread, and return a ``Future`` that is done once they're sent. It
+        must be called from the thread of the loop, e.g.::
+
+            loop.run_until_complete(tracer.writer.flush())
+        """
+        loop = loop or _running_loop() or asyncio.get_event_loop()
+        return self._get_buffer(loop).flush()
+
+    def stats(self):
+        """
+        Return a dictionary with the state of the buffers of all event loops: the
+        number of buffered traces and their estimated size in bytes, and the number of
+        traces and spans dropped because a buffer was full or couldn't be sent.
+        """
+        stats = {'queued_traces': 0, 'queued_bytes': 0, 'dropped_traces': 0, 'dropped_spans': 0}
+        with self._lock:
+            buffers = list(self._buffers.values())
+        for buf in buffers:
+            for key, value in buf.stats().items():
+                stats[key] += value
+        return stats
+
+    def _get_buffer(self, loop):
+        with self._lock:
+            pid = os.getpid()
+            if self._pid != pid:
+                # the loops of the parent process aren't running in this one
+                self._buffers = weakref.WeakKeyDictionary()
+                self._orphans = []
+                self._thread_writer = None
+                self._pid = pid
+            buf = self._buffers.get(loop)
+            if buf is None:
+                self._remove_closed_buffers()
+                buf = _LoopBuffer(self, loop)
+                self._buffers[loop] = buf
+                # the buffer only keeps a weak reference to its loop; the callback
+                # may run during any garbage collection, so it doesn't lock
+                buf._finalizer = weakref.finalize(loop, self._orphans.append, buf)
+        if self._orphans:
+            self._send_orphans()
+        return buf
+
+    def _remove_closed_buffers(self):
+        """
+        Remove the buffers of the closed loops, since they may still be referenced
+        by the futures of a flush in progress. Non-safe if not used with a lock.
+        """
+        for loop, buf in list(self._buffers.items()):
+            if loop.is_closed():
+                del self._buffers[loop]
+                buf._finalizer.detach()
+                self._orphans.append(buf)
+
+    def _send_orphans(self):
+        """
+        Send the traces left in the buffers of the loops closed or collected with
+        the flush thread.
+        """
+        while self._orphans:
+            try:
+                buf = self._orphans.pop()
+            except IndexError:
+                # emptied by another thread
+                return
+            traces, services = buf.drain()
+            if not traces and not services:
+                continue
+            writer = self._get_thread_writer()
+            for spans in traces:
+                writer.write(spans=spans)
+            for service in services:
+                writer.write(services=service)
+
+    def _get_thread_writer(self):
+        with self._lock:
+            if self._thread_writer is None:
+                self._thread_writer = AgentWriter(**self._writer_kwargs)
+            return self._thread_writer
+
+    def _log_error(self, msg, *args):
+        now = time.time()
+        if now > self._last_error_ts + LOG_ERR_INTERVAL:
+            log.error(msg, *args)
+            self._last_error_ts = now
+        else:
+            log.debug(msg, *args)
+
+    def _on_shutdown(self):
+        """
+        Send the traces left in the buffers of the loops that are not running anymore.
+        """
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            buffers = list(self._buffers.values()) + self._orphans
+            del self._orphans[:]
+        for buf in buffers:
+            traces, services = buf.drain()
+            try:
+                self.api.send_traces(_apply_filters(self._filters, traces))
+                self.api.send_services(services)
+            except Exception as err:
+                log.debug("cannot send buffered traces at exit: %s", err)
+        self.api.close()
+
+
+class _LoopBuffer(object):
+    """
+    Traces and services buffered in a single event loop. Except for ``drain()``,
+    its methods must be called from the loop.
+    """
+    def __init__(self, writer, loop):
+        self._writer = writer
+        # the buffer is kept by the writer, so it mustn't keep the loop alive
+        self._loop_ref = weakref.ref(loop)
+        self._finalizer = None
+        self._traces = []
+        self._services = []
+        self._queued_bytes = 0
+        self._dropped_traces = 0
+        self._dropped_spans = 0
+        self._timer = None
+        # the flush in progress, if any, and the one waiting for it to end
+        self._flushing = None
+        self._pending = None
+
+    def add(self, spans, services):
+        if spans:
+            if len(self._traces) >= MAX_TRACES:
+                self._dropped_traces += 1
+                self._dropped_spans += len(spans)
+            else:
+                self._traces.append(spans)
+                self._queued_bytes += _estimate_trace_size(spans)
+        if services and len(self._services) < MAX_SERVICES:
+            self._services.append(services)
+
+        if len(self._traces) >= self._writer._flush_size:
+            self.flush()
+        elif self._timer is None:
+            self._schedule_flush()
+
+    def flush(self):
+        """
+        Start sending the buffered traces and return a ``Future`` done once they're sent.
+        A flush started while another one is in progress waits for it to end.
+        """
+        if self._timer is not None:
+            timer = self._timer()
+            if timer is not None:
+                timer.cancel()
+            self._timer = None
+
+        if self._flushing is not None:
+            if self._pending is None:
+                self._pending = asyncio.Future(loop=self._loop)
+            return self._pending
+
+        traces, services = self.drain()
+        done = asyncio.Future(loop=self._loop)
+        self._flushing = _Flush(self._writer, self._loop, traces, services, done)
+        done.add_done_callback(self._on_flushed)
+        self._flushing.start()
+        return done
+
+    def drain(self):
+        """
+        Remove the buffered traces and services and return them.
+        """
+        traces, self._traces = self._traces, []
+        services, self._services = self._services, []
+        self._queued_bytes = 0
+        return traces, services
+
+    def stats(self):
+        return {
+            'queued_traces': len(self._traces),
+            'queued_bytes': self._queued_bytes,
+            'dropped_traces': self._dropped_traces,
+            'dropped_spans': self._dropped_spans,
+        }
+
+    @property
+    def _loop(self):
+        return self._loop_ref()
+
+    def _on_flushed(self, future):
+        self._dropped_traces += future.result()
+        self._flushing = None
+        pending, self._pending = self._pending, None
+        if pending is not None:
+            # chain the flush that was waiting, and resolve its future with it
+            self.flush().add_done_callback(lambda _: pending.set_result(None))
+        elif self._traces and self._timer is None:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        # the handle references the loop, which keeps it until it's called
+        timer = self._loop.call_later(self._writer._flush_interval, self.flush)
+        self._timer = weakref.ref(timer)
+
+
+class _Flush(object):
+    """
+    Encode and send a batch of traces, one step per loop iteration. The ``done``
+    future receives the number of traces that couldn't be sent.
+    """
+    def __init__(self, writer, loop, traces, services, done):
+        self._writer = writer
+        self._api = writer.api
+        self._loop = loop
+        self._traces = traces
+        self._services = services
+        self._done = done
+        self._encoded = []
+        self._payloads = []
+        self._dropped = 0
+
+    def start(self):
+        try:
+            self._traces = _apply_filters(self._writer._filters, self._traces)
+        except Exception as err:
+            log.error("error while filtering traces:{0}".format(err))
+        self._encoded = []
+        if self._traces and self._api.encoder.incremental:
+            self._loop.call_soon(self._encode, 0)
+        elif self._traces:
+            self._payloads = self._api.encode_traces(self._traces)
+            self._send_next()
+        else:
+            self._send_services()
+
+    def _encode(self, offset):
+        """
+        Encode the next batch of traces, then join them in payloads once they're all encoded.
+        """
+        encoder = self._api.encoder
+        deadline = time.time() + ENCODE_TIME_BUDGET
+        try:
+            while offset < len(self._traces):
+                self._encoded.append(encoder.encode_trace(self._traces[offset]))
+                offset += 1
+                if time.time() >= deadline:
+                    break
+        except Exception as err:
+            log.error("cannot encode traces: %s", err)
+            self._finish(len(self._traces))
+            return
+        if offset < len(self._traces):
+            self._loop.call_soon(self._encode, offset)
+            return
+
+        # keep the traces of each payload, so that they're encoded again if the API is downgraded
+        self._payloads = []
+        start = 0
+        for payload in self._api.join_traces(self._encoded):
+            self._payloads.append(Payload(payload.data, self._traces[start:start + payload.count]))
+            start += payload.count
+        self._encoded = []
+        self._send_next()
+
+    def _send_next(self):
+        if not self._payloads:
+            self._send_services()
+            return
+        payload = self._payloads.pop(0)
+        endpoint, body, headers = self._api.prepare_payload(payload)
+        self._request(endpoint, body, headers, lambda response: self._on_traces_response(payload, endpoint, response))
+
+    def _on_traces_response(self, payload, endpoint, response):
+        if response is None:
+            self._dropped += payload.count
+        elif self._api.downgrade_on(endpoint, response):
+            self._payloads = self._api.encode_traces(payload.traces) + self._payloads
+        elif response.status >= 400:
+            self._dropped += payload.count
+            self._writer._log_error("failed_to_send traces to Agent: HTTP error status %s, reason %s",
+                                    response.status, response.reason)
+        elif self._writer._priority_sampler:
+            result = _parse_response_json(response)
+            if result and 'rate_by_service' in result:
+                self._writer._priority_sampler.set_sample_rate_by_service(result['rate_by_service'])
+        self._send_next()
+
+    def _send_services(self):
+        request = self._api.prepare_services(self._services)
+        if request is None:
+            self._finish(0)
+            return
+        endpoint, body, headers = request
+        self._request(endpoint, body, headers, lambda response: self._on_services_response(endpoint, response))
+
+    def _on_services_response(self, endpoint, response):
+        if response is not None and self._api.downgrade_on(endpoint, response):
+            self._send_services()
+            return
+        if response is not None and response.status >= 400:
+            self._writer._log_error("failed_to_send services to Agent: HTTP error status %s, reason %s",
+                                    response.status, response.reason)
+        self._finish(0)
+
+    def _finish(self, dropped):
+        if not self._done.done():
+            self._done.set_result(self._dropped + dropped)
+
+    def _request(self, endpoint, body, headers, callback):
+        """
+        Send a ``PUT`` request without blocking the loop, and call ``callback`` with
+        the ``Response``, or ``None`` if the request failed.
+        """
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        api = self._api
+        lines = ['PUT {} HTTP/1.1'.format(endpoint), 'Host: {}:{}'.format(api.hostname, api.port),
+                 'Content-Length: {}'.format(len(body)), 'Connection: close']
+        lines.extend('{}: {}'.format(key, value) for key, value in headers.items())
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+        protocol = _AgentProtocol(request, self._loop, callback)
+        if api.uds_path:
+            connect = self._loop.create_unix_connection(lambda: protocol, api.uds_path)
+        else:
+            connect = self._loop.create_connection(lambda: protocol, api.hostname, api.port)
+        protocol.start(asyncio.ensure_future(connect, loop=self._loop), self._writer._timeout)
+
+
+class _AgentProtocol(asyncio.Protocol):
+    """
+    Protocol of a single HTTP request to the trace agent: the request is written
+    once connected and the response is read until the agent closes the connection.
+    """
+    def __init__(self, request, loop, callback):
+        self._request = request
+        self._loop = loop
+        self._callback = callback
+        self._transport = None
+        self._chunks = []
+        self._timer = None
+
+    def start(self, connect, timeout):
+        self._timer = self._loop.call_later(timeout, self._on_timeout, connect)
+        connect.add_done_callback(self._on_connect)
+
+    def connection_made(self, transport):
+        self._transport = transport
+        transport.write(self._request)
+
+    def data_received(self, data):
+        self._chunks.append(data)
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            self._done(None, exc)
+            return
+        try:
+            response = _parse_response(b''.join(self._chunks))
+        except ValueError as err:
+            self._done(None, err)
+            return
+        self._done(response)
+
+    def _on_connect(self, connect):
+        if connect.cancelled():
+            return
+        err = connect.exception()
+        if err is not None:
+            self._done(None, err)
+
+    def _on_timeout(self, connect):
+        connect.cancel()
+        if self._transport is not None:
+            self._transport.abort()
+        self._done(None, 'timed out')
+
+    def _done(self, response, err=None):
+        if self._callback is None:
+            return
+        callback, self._callback = self._callback, None
+        self._timer.cancel()
+        if err is not None:
+            log.debug("cannot send a request to the trace agent: %s", err)
+        callback(response)
+
+
+def _parse_response(data):
+    """
+    Return the ``Response`` parsed from an HTTP response that has been entirely read.
+    """
+    head, sep, body = data.partition(b'\r\n\r\n')
+    if not sep:
+        raise ValueError('incomplete HTTP response')
+    lines = head.decode('latin-1').split('\r\n')
+    parts = lines[0].split(' ', 2)
+    if len(parts) < 2 or not parts[1].isdigit():
+        raise ValueError('invalid HTTP status line: {!r}'.format(lines[0]))
+    headers = {}
+    for line in lines[1:]:
+        key, _, value = line.partition(':')
+        headers[key.strip().lower()] = value.strip()
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        # the agent chunks large responses to HTTP/1.1 requests
+        body = _decode_chunked(body)
+    elif 'content-length' in headers:
+        body = body[:int(headers['content-length'])]
+    return Response(int(parts[1]), parts[2] if len(parts) > 2 else '', headers, body)
+
+
+def _decode_chunked(data):
+    """
+    Return the body sent with the chunked transfer encoding in ``data``.
+    """
+    chunks = []
+    while True:
+        size, sep, data = data.partition(b'\r\n')
+        if not sep:
+            raise ValueError('incomplete chunked body')
+        # chunk extensions are ignored
+        size = int(size.split(b';', 1)[0].strip(), 16)
+        if size == 0:
+            # the trailer, if any, is ignored
+            return b''.join(chunks)
+        if len(data) < size + 2:
+            raise ValueError('incomplete chunked body')
+        chunks.append(data[:size])
+        data = data[size + 2:]
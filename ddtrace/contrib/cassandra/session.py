@@ -170,6 +170,8 @@ def _start_span_and_set_tags(pin, query, session, cluster):
     service = pin.service
     tracer = pin.tracer
     span = tracer.trace("cassandra.query", service=service, span_type=cassx.TYPE)
+    # the span is finished by the IO thread of the driver
+    span.context._make_thread_safe()
     _sanitize_query(span, query)
     span.set_tags(_extract_session_metas(session))     # FIXME[matt] do once?
     span.set_tags(_extract_cluster_metas(cluster))
@@ -7,8 +7,9 @@ def _wrap_submit(func, instance, args, kwargs):
     thread. This wrapper ensures that a new `Context` is created and
     properly propagated using an intermediate function.
     """
-    # propagate the same Context in the new thread
-    current_ctx = ddtrace.tracer.context_provider.active()
+    # propagate the same Context in the new thread; it's used by both threads
+    # so it's made thread-safe before being handed over
+    current_ctx = ddtrace.tracer.context_provider.active()._make_thread_safe()
 
     # extract the target function that must be executed in
     # a new thread and the `target` arguments
@@ -28,6 +28,14 @@ patch ``gevent`` **before importing** the library::
 
             with tracer.trace("greenlet.child_call") as child:
                 ...
+
+Traces can also be flushed by a greenlet that reaches the agent with gevent
+sockets, so that it doesn't block the hub or compete with it from a separate
+thread. It runs in the hub of the thread that configures the tracer, which must
+keep running, e.g. the main thread of a gevent application::
+
+    patch(gevent=True)
+    tracer.configure(native_writer=True)
 """
 from ...utils.importlib import require_modules
 
@@ -38,6 +46,7 @@ with require_modules(required_modules) as missing_modules:
     if not missing_modules:
         from .provider import GeventContextProvider
         from .patch import patch, unpatch
+        from .writer import GeventWriter
 
         context_provider = GeventContextProvider()
 
@@ -45,4 +54,5 @@ with require_modules(required_modules) as missing_modules:
             'patch',
             'unpatch',
             'context_provider',
+            'GeventWriter',
         ]
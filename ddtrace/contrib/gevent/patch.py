@@ -32,7 +32,7 @@ def unpatch():
     class may be used during initialization.
     """
     _replace(__Greenlet, __IMap, __IMapUnordered)
-    ddtrace.tracer.configure(context_provider=DefaultContextProvider())
+    ddtrace.tracer.configure(context_provider=DefaultContextProvider(), native_writer=False)
 
 
 def _replace(g_class, imap_class, imap_unordered_class):
@@ -1,7 +1,8 @@
 import gevent
 
-from ...context import Context
+from ...context import LockFreeContext
 from ...provider import BaseContextProvider
+from .writer import GeventWriter
 
 
 # Greenlet attribute used to set/get the Context instance
@@ -15,6 +16,8 @@ class GeventContextProvider(BaseContextProvider):
     in the ``gevent`` library. Framework instrumentation that uses the
     gevent WSGI server (or gevent in general), can use this provider.
     """
+    writer_class = GeventWriter
+
     def activate(self, context):
         """Sets the scoped ``Context`` for the current running ``Greenlet``.
         """
@@ -39,6 +42,7 @@ class GeventContextProvider(BaseContextProvider):
         # even to the main greenlet. This is required in Distributed Tracing
         # when a new arbitrary Context is provided.
         if current_g:
-            ctx = Context()
+            # greenlets of the same hub run in the same thread, one at a time
+            ctx = LockFreeContext()
             setattr(current_g, CONTEXT_ATTR, ctx)
             return ctx
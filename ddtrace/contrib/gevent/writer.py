@@ -0,0 +1,181 @@
+"""
+Writer that flushes traces from a greenlet, so that it cooperates with the
+other greenlets whether or not the ``threading`` and ``socket`` modules have
+been monkey patched.
+"""
+import atexit
+import collections
+import logging
+import socket
+
+import gevent
+import gevent.event
+import gevent.monkey
+import gevent.socket
+
+from ...compat import PY2, httplib
+from ...writer import AgentWriter, AsyncWorker, Q
+
+
+log = logging.getLogger(__name__)
+
+# the identifier of the OS thread, even when ``threading`` is monkey patched
+_get_ident = gevent.monkey.get_original('thread' if PY2 else '_thread', 'get_ident')
+
+
+class GeventWriter(AgentWriter):
+    """
+    ``AgentWriter`` that flushes traces from a greenlet instead of a thread, waits
+    with gevent events and reaches the trace agent with gevent sockets. The greenlet
+    runs in the hub of the thread that creates the writer, usually the main one:
+    traces written from other threads wake it up through the loop of that hub.
+
+    It is used by the tracer when it's configured with the ``GeventContextProvider``
+    and ``native_writer=True``. The shared buffer isn't supported.
+    """
+    def __init__(self, *args, **kwargs):
+        if kwargs.pop('shared_buffer_size', 0):
+            log.warning('the shared buffer is not supported by the gevent writer')
+        if kwargs.get('connection_factory') is None:
+            kwargs['connection_factory'] = gevent_connection_factory(kwargs.get('uds_path'))
+        self._hub_callbacks = _HubCallbacks(gevent.get_hub())
+        super(GeventWriter, self).__init__(*args, **kwargs)
+
+    def _create_trace_queue(self, **kwargs):
+        return GeventQ(self._hub_callbacks, **kwargs)
+
+    def _create_worker(self, *args, **kwargs):
+        kwargs['hub_callbacks'] = self._hub_callbacks
+        return GeventWorker(*args, **kwargs)
+
+
+class GeventWorker(AsyncWorker):
+    """
+    ``AsyncWorker`` running in a greenlet of the hub of ``hub_callbacks``. When it's
+    started from another thread, the greenlet is spawned once the hub runs.
+    """
+    def __init__(self, *args, **kwargs):
+        self._hub_callbacks = kwargs.pop('hub_callbacks')
+        super(GeventWorker, self).__init__(*args, **kwargs)
+
+    def _create_event(self):
+        return gevent.event.Event()
+
+    def is_alive(self):
+        # the greenlet may not be spawned yet
+        return self._thread is None or not self._thread.dead
+
+    def start(self):
+        self._hub_callbacks.run(self._spawn)
+
+    def stop(self):
+        # the stop event can only be set from the hub
+        self._hub_callbacks.run(super(GeventWorker, self).stop)
+
+    def join(self, timeout=2):
+        if self._thread is not None:
+            super(GeventWorker, self).join(timeout)
+
+    def _spawn(self):
+        with self._lock:
+            if not self._thread:
+                log.debug("starting flush greenlet")
+                self._thread = gevent.spawn(self._target)
+                atexit.register(self._on_shutdown)
+
+
+class GeventQ(Q):
+    """
+    ``Q`` that the worker greenlet waits for with a gevent event, instead of a
+    condition that would block the hub. The event is set from the hub of
+    ``hub_callbacks``, since gevent events aren't thread-safe.
+    """
+    def __init__(self, hub_callbacks, **kwargs):
+        super(GeventQ, self).__init__(**kwargs)
+        self._ready = gevent.event.Event()
+        self._flush_ready = _EventCondition(self._ready, hub_callbacks)
+
+    def wait(self, timeout):
+        with self._lock:
+            if self._closed or self._is_flush_ready():
+                return
+            self._ready.clear()
+        self._ready.wait(timeout)
+
+
+class _EventCondition(object):
+    """
+    Notifications of a ``Q`` condition forwarded to a gevent event.
+    """
+    def __init__(self, event, hub_callbacks):
+        self._event = event
+        self._hub_callbacks = hub_callbacks
+
+    def notify(self):
+        self._hub_callbacks.run(self._event.set)
+
+    def notify_all(self):
+        self._hub_callbacks.run(self._event.set)
+
+
+class _HubCallbacks(object):
+    """
+    Run callbacks in the loop of a hub from any thread: right away from the thread
+    of the hub, otherwise through an async watcher, that is the only thread-safe
+    way to wake up a gevent loop. It must be created in the thread of the hub.
+    """
+    def __init__(self, hub):
+        self._thread_ident = _get_ident()
+        self._pending = collections.deque()
+        # ``async`` is a keyword since Python 3.7, and it's named ``async_`` since gevent 1.3
+        new_async = getattr(hub.loop, 'async_', None) or getattr(hub.loop, 'async')
+        # the watcher doesn't keep the loop running
+        self._watcher = new_async(ref=False)
+        self._watcher.start(self._run_pending)
+
+    def run(self, callback):
+        if _get_ident() == self._thread_ident:
+            callback()
+            return
+        self._pending.append(callback)
+        self._watcher.send()
+
+    def _run_pending(self):
+        while self._pending:
+            callback = self._pending.popleft()
+            try:
+                callback()
+            except Exception as err:
+                log.error("error in a callback of the flush greenlet: %s", err)
+
+
+def gevent_connection_factory(uds_path=None):
+    """
+    Return a connection factory that reaches the trace agent with gevent sockets,
+    through the Unix domain socket at ``uds_path`` if it's set.
+    """
+    def factory(hostname, port):
+        return GeventHTTPConnection(hostname, port, uds_path=uds_path)
+    return factory
+
+
+class GeventHTTPConnection(httplib.HTTPConnection):
+    """
+    ``HTTPConnection`` using a cooperative gevent socket.
+    """
+    def __init__(self, *args, **kwargs):
+        self.uds_path = kwargs.pop('uds_path', None)
+        # DEV: ``HTTPConnection`` is an old-style class in Python 2
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+
+    def connect(self):
+        if self.uds_path:
+            sock = gevent.socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(self.timeout)
+            sock.connect(self.uds_path)
+        else:
+            sock = gevent.socket.create_connection((self.host, self.port), self.timeout)
+            # don't delay the small requests sent to the agent
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = sock
@@ -76,8 +76,10 @@ def should_skip_request(pin, request):
     if not pin or not pin.enabled():
         return True
 
-    api = pin.tracer.writer.api
-    return request.host == api.hostname and request.port == api.port
+    writer = pin.tracer.writer
+    agent_pool = getattr(writer, 'agent_pool', None)
+    apis = [endpoint.api for endpoint in agent_pool.endpoints] if agent_pool else [writer.api]
+    return any(request.host == api.hostname and request.port == api.port for api in apis)
 
 
 def patch():
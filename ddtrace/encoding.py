@@ -1,5 +1,8 @@
 import json
 import logging
+import threading
+
+from .compat import string_type, stringify
 
 
 # check msgpack CPP implementation; if the import fails, we're using the
@@ -25,6 +28,10 @@ class Encoder(object):
     """
     Encoder interface that provides the logic to encode traces and service.
     """
+    # traces encoded one by one with ``encode_trace()`` are joined later without
+    # being decoded, so it's as cheap as encoding them at once
+    incremental = True
+
     def __init__(self):
         """
         When extending the ``Encoder`` class, ``headers`` must be set because
@@ -46,6 +53,66 @@ class Encoder(object):
         normalized_traces = [[span.to_dict() for span in trace] for trace in traces]
         return self._encode(normalized_traces)
 
+    def encode_trace(self, trace):
+        """
+        Encodes a single trace, expecting a list of spans. Encoded traces can be
+        assembled in a payload with ``join_encoded()``, so that the size of a
+        payload is known before it is built.
+
+        :param trace: A list of spans that should be serialized
+        """
+        return self._encode([span.to_dict() for span in trace])
+
+    def join_encoded(self, objs):
+        """
+        Joins a list of already encoded items, e.g. traces returned by
+        ``encode_trace()``, in a single encoded list.
+
+        :param objs: A list of encoded items
+        """
+        raise NotImplementedError
+
+    def encode_chunks(self, traces, max_size):
+        """
+        Encodes a list of traces in chunks, each one smaller than ``max_size``
+        unless it contains a single trace that is larger. Returns a list of
+        ``(data, traces)`` tuples.
+
+        :param traces: A list of traces that should be serialized
+        :param int max_size: The maximum size in bytes of an encoded chunk
+        """
+        chunks = []
+        start = 0
+        for data, count in self.join_chunks([self.encode_trace(trace) for trace in traces], max_size):
+            chunks.append((data, traces[start:start + count]))
+            start += count
+        return chunks
+
+    def join_chunks(self, objs, max_size):
+        """
+        Joins a list of traces returned by ``encode_trace()`` in chunks, each one
+        smaller than ``max_size`` unless it contains a single trace that is larger.
+        Returns a list of ``(data, count)`` tuples.
+
+        :param objs: A list of encoded traces
+        :param int max_size: The maximum size in bytes of an encoded chunk
+        """
+        chunks = []
+        encoded = []
+        # joining the traces adds a list header, and a separator between JSON items
+        size = 5
+        for data in objs:
+            if encoded and size + len(data) + 1 > max_size:
+                chunks.append((self.join_encoded(encoded), len(encoded)))
+                encoded = []
+                size = 5
+            encoded.append(data)
+            size += len(data) + 1
+
+        if encoded:
+            chunks.append((self.join_encoded(encoded), len(encoded)))
+        return chunks
+
     def encode_services(self, services):
         """
         Encodes a dictionary of services.
@@ -71,6 +138,12 @@ class JSONEncoder(Encoder):
     def _encode(self, obj):
         return json.dumps(obj)
 
+    def join_encoded(self, objs):
+        if objs and isinstance(objs[0], bytes):
+            # traces that were stored as bytes, e.g. in a shared buffer
+            return b'[' + b','.join(objs) + b']'
+        return '[' + ','.join(objs) + ']'
+
 
 class MsgpackEncoder(Encoder):
     def __init__(self):
@@ -80,6 +153,350 @@ class MsgpackEncoder(Encoder):
     def _encode(self, obj):
         return msgpack.packb(obj, **MSGPACK_PARAMS)
 
+    def join_encoded(self, objs):
+        return msgpack.Packer(**MSGPACK_PARAMS).pack_array_header(len(objs)) + b''.join(objs)
+
+
+class StreamingMsgpackEncoder(MsgpackEncoder):
+    """
+    Msgpack encoder that writes spans straight into a reusable ``Packer`` buffer,
+    without building the intermediate ``Span.to_dict()`` dictionaries. The output
+    is the same as the ``MsgpackEncoder`` one.
+    """
+    def __init__(self):
+        super(StreamingMsgpackEncoder, self).__init__()
+        # each thread has its own buffer, so that traces can be encoded concurrently
+        self._local = threading.local()
+
+    def encode_traces(self, traces):
+        packer = self._get_packer()
+        try:
+            packer.pack_array_header(len(traces))
+            for trace in traces:
+                self._pack_trace(packer, trace)
+            return packer.bytes()
+        finally:
+            packer.reset()
+
+    def encode_trace(self, trace):
+        packer = self._get_packer()
+        try:
+            self._pack_trace(packer, trace)
+            return packer.bytes()
+        finally:
+            packer.reset()
+
+    def _get_packer(self):
+        packer = getattr(self._local, 'packer', None)
+        if packer is None:
+            packer = msgpack.Packer(autoreset=False, **MSGPACK_PARAMS)
+            self._local.packer = packer
+        return packer
+
+    def _pack_trace(self, packer, trace):
+        packer.pack_array_header(len(trace))
+        for span in trace:
+            self._pack_span(packer, span)
+
+    @staticmethod
+    def _pack_span(packer, span):
+        """
+        Write a span as a msgpack map; fields are the ones of ``Span.to_dict()``
+        and must be kept in sync with it.
+        """
+        # a common mistake is to set the error field to a boolean instead of an int
+        error = span.error
+        if error is True:
+            error = 1
+        if span._exc_stack is not None:
+            span._format_exc_stack()
+
+        # optional fields are only written if set, so count them for the map header
+        start = span.start_ns
+        duration = span.duration_ns
+        # read the slots, so that the dictionaries of spans without tags aren't allocated
+        meta = span._meta
+        metrics = span._metrics
+        span_type = span.span_type
+        size = 7
+        if start:
+            size += 1
+        if duration:
+            size += 1
+        if meta:
+            size += 1
+        if metrics:
+            size += 1
+        if span_type:
+            size += 1
+
+        pack = packer.pack
+        packer.pack_map_header(size)
+        pack('trace_id')
+        pack(span.trace_id)
+        pack('parent_id')
+        pack(span.parent_id)
+        pack('span_id')
+        pack(span.span_id)
+        pack('service')
+        pack(span.service)
+        pack('resource')
+        pack(span.resource)
+        pack('name')
+        pack(span.name)
+        pack('error')
+        pack(error)
+        if start:
+            pack('start')
+            pack(start)
+        if duration:
+            pack('duration')
+            pack(duration)
+        if meta:
+            pack('meta')
+            pack(meta)
+        if metrics:
+            pack('metrics')
+            pack(metrics)
+        if span_type:
+            pack('type')
+            pack(span_type)
+
+
+class StringTable(object):
+    """
+    Table of the strings of a payload, where each string is stored once and
+    referenced by its index. The empty string is always at index ``0``.
+    """
+    def __init__(self):
+        self._index = {'': 0}
+        self._strings = ['']
+        # size of the strings once encoded in msgpack
+        self.size = 1
+
+    def __len__(self):
+        return len(self._strings)
+
+    def __iter__(self):
+        return iter(self._strings)
+
+    def index(self, value):
+        """
+        Return the index of the given string, adding it to the table if needed.
+        ``None`` is encoded as the empty string.
+        """
+        if value is None:
+            return 0
+        if not isinstance(value, string_type):
+            value = stringify(value)
+        idx = self._index.get(value)
+        if idx is None:
+            idx = len(self._strings)
+            self._index[value] = idx
+            self._strings.append(value)
+            self.size += _msgpack_str_size(value)
+        return idx
+
+    def mark(self):
+        """
+        Return the current state of the table, that can be restored with ``rollback()``.
+        """
+        return len(self._strings), self.size
+
+    def rollback(self, mark):
+        """
+        Remove the strings added after the given ``mark()``.
+        """
+        length, size = mark
+        for value in self._strings[length:]:
+            del self._index[value]
+        del self._strings[length:]
+        self.size = size
+
+
+def _msgpack_str_size(value):
+    """
+    Return the size of a string encoded in msgpack.
+    """
+    if not isinstance(value, bytes):
+        value = value.encode('utf-8')
+    length = len(value)
+    if length < 32:
+        return length + 1
+    elif length < 256:
+        return length + 2
+    elif length < 65536:
+        return length + 3
+    return length + 5
+
+
+# the span fields that are indexes in the string table, apart from meta and metrics
+_STRING_FIELDS = (0, 1, 2, 11)
+
+
+def _unpackb(data):
+    try:
+        return msgpack.unpackb(data, raw=False)
+    except TypeError:
+        # the raw parameter only exists since msgpack-python v0.5.2
+        return msgpack.unpackb(data, encoding='utf-8')
+
+
+class StringTableMsgpackEncoder(MsgpackEncoder):
+    """
+    Msgpack encoder for the ``v0.5`` API, where strings are sent once per payload
+    in a string table. A payload is a ``[strings, traces]`` array, and each span is
+    an array of fields where strings are replaced with their index in the table::
+
+        [service, name, resource, trace_id, span_id, parent_id,
+         start, duration, error, meta, metrics, type]
+
+    A trace encoded alone with ``encode_trace()`` has its own table: the traces are
+    decoded to merge the tables when they're joined, so it's not ``incremental``.
+    """
+    incremental = False
+
+    def __init__(self):
+        super(StringTableMsgpackEncoder, self).__init__()
+        self._local = threading.local()
+
+    def encode_traces(self, traces):
+        table = StringTable()
+        return self._join(table, [self._encode_trace(table, trace) for trace in traces])
+
+    def encode_trace(self, trace):
+        """
+        Encode a single trace with its own string table, as a payload of one trace.
+        """
+        table = StringTable()
+        return self._join(table, [self._encode_trace(table, trace)])
+
+    def join_encoded(self, objs):
+        """
+        Join payloads returned by ``encode_trace()`` in a single one, whose string
+        table is merged from theirs.
+        """
+        table = StringTable()
+        encoded = []
+        packer = self._get_packer()
+        for data in objs:
+            strings, traces = _unpackb(data)
+            # the index of each string in the merged table
+            index = [table.index(value) for value in strings]
+            for trace in traces:
+                for fields in trace:
+                    for i in _STRING_FIELDS:
+                        fields[i] = index[fields[i]]
+                    fields[9] = dict((index[key], index[value]) for key, value in fields[9].items())
+                    fields[10] = dict((index[key], value) for key, value in fields[10].items())
+                try:
+                    packer.pack(trace)
+                    encoded.append(packer.bytes())
+                finally:
+                    packer.reset()
+        return self._join(table, encoded)
+
+    def encode_chunks(self, traces, max_size):
+        chunks = []
+        chunk = []
+        encoded = []
+        table = StringTable()
+        # the payload and the traces array headers use at most 11 bytes
+        size = 11
+        for trace in traces:
+            mark = table.mark()
+            data = self._encode_trace(table, trace)
+            if chunk and size + table.size + len(data) > max_size:
+                # this trace goes in the next chunk, with its own string table
+                table.rollback(mark)
+                chunks.append((self._join(table, encoded), chunk))
+                chunk = []
+                encoded = []
+                table = StringTable()
+                size = 11
+                data = self._encode_trace(table, trace)
+            chunk.append(trace)
+            encoded.append(data)
+            size += len(data)
+
+        if chunk:
+            chunks.append((self._join(table, encoded), chunk))
+        return chunks
+
+    def _get_packer(self):
+        packer = getattr(self._local, 'packer', None)
+        if packer is None:
+            packer = msgpack.Packer(autoreset=False, **MSGPACK_PARAMS)
+            self._local.packer = packer
+        return packer
+
+    def _join(self, table, encoded):
+        packer = self._get_packer()
+        try:
+            packer.pack_array_header(2)
+            packer.pack_array_header(len(table))
+            for value in table:
+                packer.pack(value)
+            packer.pack_array_header(len(encoded))
+            return packer.bytes() + b''.join(encoded)
+        finally:
+            packer.reset()
+
+    def _encode_trace(self, table, trace):
+        packer = self._get_packer()
+        try:
+            packer.pack_array_header(len(trace))
+            for span in trace:
+                self._pack_span(packer, table, span)
+            return packer.bytes()
+        finally:
+            packer.reset()
+
+    @staticmethod
+    def _pack_span(packer, table, span):
+        index = table.index
+        pack = packer.pack
+
+        # a common mistake is to set the error field to a boolean instead of an int
+        error = span.error
+        if error is True:
+            error = 1
+        if span._exc_stack is not None:
+            span._format_exc_stack()
+
+        packer.pack_array_header(12)
+        pack(index(span.service))
+        pack(index(span.name))
+        pack(index(span.resource))
+        pack(span.trace_id)
+        pack(span.span_id)
+        pack(span.parent_id or 0)
+        pack(span.start_ns or 0)
+        pack(span.duration_ns or 0)
+        pack(error or 0)
+
+        # read the slots, so that the dictionaries of spans without tags aren't allocated
+        meta = span._meta
+        if meta:
+            packer.pack_map_header(len(meta))
+            for key, value in meta.items():
+                pack(index(key))
+                pack(index(value))
+        else:
+            packer.pack_map_header(0)
+
+        metrics = span._metrics
+        if metrics:
+            packer.pack_map_header(len(metrics))
+            for key, value in metrics.items():
+                pack(index(key))
+                pack(value)
+        else:
+            packer.pack_map_header(0)
+
+        pack(index(span.span_type))
+
+
 def get_encoder():
     """
     Switching logic that choose the best encoder for the API transport.
@@ -87,6 +504,6 @@ def get_encoder():
     installed, falling back to the Python built-in JSON encoder.
     """
     if MSGPACK_ENCODING:
-        return MsgpackEncoder()
+        return StreamingMsgpackEncoder()
     else:
         return JSONEncoder()
@@ -0,0 +1,195 @@
+"""
+Routing of the payloads between several trace agents, e.g. a node-local agent and
+a secondary one that takes over when the first one is down or overloaded.
+"""
+import logging
+
+from .utils.retry import CircuitBreaker
+
+
+log = logging.getLogger(__name__)
+
+# payloads are sent to the first available agent
+ROUTING_FAILOVER = 'failover'
+# payloads are spread over the available agents in proportion to their weight
+ROUTING_ROUND_ROBIN = 'round_robin'
+ROUTINGS = (ROUTING_FAILOVER, ROUTING_ROUND_ROBIN)
+
+
+class AgentEndpoint(object):
+    """
+    A trace agent reached through ``api``, with the circuit breaker that tracks its
+    health and the sampling rates by service it reported last.
+    """
+    def __init__(self, api, circuit_breaker=None, weight=1):
+        self.api = api
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self.weight = weight
+        self.rate_by_service = None
+        # current weight of the smooth weighted round-robin
+        self._current_weight = 0
+
+    def __repr__(self):
+        if getattr(self.api, 'uds_path', None):
+            return 'AgentEndpoint({})'.format(self.api.uds_path)
+        return 'AgentEndpoint({}:{})'.format(self.api.hostname, self.api.port)
+
+    def healthy(self):
+        return self.circuit_breaker.state == CircuitBreaker.CLOSED
+
+    def available(self):
+        """
+        Return ``False`` if the circuit breaker is open because the agent is down.
+        When the circuit is half-open, a cheap probe is sent first.
+        """
+        breaker = self.circuit_breaker
+        if not breaker.allow():
+            return False
+
+        if breaker.state == CircuitBreaker.HALF_OPEN:
+            try:
+                response = self.api.probe()
+            except Exception as err:
+                response = None
+                log.debug("probe of %r failed: %s", self, err)
+            if not _is_successful(response):
+                breaker.record_failure()
+                return False
+            breaker.record_success()
+        return True
+
+    def accepts(self, payload, source):
+        """
+        Return ``True`` if the given ``Payload``, encoded by the ``source`` API, can be
+        sent to this agent: traces joined ahead of time can't be encoded again, so they
+        can't be sent to an agent whose API has been downgraded to another format.
+        """
+        return payload.traces is not None or self._same_format(source)
+
+    def send_payload(self, payload, source):
+        """
+        Send the given ``Payload``, encoded by the ``source`` API; its traces are
+        encoded again if the API of this agent uses another format.
+        """
+        if payload.traces is not None and not self._same_format(source):
+            return self.api.send_traces(payload.traces)
+        return self.api.send_payload(payload)
+
+    def _same_format(self, source):
+        return self.api is source or type(self.api.encoder) is type(source.encoder)
+
+
+class AgentPool(object):
+    """
+    The trace agents that payloads are sent to, in order of priority. With the
+    ``failover`` routing, payloads go to the first available agent, so that the
+    next ones are only used while the previous ones are down or failing. With the
+    ``round_robin`` routing, they are spread over the available agents in
+    proportion to their ``weight``.
+
+    Each agent reports sampling rates computed from the traffic it receives. With
+    the ``round_robin`` routing, the rates applied are the ones of a single agent,
+    kept as long as it's healthy, so that the priority sampler doesn't swing from
+    the rates of an agent to the ones of another.
+
+    Non-safe if used by more than one flush thread.
+    """
+    def __init__(self, endpoints, routing=ROUTING_FAILOVER):
+        if routing not in ROUTINGS:
+            raise ValueError('unknown routing {!r}, expected one of {}'.format(routing, ', '.join(ROUTINGS)))
+        if not endpoints:
+            raise ValueError('at least one trace agent is required')
+        self.endpoints = list(endpoints)
+        self.routing = routing
+        # the agent whose sampling rates are applied
+        self._rates_endpoint = None
+
+    @property
+    def primary(self):
+        return self.endpoints[0]
+
+    def healthy(self):
+        """
+        Return ``True`` if the circuit of at least one agent is closed.
+        """
+        return any(endpoint.healthy() for endpoint in self.endpoints)
+
+    def healthy_endpoint(self):
+        """
+        Return the first agent whose circuit is closed, or ``None``; the circuits
+        are left untouched.
+        """
+        for endpoint in self.endpoints:
+            if endpoint.healthy():
+                return endpoint
+        return None
+
+    def available(self):
+        """
+        Return ``True`` if at least one agent is available, probing the agents whose
+        circuit is half-open until one answers.
+        """
+        return any(endpoint.available() for endpoint in self.endpoints)
+
+    def select(self, avoid=None, accepts=None):
+        """
+        Return the agent that the next payload must be sent to, or ``None`` if they're
+        all down. Another agent than ``avoid``, e.g. because it just failed, is
+        preferred if one is available.
+
+        :param callable accepts: if set, only the agents for which it returns ``True``
+            are considered.
+        """
+        available = []
+        for endpoint in self.endpoints:
+            if accepts is not None and not accepts(endpoint):
+                continue
+            if not endpoint.available():
+                continue
+            available.append(endpoint)
+            if self.routing == ROUTING_FAILOVER and endpoint is not avoid:
+                break
+
+        if len(available) > 1 and avoid in available:
+            available.remove(avoid)
+        if not available:
+            return None
+        if self.routing == ROUTING_FAILOVER or len(available) == 1:
+            return available[0]
+        return self._next_weighted(available)
+
+    def update_rates(self, endpoint, rate_by_service):
+        """
+        Record the sampling rates reported by the given agent; return the rates that
+        the priority sampler must apply, or ``None`` if they must not be applied.
+        """
+        endpoint.rate_by_service = rate_by_service
+        current = self._rates_endpoint
+        if self.routing == ROUTING_ROUND_ROBIN and current is not None and current is not endpoint and \
+                current.healthy():
+            return None
+        self._rates_endpoint = endpoint
+        return rate_by_service
+
+    def _next_weighted(self, endpoints):
+        """
+        Smooth weighted round-robin: each agent gains its weight, the agent with
+        the largest current weight is picked and loses the total of the weights.
+        """
+        total = 0
+        selected = None
+        for endpoint in endpoints:
+            endpoint._current_weight += endpoint.weight
+            total += endpoint.weight
+            if selected is None or endpoint._current_weight > selected._current_weight:
+                selected = endpoint
+        selected._current_weight -= total
+        return selected
+
+
+def _is_successful(response):
+    """
+    Return ``False`` if the response is missing or reports an error of the trace agent,
+    that may go away if the request is sent again later.
+    """
+    return response is not None and getattr(response, 'status', 0) < 500
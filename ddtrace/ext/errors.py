@@ -8,6 +8,8 @@ import traceback
 ERROR_MSG = "error.msg"     # a string representing the error message
 ERROR_TYPE = "error.type"   # a string representing the type of the error
 ERROR_STACK = "error.stack" # a human readable version of the stack. beta.
+ERROR_FINGERPRINT = "error.fingerprint" # identifies the errors with the same type and stack
+ERROR_OCCURRENCES = "error.occurrences" # the number of errors with the same fingerprint sent in the interval
 
 # shorthand for -----^
 MSG = ERROR_MSG
@@ -1,6 +1,14 @@
+import hashlib
+import os
 import re
+import threading
+import time
 
-from .ext import http
+from .compat import to_unicode
+from .ext import errors, http
+
+# the frame locations of a traceback formatted by the traceback module
+_FRAME_LOCATION = re.compile(r'^  File "(.*)", line (\d+), in (.*)$', re.MULTILINE)
 
 class FilterRequestsOnUrl(object):
     """Filter out traces from incoming http requests based on the request's url.
@@ -46,3 +54,96 @@ class FilterRequestsOnUrl(object):
                     if regexp.match(url):
                         return None
         return trace
+
+
+class FilterDuplicateErrorStacks(object):
+    """Send the stack of identical errors only once per interval.
+    Errors are fingerprinted by their ``error.type`` and the locations (file,
+    line and function) of the frames of their ``error.stack``. Only the first
+    error span of a fingerprint keeps its stack in each interval of ``interval``
+    seconds; the next ones are sent without it. Every error span is tagged with
+    its ``error.fingerprint`` and with ``error.occurrences``, the number of errors
+    with the same fingerprint in the interval so far.
+
+    To bound the memory used, at most ``max_fingerprints`` fingerprints are
+    counted by interval; the stacks of the errors with other fingerprints are
+    always sent.
+
+    :param float interval: the number of seconds after which stacks are sent again.
+    :param int max_fingerprints: the maximum number of fingerprints by interval.
+
+    Example::
+
+        Tracer.configure(settings={
+            'FILTERS': [
+                FilterDuplicateErrorStacks(interval=60),
+            ],
+        })
+    """
+    def __init__(self, interval=60, max_fingerprints=1000):
+        self.interval = interval
+        self.max_fingerprints = max_fingerprints
+        self._lock = threading.Lock()
+        self._reset()
+
+    def process_trace(self, trace):
+        """
+        Tag the error spans of the trace with their fingerprint and remove the
+        stacks already sent in the interval.
+        """
+        for span in trace:
+            if not span.error:
+                continue
+            fingerprint = _fingerprint(span)
+            if fingerprint is None:
+                continue
+            with self._lock:
+                self._check_interval()
+                occurrences = self._occurrences.get(fingerprint, 0) + 1
+                if occurrences > 1 or len(self._occurrences) < self.max_fingerprints:
+                    self._occurrences[fingerprint] = occurrences
+            span.set_tag(errors.ERROR_FINGERPRINT, fingerprint)
+            span.set_metric(errors.ERROR_OCCURRENCES, occurrences)
+            if occurrences > 1:
+                # the stack captured by set_exc_info() isn't even formatted
+                span._exc_stack = None
+                span._remove_tag(errors.ERROR_STACK)
+        return trace
+
+    def _reset(self):
+        """
+        Non-safe if not used with a lock.
+        """
+        self._pid = os.getpid()
+        self._start = time.time()
+        self._occurrences = {}
+
+    def _check_interval(self):
+        """
+        Start a new interval when the current one is over, or in a forked process.
+        Non-safe if not used with a lock.
+        """
+        if self._pid != os.getpid() or time.time() >= self._start + self.interval:
+            self._reset()
+
+
+def _fingerprint(span):
+    """
+    Return the fingerprint of the error of the span, or ``None`` if it has no
+    type or stack.
+    """
+    error_type = span.get_tag(errors.ERROR_TYPE)
+    if not error_type:
+        return None
+    # a stack set explicitly takes precedence over the one captured by set_exc_info()
+    stack = span._meta.get(errors.ERROR_STACK)
+    if stack is not None:
+        frames = _FRAME_LOCATION.findall(stack)
+    elif span._exc_stack is not None:
+        frames = [(frame.filename, frame.lineno, frame.name) for frame in span._exc_stack.stack]
+    else:
+        return None
+    digest = hashlib.sha1(to_unicode(error_type).encode('utf-8'))
+    for filename, lineno, name in frames:
+        digest.update(u'\n{}:{}:{}'.format(to_unicode(filename), lineno, to_unicode(name)).encode('utf-8'))
+    return digest.hexdigest()[:16]
@@ -9,7 +9,17 @@ class BaseContextProvider(object):
     and implement:
         * the ``active`` method, that returns the current active ``Context``
         * the ``activate`` method, that sets the current active ``Context``
+
+    Providers that guarantee that the ``Context`` they create is only used by a
+    single thread, e.g. by the greenlets of a gevent hub, can create a
+    ``LockFreeContext`` instead, that doesn't lock on each operation.
+
+    Providers of asynchronous frameworks can set ``writer_class`` to a writer that
+    sends traces with the framework I/O, used when the tracer is configured with
+    ``native_writer=True``.
     """
+    writer_class = None
+
     def activate(self, context):
         raise NotImplementedError
 
@@ -0,0 +1,182 @@
+"""
+Ring buffer of records stored in shared memory, used by the processes of a
+pre-fork server (gunicorn, uwsgi, celery) to hand their encoded traces over to
+a single exporter.
+
+The buffer must be created before forking: the anonymous memory map and the
+lock are then inherited by the child processes, and shared with them. The pid of
+the process holding the lock is stored in the memory map as well, so that a lock
+left held by a process that was killed can be taken over by another one.
+"""
+import logging
+import mmap
+import multiprocessing
+import os
+import struct
+
+from .utils import forksafe
+
+
+log = logging.getLogger(__name__)
+
+# write position, read position (both increase forever), number of records in the
+# buffer, number of records dropped because the buffer was full and number of items
+# they contained
+_HEADER = struct.Struct('<QQQQQ')
+# pid of the process holding the lock, after the header
+_OWNER = struct.Struct('<Q')
+_OWNER_OFFSET = _HEADER.size
+_DATA_OFFSET = _OWNER_OFFSET + _OWNER.size
+# size of the data, kind of record and number of items it contains
+_RECORD = struct.Struct('<IBI')
+
+# maximum time spent waiting for another process to release the buffer
+LOCK_TIMEOUT = 0.1
+
+
+class SharedRingBuffer(object):
+    """
+    Multi-process ring buffer of variable size records, backed by an anonymous
+    shared memory map of ``size`` bytes. When there's no room left for a record,
+    it is dropped and accounted in the buffer statistics.
+    """
+    def __init__(self, size):
+        self._capacity = size
+        self._mmap = mmap.mmap(-1, _DATA_OFFSET + size)
+        self._lock = multiprocessing.Lock()
+        # serializes the take over of the lock, so that a single process inherits it
+        self._takeover_lock = multiprocessing.Lock()
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def write(self, data, kind=0, items=0):
+        """
+        Append a record; return ``False`` if it has been dropped because the buffer
+        is full.
+
+        :param bytes data: the content of the record
+        :param int kind: the type of the record, returned by ``read()``
+        :param int items: the number of items in the record, e.g. spans, counted when
+            the record is dropped
+        """
+        record = _RECORD.pack(len(data), kind, items) + data
+        if not self._acquire():
+            log.debug('shared buffer is locked, dropping a record of %d bytes', len(data))
+            return False
+        try:
+            write_pos, read_pos, records, dropped, dropped_items = _HEADER.unpack_from(self._mmap, 0)
+            if write_pos - read_pos + len(record) > self._capacity:
+                _HEADER.pack_into(self._mmap, 0, write_pos, read_pos, records, dropped + 1, dropped_items + items)
+                return False
+            self._copy_in(write_pos, record)
+            _HEADER.pack_into(self._mmap, 0, write_pos + len(record), read_pos, records + 1, dropped, dropped_items)
+            return True
+        finally:
+            self._release()
+
+    def read(self):
+        """
+        Remove all the records from the buffer and return them as a list of
+        ``(kind, items, data)`` tuples, oldest first. Nothing is returned if the
+        buffer stays locked by another process.
+        """
+        if not self._acquire():
+            log.debug('shared buffer is locked, reading it later')
+            return []
+        try:
+            write_pos, read_pos, _, dropped, dropped_items = _HEADER.unpack_from(self._mmap, 0)
+            if write_pos == read_pos:
+                return []
+            buf = self._copy_out(read_pos, write_pos - read_pos)
+            _HEADER.pack_into(self._mmap, 0, write_pos, write_pos, 0, dropped, dropped_items)
+        finally:
+            self._release()
+
+        records = []
+        offset = 0
+        while offset < len(buf):
+            length, kind, items = _RECORD.unpack_from(buf, offset)
+            offset += _RECORD.size
+            records.append((kind, items, buf[offset:offset + length]))
+            offset += length
+        return records
+
+    def stats(self):
+        """
+        Return the number of records and bytes in the buffer, and the number of
+        records and items dropped since it was created. If the buffer stays locked
+        by another process, they're read without the lock and may be inconsistent.
+        """
+        locked = self._acquire()
+        try:
+            write_pos, read_pos, records, dropped, dropped_items = _HEADER.unpack_from(self._mmap, 0)
+        finally:
+            if locked:
+                self._release()
+        return {
+            'records': records,
+            'bytes': write_pos - read_pos,
+            'dropped_records': dropped,
+            'dropped_items': dropped_items,
+        }
+
+    def _acquire(self):
+        """
+        Take the lock, waiting for at most ``LOCK_TIMEOUT`` seconds; return ``False``
+        if it's still held by another process, unless that process is gone. When
+        ``True`` is returned, the lock must be released with ``_release()``.
+        """
+        if self._lock.acquire(True, LOCK_TIMEOUT):
+            _OWNER.pack_into(self._mmap, _OWNER_OFFSET, os.getpid())
+            return True
+        return self._take_over()
+
+    def _take_over(self):
+        """
+        Take over the lock if the process holding it is gone: this process inherits
+        its acquisition, and releases it in its place. The owner is checked and
+        replaced by a single process at a time, so that only one inherits it.
+        """
+        if not self._takeover_lock.acquire(True, LOCK_TIMEOUT):
+            return False
+        try:
+            owner, = _OWNER.unpack_from(self._mmap, _OWNER_OFFSET)
+            if not owner or forksafe.is_alive(owner):
+                return False
+            # the records are committed by updating the header, so a process killed
+            # while holding the lock leaves the buffer consistent
+            log.warning('taking over the shared buffer lock held by the process %d that is gone', owner)
+            _OWNER.pack_into(self._mmap, _OWNER_OFFSET, os.getpid())
+            return True
+        finally:
+            self._takeover_lock.release()
+
+    def _release(self):
+        _OWNER.pack_into(self._mmap, _OWNER_OFFSET, 0)
+        self._lock.release()
+
+    def _copy_in(self, pos, data):
+        """
+        Non-safe if not used with a lock.
+        """
+        offset = pos % self._capacity
+        first = min(len(data), self._capacity - offset)
+        start = _DATA_OFFSET + offset
+        self._mmap[start:start + first] = data[:first]
+        if first < len(data):
+            # wrap around the end of the buffer
+            self._mmap[_DATA_OFFSET:_DATA_OFFSET + len(data) - first] = data[first:]
+
+    def _copy_out(self, pos, length):
+        """
+        Non-safe if not used with a lock.
+        """
+        offset = pos % self._capacity
+        first = min(length, self._capacity - offset)
+        start = _DATA_OFFSET + offset
+        data = self._mmap[start:start + first]
+        if first < length:
+            data += self._mmap[_DATA_OFFSET:_DATA_OFFSET + length - first]
+        return data
@@ -4,9 +4,8 @@ Any `sampled = False` trace won't be written, and can be ignored by the instrume
 """
 import logging
 
-from threading import Lock
-
 from .compat import iteritems
+from .utils import forksafe
 
 log = logging.getLogger(__name__)
 
@@ -66,7 +65,7 @@ class RateByServiceSampler(object):
     """
 
     def __init__(self, sample_rate=1):
-        self._lock = Lock()
+        self._lock = forksafe.Lock()
         self._by_service_samplers = {}
         self._by_service_samplers[_default_key] = RateSampler(sample_rate)
 
@@ -1,12 +1,18 @@
 import logging
 import math
-import random
 import sys
 import time
 import traceback
 
-from .compat import StringIO, stringify, iteritems, numeric_types
+from .compat import StringIO, stringify, iteritems, numeric_types, monotonic_ns, time_ns
 from .ext import errors
+from .utils.ids import new_id
+
+try:
+    from traceback import TracebackException
+except ImportError:
+    # Python < 3.5: tracebacks are formatted right away
+    TracebackException = None
 
 
 log = logging.getLogger(__name__)
@@ -22,12 +28,10 @@ class Span(object):
         'span_id',
         'trace_id',
         'parent_id',
-        'meta',
         'error',
-        'metrics',
         'span_type',
-        'start',
-        'duration',
+        'start_ns',
+        'duration_ns',
         # Sampler attributes
         'sampled',
         # Internal attributes
@@ -35,6 +39,12 @@ class Span(object):
         '_context',
         '_finished',
         '_parent',
+        '_start_monotonic_ns',
+        # tags and metrics, allocated when the first one is set
+        '_meta',
+        '_metrics',
+        # traceback captured by ``set_exc_info()``, rendered when the span is encoded
+        '_exc_stack',
         '__weakref__',
     ]
 
@@ -77,17 +87,24 @@ class Span(object):
         self.span_type = span_type
 
         # tags / metatdata
-        self.meta = {}
+        self._meta = None
         self.error = 0
-        self.metrics = {}
-
-        # timing
-        self.start = start or time.time()
-        self.duration = None
+        self._metrics = None
+        self._exc_stack = None
+
+        # timing: an integer wall-clock start and a monotonic duration, in nanoseconds
+        if start:
+            self.start_ns = int(start * 1e9)
+            # the duration is measured with the wall clock from a start in the past
+            self._start_monotonic_ns = None
+        else:
+            self.start_ns = time_ns()
+            self._start_monotonic_ns = monotonic_ns()
+        self.duration_ns = None
 
         # tracing
-        self.trace_id = trace_id or _new_id()
-        self.span_id = span_id or _new_id()
+        self.trace_id = trace_id or new_id()
+        self.span_id = span_id or new_id()
         self.parent_id = parent_id
 
         # sampling
@@ -111,10 +128,14 @@ class Span(object):
             return
         self._finished = True
 
-        if self.duration is None:
-            ft = finish_time or time.time()
-            # be defensive so we don't die if start isn't set
-            self.duration = ft - (self.start or ft)
+        if self.duration_ns is None:
+            if finish_time is None and self._start_monotonic_ns is not None:
+                # immune to the jumps of the wall clock
+                self.duration_ns = monotonic_ns() - self._start_monotonic_ns
+            else:
+                ft = int((finish_time or time.time()) * 1e9)
+                # be defensive so we don't die if start isn't set
+                self.duration_ns = ft - (self.start_ns or ft)
 
         # if a tracer is available to process the current context
         if self._tracer and self._context:
@@ -124,24 +145,83 @@ class Span(object):
             except Exception:
                 log.exception("error recording finished trace")
 
+    @property
+    def start(self):
+        """
+        The start time of the span as a unix epoch in seconds.
+        """
+        return self.start_ns / 1e9 if self.start_ns is not None else None
+
+    @start.setter
+    def start(self, value):
+        self.start_ns = int(value * 1e9) if value is not None else None
+        self._start_monotonic_ns = None
+
+    @property
+    def duration(self):
+        """
+        The duration of the span in seconds, or ``None`` if it's not finished.
+        """
+        return self.duration_ns / 1e9 if self.duration_ns is not None else None
+
+    @duration.setter
+    def duration(self, value):
+        self.duration_ns = int(value * 1e9) if value is not None else None
+
+    @property
+    def meta(self):
+        """
+        The tags of the span; the dictionary is allocated when it's first needed,
+        since many spans have no tags.
+        """
+        if self._exc_stack is not None:
+            self._format_exc_stack()
+        if self._meta is None:
+            self._meta = {}
+        return self._meta
+
+    @meta.setter
+    def meta(self, value):
+        self._meta = value
+
+    @property
+    def metrics(self):
+        """
+        The metrics of the span; the dictionary is allocated when it's first needed.
+        """
+        if self._metrics is None:
+            self._metrics = {}
+        return self._metrics
+
+    @metrics.setter
+    def metrics(self, value):
+        self._metrics = value
+
     def set_tag(self, key, value):
         """ Set the given key / value tag pair on the span. Keys and values
             must be strings (or stringable). If a casting error occurs, it will
             be ignored.
         """
         try:
-            self.meta[key] = stringify(value)
+            value = stringify(value)
         except Exception:
             log.debug("error setting tag %s, ignoring it", key, exc_info=True)
+            return
+        if self._meta is None:
+            self._meta = {key: value}
+        else:
+            self._meta[key] = value
 
     def _remove_tag(self, key):
-        if key in self.meta:
-            del self.meta[key]
+        if self._meta and key in self._meta:
+            del self._meta[key]
 
     def get_tag(self, key):
         """ Return the given tag or None if it doesn't exist.
         """
-        return self.meta.get(key, None)
+        if self._exc_stack is not None and key == errors.ERROR_STACK:
+            self._format_exc_stack()
+        return self._meta.get(key, None) if self._meta else None
 
     def set_tags(self, tags):
         """ Set a dictionary of tags on the given span. Keys and values
@@ -177,7 +257,10 @@ class Span(object):
             log.debug("ignoring not real metric %s:%s", key, value)
             return
 
-        self.metrics[key] = value
+        if self._metrics is None:
+            self._metrics = {key: value}
+        else:
+            self._metrics[key] = value
 
     def set_metrics(self, metrics):
         if metrics:
@@ -185,9 +268,11 @@ class Span(object):
                 self.set_metric(k, v)
 
     def get_metric(self, key):
-        return self.metrics.get(key)
+        return self._metrics.get(key) if self._metrics else None
 
     def to_dict(self):
+        if self._exc_stack is not None:
+            self._format_exc_stack()
         d = {
             'trace_id' : self.trace_id,
             'parent_id' : self.parent_id,
@@ -205,17 +290,17 @@ class Span(object):
         if err and type(err) == bool:
             d['error'] = 1
 
-        if self.start:
-            d['start'] = int(self.start * 1e9)  # ns
+        if self.start_ns:
+            d['start'] = self.start_ns
 
-        if self.duration:
-            d['duration'] = int(self.duration * 1e9)  # ns
+        if self.duration_ns:
+            d['duration'] = self.duration_ns
 
-        if self.meta:
-            d['meta'] = self.meta
+        if self._meta:
+            d['meta'] = self._meta
 
-        if self.metrics:
-            d['metrics'] = self.metrics
+        if self._metrics:
+            d['metrics'] = self._metrics
 
         if self.span_type:
             d['type'] = self.span_type
@@ -241,21 +326,43 @@ class Span(object):
 
         self.error = 1
 
-        # get the traceback
-        buff = StringIO()
-        traceback.print_exception(exc_type, exc_val, exc_tb, file=buff, limit=20)
-        tb = buff.getvalue()
-
         # readable version of type (e.g. exceptions.ZeroDivisionError)
         exc_type_str = "%s.%s" % (exc_type.__module__, exc_type.__name__)
 
         self.set_tag(errors.ERROR_MSG, exc_val)
         self.set_tag(errors.ERROR_TYPE, exc_type_str)
-        self.set_tag(errors.ERROR_STACK, tb)
+
+        if TracebackException is not None:
+            # only the frames are captured here: reading the source lines and
+            # formatting the traceback is left to the writer, when the span is encoded
+            self._exc_stack = TracebackException(exc_type, exc_val, exc_tb, limit=20, lookup_lines=False)
+            self._remove_tag(errors.ERROR_STACK)
+            return
+
+        # get the traceback
+        buff = StringIO()
+        traceback.print_exception(exc_type, exc_val, exc_tb, file=buff, limit=20)
+        self.set_tag(errors.ERROR_STACK, buff.getvalue())
+
+    def _format_exc_stack(self):
+        """
+        Render the traceback captured by ``set_exc_info()`` in the ``error.stack`` tag,
+        unless the tag has been set since.
+        """
+        exc_stack, self._exc_stack = self._exc_stack, None
+        try:
+            tb = ''.join(exc_stack.format())
+        except Exception:
+            log.debug("error formatting the traceback, ignoring it", exc_info=True)
+            return
+        if self._meta is None:
+            self._meta = {}
+        self._meta.setdefault(errors.ERROR_STACK, tb)
 
     def _remove_exc_info(self):
         """ Remove all exception related information from the span. """
         self.error = 0
+        self._exc_stack = None
         self._remove_tag(errors.ERROR_MSG)
         self._remove_tag(errors.ERROR_TYPE)
         self._remove_tag(errors.ERROR_STACK)
@@ -312,6 +419,50 @@ class Span(object):
         )
 
 
-def _new_id():
-    """Generate a random trace_id or span_id"""
-    return random.getrandbits(64)
+class SuppressedSpan(Span):
+    """
+    Span started past the maximum number of spans of a trace: it's not sent, its
+    tags are ignored, and the root span of the trace records the number and the
+    total duration of the suppressed spans, by name.
+    """
+    __slots__ = [
+        # the summary of the suppressed spans of the trace the span belongs to
+        '_summary',
+    ]
+
+    def finish(self, finish_time=None):
+        """ Mark the end time of the span and add it to the summary of the
+            suppressed spans of its trace.
+        """
+        if self._finished:
+            return
+        # the duration is measured as for any span, without submitting the span
+        context, self._context = self._context, None
+        super(SuppressedSpan, self).finish(finish_time=finish_time)
+        self._context = context
+        if context is not None:
+            try:
+                context.close_suppressed_span(self)
+            except Exception:
+                log.exception("error recording suppressed span")
+
+    def set_tag(self, key, value):
+        pass
+
+    def set_tags(self, tags):
+        pass
+
+    def set_meta(self, k, v):
+        pass
+
+    def set_metas(self, kvs):
+        pass
+
+    def set_metric(self, key, value):
+        pass
+
+    def set_metrics(self, metrics):
+        pass
+
+    def set_exc_info(self, exc_type, exc_val, exc_tb):
+        pass
@@ -0,0 +1,401 @@
+"""
+Disk spool of the payloads that couldn't be sent to the trace agent, so that
+they can be sent again once it's back instead of being dropped.
+
+Payloads are appended to segment files of a bounded size, and each record is
+protected by a CRC so that a segment truncated by a crash is detected. The header
+of a segment records the format of its payloads, e.g. the API version and the
+Content-Type they were encoded for, since the process that replays it may use
+another one. Segments
+go through these states, encoded in their file name::
+
+    <timestamp>-<pid>.open          being written by the process <pid>
+    <timestamp>-<pid>.seg           closed, waiting to be replayed
+    <timestamp>-<pid>.replay-<pid>  being replayed by a process
+
+so that many processes can share the same spool directory: renaming a closed
+segment is how a process claims it for replay.
+"""
+import errno
+import logging
+import mmap
+import os
+import struct
+import time
+import zlib
+
+from .api import Payload
+from .compat import PY2
+from .utils import forksafe
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_SEGMENT_SIZE = 4 << 20
+DEFAULT_QUOTA = 64 << 20
+# bytes per second replayed once the trace agent is back, so that it isn't flooded
+DEFAULT_REPLAY_RATE = 1 << 20
+
+_MAGIC = b'DDSPOOL2'
+# size of the payload format that follows the magic bytes
+_HEADER = struct.Struct('<H')
+# size of the payload, number of traces and CRC32 of the payload
+_RECORD = struct.Struct('<III')
+
+_OPEN = '.open'
+_CLOSED = '.seg'
+_REPLAY = '.replay-'
+
+
+class Spool(object):
+    """
+    Thread-safe spool of ``Payload`` stored in ``directory``.
+
+    :param str directory: where the segment files are stored; it's created if needed
+    :param int segment_size: the size after which a segment is closed and a new one is started
+    :param int quota: the maximum size of all the segments; the oldest ones are discarded to
+        make room for new payloads
+    :param int replay_rate: the maximum number of bytes per second sent by ``replay()``
+    """
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, quota=DEFAULT_QUOTA,
+                 replay_rate=DEFAULT_REPLAY_RATE):
+        self.directory = directory
+        self._segment_size = segment_size
+        self._quota = quota
+        self._bucket = _TokenBucket(replay_rate)
+        self._lock = forksafe.Lock()
+        self._pid = os.getpid()
+        # the segment being written, its size and the format of its payloads
+        self._file = None
+        self._file_size = 0
+        self._file_format = None
+        # the segment being replayed, and the offset of the next record to send
+        self._replay_path = None
+        self._replay_offset = 0
+        # payloads and bytes discarded because of the quota or of a corruption
+        self.discarded_payloads = 0
+        self.discarded_bytes = 0
+
+        try:
+            os.makedirs(directory)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+        self._recover()
+
+    def write(self, payload, payload_format):
+        """
+        Append the given payload, encoded in ``payload_format``, to the current segment;
+        return ``False`` if it doesn't fit in the quota. A payload in another format
+        than the current segment starts a new one.
+        """
+        data = payload.data
+        if not isinstance(data, bytes) and hasattr(data, 'encode'):
+            data = data.encode('utf-8')
+        record = _RECORD.pack(len(data), payload.count, zlib.crc32(data) & 0xffffffff) + data
+
+        with self._lock:
+            self._check_pid()
+            if payload_format != self._file_format:
+                self._close_segment()
+            header = _header(payload_format)
+            if len(header) + len(record) > self._quota or not self._make_room(len(record), len(header)):
+                self._discard(1, len(data))
+                return False
+
+            if self._file is not None and self._file_size + len(record) > self._segment_size:
+                self._close_segment()
+            if self._file is None:
+                self._open_segment(header, payload_format)
+            self._file.write(record)
+            self._file.flush()
+            self._file_size += len(record)
+            return True
+
+    def replay(self, send):
+        """
+        Send the spooled payloads, oldest first, with the ``send`` callable that is
+        given a ``Payload`` and its format, and returns ``True`` if it doesn't need
+        to be sent again. Stop as soon as a payload
+        fails, or when the replay rate is reached. Return the number of payloads sent.
+        """
+        sent = 0
+        with self._lock:
+            self._check_pid()
+            # the current segment can be replayed as well
+            self._close_segment()
+            while True:
+                if self._replay_path is None and not self._claim_segment():
+                    return sent
+                sent += self._replay_segment(send)
+                if self._replay_path is not None:
+                    # the segment hasn't been entirely sent
+                    return sent
+
+    def close(self):
+        """
+        Close the current segment, so that it can be replayed.
+        """
+        with self._lock:
+            self._close_segment()
+
+    def size(self):
+        """
+        Return the size of all the segments in the spool directory.
+        """
+        with self._lock:
+            return sum(size for _, size in self._segments())
+
+    def _replay_segment(self, send):
+        """
+        Non-safe if not used with a lock.
+        """
+        path = self._replay_path
+        sent = 0
+        with open(path, 'rb') as f:
+            length = os.fstat(f.fileno()).st_size
+            if length <= len(_MAGIC):
+                self._end_replay()
+                return sent
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # payloads are slices of the memory map, so they're sent without a copy
+        view = mm if PY2 else memoryview(mm)
+        try:
+            payload_format, header_size = _parse_header(mm, length)
+            if payload_format is None:
+                log.warning('discarding spooled segment %s: invalid header', path)
+                self._discard(1, length)
+                self._end_replay()
+                return sent
+
+            offset = max(self._replay_offset, header_size)
+            while offset < length:
+                if offset + _RECORD.size > length:
+                    self._discard_corrupted(path, length - offset)
+                    return sent
+                size, count, crc = _RECORD.unpack_from(mm, offset)
+                start = offset + _RECORD.size
+                data = view[start:start + size]
+                try:
+                    if start + size > length or zlib.crc32(data) & 0xffffffff != crc:
+                        self._discard_corrupted(path, length - offset)
+                        return sent
+                    if not self._bucket.consume(size):
+                        return sent
+                    if not send(Payload(data, None, count), payload_format):
+                        return sent
+                finally:
+                    if not PY2:
+                        data.release()
+                sent += 1
+                offset = start + size
+                self._replay_offset = offset
+
+            self._end_replay()
+            return sent
+        finally:
+            if not PY2:
+                view.release()
+            try:
+                mm.close()
+            except BufferError:
+                # a payload is still referenced; the map is closed once it's collected
+                pass
+
+    def _discard_corrupted(self, path, size):
+        """
+        Non-safe if not used with a lock.
+        """
+        log.warning('discarding spooled segment %s: corrupted record', path)
+        self._discard(1, size)
+        self._end_replay()
+
+    def _discard(self, payloads, size):
+        """
+        Non-safe if not used with a lock.
+        """
+        self.discarded_payloads += payloads
+        self.discarded_bytes += size
+
+    def _end_replay(self):
+        """
+        Non-safe if not used with a lock.
+        """
+        _remove(self._replay_path)
+        self._replay_path = None
+        self._replay_offset = 0
+
+    def _claim_segment(self):
+        """
+        Rename the oldest closed segment so that no other process replays it.
+
+        Non-safe if not used with a lock.
+        """
+        for name, _ in self._segments():
+            if not name.endswith(_CLOSED):
+                continue
+            path = os.path.join(self.directory, name)
+            claimed = path[:-len(_CLOSED)] + _REPLAY + str(self._pid)
+            try:
+                os.rename(path, claimed)
+            except OSError:
+                # claimed by another process in the meantime
+                continue
+            self._replay_path = claimed
+            self._replay_offset = 0
+            return True
+        return False
+
+    def _make_room(self, size, header_size):
+        """
+        Discard the oldest closed segments until there is room for ``size`` more
+        bytes; return ``False`` if that isn't enough.
+
+        Non-safe if not used with a lock.
+        """
+        segments = self._segments()
+        total = sum(segment_size for _, segment_size in segments)
+        if self._file is None:
+            # a new segment is started with a header
+            size += header_size
+        for name, segment_size in segments:
+            if total + size <= self._quota:
+                return True
+            if not name.endswith(_CLOSED):
+                continue
+            log.debug('spool quota exceeded, discarding segment %s', name)
+            _remove(os.path.join(self.directory, name))
+            self._discard(0, segment_size)
+            total -= segment_size
+        return total + size <= self._quota
+
+    def _segments(self):
+        """
+        Return the ``(name, size)`` of all the segments, oldest first.
+
+        Non-safe if not used with a lock.
+        """
+        segments = []
+        for name in sorted(os.listdir(self.directory)):
+            if not (name.endswith(_OPEN) or name.endswith(_CLOSED) or _REPLAY in name):
+                continue
+            try:
+                size = os.path.getsize(os.path.join(self.directory, name))
+            except OSError:
+                # removed by another process in the meantime
+                continue
+            segments.append((name, size))
+        return segments
+
+    def _recover(self):
+        """
+        Close the segments left open or being replayed by processes that are gone.
+        """
+        for name in os.listdir(self.directory):
+            try:
+                if name.endswith(_OPEN):
+                    base = name[:-len(_OPEN)]
+                    owner = base.split('-')[1]
+                elif _REPLAY in name:
+                    base, owner = name.split(_REPLAY)
+                else:
+                    continue
+                if forksafe.is_alive(int(owner)):
+                    continue
+                os.rename(os.path.join(self.directory, name), os.path.join(self.directory, base + _CLOSED))
+            except (IndexError, ValueError, OSError):
+                continue
+
+    def _open_segment(self, header, payload_format):
+        """
+        Non-safe if not used with a lock.
+        """
+        name = '{:020d}-{}{}'.format(int(time.time() * 1e6), self._pid, _OPEN)
+        self._file = open(os.path.join(self.directory, name), 'ab')
+        self._file.write(header)
+        self._file_size = len(header)
+        self._file_format = payload_format
+
+    def _close_segment(self):
+        """
+        Non-safe if not used with a lock.
+        """
+        if self._file is None:
+            return
+        path = self._file.name
+        self._file.close()
+        self._file = None
+        self._file_size = 0
+        self._file_format = None
+        os.rename(path, path[:-len(_OPEN)] + _CLOSED)
+
+    def _check_pid(self):
+        """
+        Forget the segments of the parent process when the process has been forked;
+        the parent keeps writing and replaying them.
+
+        Non-safe if not used with a lock.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            if self._file is not None:
+                self._file.close()
+            self._file = None
+            self._file_size = 0
+            self._file_format = None
+            self._replay_path = None
+            self._replay_offset = 0
+            self._pid = pid
+
+
+class _TokenBucket(object):
+    """
+    Allow ``rate`` units per second, with bursts of up to ``rate`` units. A request
+    larger than the burst is allowed once the bucket is full, and it's paid for later.
+    """
+    def __init__(self, rate):
+        self._rate = rate
+        self._tokens = rate
+        self._last = time.time()
+
+    def consume(self, amount):
+        now = time.time()
+        self._tokens = min(self._rate, self._tokens + (now - self._last) * self._rate)
+        self._last = now
+        if self._tokens < min(amount, self._rate):
+            return False
+        self._tokens -= amount
+        return True
+
+
+def _header(payload_format):
+    """
+    Return the header of a segment of payloads in the given format.
+    """
+    payload_format = payload_format.encode('utf-8')
+    return _MAGIC + _HEADER.pack(len(payload_format)) + payload_format
+
+
+def _parse_header(mm, length):
+    """
+    Return the payload format of a segment and the size of its header, or
+    ``(None, 0)`` if the header is invalid, e.g. written by an older version.
+    """
+    start = len(_MAGIC) + _HEADER.size
+    if length < start or mm[:len(_MAGIC)] != _MAGIC:
+        return None, 0
+    size, = _HEADER.unpack_from(mm, len(_MAGIC))
+    if start + size > length:
+        return None, 0
+    try:
+        return mm[start:start + size].decode('utf-8'), start + size
+    except UnicodeDecodeError:
+        return None, 0
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,248 @@
+"""
+Self-telemetry of the writer: what the tracer enqueues, drops, encodes and sends,
+and how long it takes. It is exposed by ``AgentWriter.stats()`` and can be sent
+as metrics with a ``MetricsEmitter``, so that an overloaded tracer is noticed
+before it hurts the application.
+"""
+import logging
+import os
+import socket
+
+from .utils import forksafe
+
+
+log = logging.getLogger(__name__)
+
+# reasons why traces are dropped
+DROP_QUEUE_FULL = 'queue_full'
+DROP_FILTERED = 'filtered'
+DROP_ENCODING_ERROR = 'encoding_error'
+DROP_INCOMPATIBLE_ENCODING = 'incompatible_encoding'
+DROP_AGENT_UNAVAILABLE = 'agent_unavailable'
+DROP_SEND_FAILED = 'send_failed'
+DROP_SPOOL_FULL = 'spool_full'
+
+# metrics are emitted at most once per interval, in seconds
+DEFAULT_EMIT_INTERVAL = 10
+
+# upper bounds of the histogram buckets, in seconds: from 10us to ~80s
+_BUCKETS = [1e-5 * 2 ** i for i in range(24)]
+
+
+class Histogram(object):
+    """
+    Histogram with exponential buckets; percentiles are estimated with the upper
+    bound of their bucket, capped by the maximum value.
+
+    Non-safe if not used with a lock.
+    """
+    def __init__(self):
+        self._counts = [0] * (len(_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(_BUCKETS) and value > _BUCKETS[index]:
+            index += 1
+        self._counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def percentile(self, percentile):
+        if not self.count:
+            return 0.0
+        rank = percentile * self.count
+        seen = 0
+        for index, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return min(_BUCKETS[index], self.max) if index < len(_BUCKETS) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'avg': self.sum / self.count if self.count else 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+        }
+
+
+class WriterTelemetry(object):
+    """
+    Thread-safe counters and histograms updated by the writer and its worker. The
+    state of a forked process starts from scratch.
+    """
+    # cumulative counters
+    COUNTERS = ('enqueued_traces', 'enqueued_spans', 'encoded_bytes', 'sent_traces', 'spooled_traces',
+                'send_errors')
+    # histograms of durations, in seconds
+    HISTOGRAMS = ('encode_time', 'send_time')
+
+    def __init__(self):
+        self._lock = forksafe.Lock()
+        self._reset()
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._check_pid()
+            self._counters[name] += value
+
+    def enqueued(self, spans):
+        with self._lock:
+            self._check_pid()
+            self._counters['enqueued_traces'] += 1
+            self._counters['enqueued_spans'] += spans
+
+    def dropped(self, reason, traces):
+        if not traces:
+            return
+        with self._lock:
+            self._check_pid()
+            self._dropped[reason] = self._dropped.get(reason, 0) + traces
+
+    def response(self, status):
+        with self._lock:
+            self._check_pid()
+            self._statuses[status] = self._statuses.get(status, 0) + 1
+
+    def observe(self, name, value):
+        with self._lock:
+            self._check_pid()
+            self._histograms[name].observe(value)
+            self._interval_histograms[name].observe(value)
+
+    def snapshot(self):
+        """
+        Return the counters, traces dropped by reason, responses by HTTP status and
+        histograms accumulated since the writer was created.
+        """
+        with self._lock:
+            self._check_pid()
+            stats = dict(self._counters)
+            stats['dropped'] = dict(self._dropped)
+            stats['http_status'] = dict(self._statuses)
+            for name, histogram in self._histograms.items():
+                stats[name] = histogram.snapshot()
+            return stats
+
+    def emit(self, emitter, queue_stats, tags=None):
+        """
+        Send the metrics accumulated since the previous call with the given emitter:
+        counters as counts, the queue state as gauges and the durations observed in
+        the interval as gauges of their average, maximum and 99th percentile.
+
+        :param dict queue_stats: the ``stats()`` of the trace queue, with its ``high_water``
+        """
+        with self._lock:
+            self._check_pid()
+            counters = dict(self._counters)
+            dropped = dict(self._dropped)
+            if queue_stats.get('dropped_traces'):
+                dropped[DROP_QUEUE_FULL] = queue_stats['dropped_traces']
+            statuses = dict(self._statuses)
+            histograms, self._interval_histograms = self._interval_histograms, self._new_histograms()
+            previous, self._emitted = self._emitted, {
+                'counters': counters, 'dropped': dropped, 'statuses': statuses,
+            }
+
+        tags = list(tags or [])
+        for name, value in counters.items():
+            _emit_count(emitter, name.replace('_', '.', 1), value - previous['counters'].get(name, 0), tags)
+        for reason, value in dropped.items():
+            _emit_count(emitter, 'dropped.traces', value - previous['dropped'].get(reason, 0),
+                        tags + ['reason:{}'.format(reason)])
+        for status, value in statuses.items():
+            _emit_count(emitter, 'http.responses', value - previous['statuses'].get(status, 0),
+                        tags + ['status:{}'.format(status)])
+        emitter.gauge('queue.traces', queue_stats.get('queued_traces', 0), tags)
+        emitter.gauge('queue.bytes', queue_stats.get('queued_bytes', 0), tags)
+        emitter.gauge('queue.high_water', queue_stats.get('high_water', 0), tags)
+        for name, histogram in histograms.items():
+            if histogram.count:
+                name = name.replace('_', '.')
+                emitter.gauge('{}.avg'.format(name), histogram.sum / histogram.count, tags)
+                emitter.gauge('{}.max'.format(name), histogram.max, tags)
+                emitter.gauge('{}.p99'.format(name), histogram.percentile(0.99), tags)
+
+    def _new_histograms(self):
+        return dict((name, Histogram()) for name in self.HISTOGRAMS)
+
+    def _reset(self):
+        """
+        Non-safe if not used with a lock.
+        """
+        self._pid = os.getpid()
+        self._counters = dict((name, 0) for name in self.COUNTERS)
+        self._dropped = {}
+        self._statuses = {}
+        self._histograms = self._new_histograms()
+        self._interval_histograms = self._new_histograms()
+        # the values sent by the previous ``emit()``, to send the difference
+        self._emitted = {'counters': {}, 'dropped': {}, 'statuses': {}}
+
+    def _check_pid(self):
+        """
+        Non-safe if not used with a lock.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+
+def _emit_count(emitter, name, value, tags):
+    if value:
+        emitter.count(name, value, tags)
+
+
+class MetricsEmitter(object):
+    """
+    Interface of the emitters that send the writer metrics to a monitoring system.
+    Emitters are called from the flush thread and must not block for long.
+    """
+    def count(self, name, value, tags=None):
+        raise NotImplementedError
+
+    def gauge(self, name, value, tags=None):
+        raise NotImplementedError
+
+
+class DogStatsdEmitter(MetricsEmitter):
+    """
+    Send the writer metrics over UDP with the DogStatsD protocol, e.g. to the
+    Datadog Agent; metric names are prefixed with ``prefix``.
+    """
+    def __init__(self, hostname='localhost', port=8125, prefix='datadog.tracer.writer', tags=None):
+        self.hostname = hostname
+        self.port = port
+        self.prefix = prefix
+        self.tags = list(tags or [])
+        self._socket = None
+
+    def count(self, name, value, tags=None):
+        self._send(name, value, 'c', tags)
+
+    def gauge(self, name, value, tags=None):
+        self._send(name, value, 'g', tags)
+
+    def close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _send(self, name, value, metric_type, tags):
+        line = '{}.{}:{}|{}'.format(self.prefix, name, value, metric_type)
+        tags = self.tags + list(tags or [])
+        if tags:
+            line += '|#' + ','.join(tags)
+        try:
+            if self._socket is None:
+                self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                self._socket.setblocking(False)
+            self._socket.sendto(line.encode('utf-8'), (self.hostname, self.port))
+        except (socket.error, socket.gaierror) as err:
+            log.debug('cannot send the %s metric: %s', name, err)
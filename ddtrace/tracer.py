@@ -7,7 +7,7 @@ from .provider import DefaultContextProvider
 from .context import Context
 from .sampler import AllSampler, RateSampler, RateByServiceSampler
 from .writer import AgentWriter
-from .span import Span
+from .span import Span, SuppressedSpan
 from .constants import FILTERS_KEY, SAMPLE_RATE_METRIC_KEY
 from . import compat
 from .ext.priority import AUTO_REJECT, AUTO_KEEP
@@ -37,6 +37,14 @@ class Tracer(object):
         """
         self.sampler = None
         self.priority_sampler = None
+        self._native_writer = False
+        # the last writer created by ``configure()``; a writer set by the user is kept
+        # when only the context provider changes
+        self._configured_writer = None
+        # finished spans sent in chunks, once there are this many in a trace; 0 disables it
+        self.partial_flush_min_spans = 0
+        # spans suppressed past this many spans in a trace; 0 disables it
+        self.max_spans_per_trace = 0
 
         # Apply the default configuration
         self.configure(
@@ -81,7 +89,8 @@ class Tracer(object):
 
     def configure(self, enabled=None, hostname=None, port=None, sampler=None,
                   context_provider=None, wrap_executor=None, priority_sampling=None,
-                  settings=None):
+                  settings=None, uds_path=None, api_version=None, compression=None, native_writer=None,
+                  partial_flush_min_spans=None, max_spans_per_trace=None, trace_stats=None):
         """
         Configure an existing Tracer the easy way.
         Allow to configure or reconfigure a Tracer instance.
@@ -99,6 +108,25 @@ class Tracer(object):
             from the default value
         :param priority_sampling: enable priority sampling, this is required for
             complete distributed tracing support.
+        :param str uds_path: Path of the Unix domain socket exposed by the Trace Agent. When set,
+            the agent is reached through this socket instead of ``hostname`` and ``port``; an empty
+            string switches back to TCP
+        :param str api_version: Version of the Trace Agent API used to report traces. ``v0.5``
+            sends each payload with a string table, so that repeated strings are sent once;
+            older agents are detected and the previous API versions are used instead
+        :param str compression: Compress the payloads sent to the Trace Agent with ``gzip``, ``zstd``
+            or ``lz4``; useful when the agent runs on another host. An empty string disables it
+        :param bool native_writer: Send traces with the writer of the ``context_provider``, if it
+            provides one, e.g. from the ``asyncio`` event loop instead of a flush thread
+        :param int partial_flush_min_spans: Send the finished spans of a trace once there are this
+            many of them, instead of waiting for all the spans of the trace to finish; useful to
+            bound the memory used by long-running traces. ``0`` disables it
+        :param int max_spans_per_trace: Suppress the spans started past this many spans in a trace:
+            they are not sent, and the root span records their number and total duration by name.
+            ``0`` disables it
+        :param TraceStatsAggregator trace_stats: Aggregate every finished trace, sampled or not, in
+            request, error and latency metrics exported by the writer; it's kept when the writer is
+            reconfigured
         """
         if enabled is not None:
             self.enabled = enabled
@@ -113,23 +141,51 @@ class Tracer(object):
         if priority_sampling:
             self.priority_sampler = RateByServiceSampler()
 
-        if hostname is not None or port is not None or filters is not None or \
-                priority_sampling is not None:
-            # Preserve hostname and port when overriding filters or priority sampling
+        if context_provider is not None:
+            self._context_provider = context_provider
+
+        if native_writer is not None:
+            self._native_writer = native_writer
+
+        if partial_flush_min_spans is not None:
+            self.partial_flush_min_spans = partial_flush_min_spans
+
+        if max_spans_per_trace is not None:
+            self.max_spans_per_trace = max_spans_per_trace
+
+        writer_class_changed = native_writer is not None or (context_provider is not None and self._native_writer)
+        if hostname is not None or port is not None or uds_path is not None or filters is not None or \
+                priority_sampling is not None or api_version is not None or compression is not None or \
+                trace_stats is not None or \
+                (writer_class_changed and getattr(self, 'writer', None) is self._configured_writer):
+            # Preserve the agent settings and the trace stats when overriding filters or priority sampling
             default_hostname = self.DEFAULT_HOSTNAME
             default_port = self.DEFAULT_PORT
+            default_uds_path = None
+            default_api_version = None
+            default_compression = None
+            default_trace_stats = None
             if hasattr(self, 'writer') and hasattr(self.writer, 'api'):
                 default_hostname = self.writer.api.hostname
                 default_port = self.writer.api.port
-            self.writer = AgentWriter(
+                default_uds_path = getattr(self.writer.api, 'uds_path', None)
+                default_api_version = getattr(self.writer.api, 'requested_version', None)
+                default_compression = getattr(self.writer.api, 'compression', None)
+                default_trace_stats = getattr(self.writer, 'trace_stats', None)
+            writer_class = AgentWriter
+            if self._native_writer:
+                writer_class = getattr(self._context_provider, 'writer_class', None) or AgentWriter
+            self.writer = writer_class(
                 hostname or default_hostname,
                 port or default_port,
+                uds_path=uds_path if uds_path is not None else default_uds_path,
+                api_version=api_version or default_api_version,
+                compression=compression if compression is not None else default_compression,
                 filters=filters,
                 priority_sampler=self.priority_sampler,
+                trace_stats=trace_stats or default_trace_stats,
             )
-
-        if context_provider is not None:
-            self._context_provider = context_provider
+            self._configured_writer = self.writer
 
         if wrap_executor is not None:
             self._wrap_executor = wrap_executor
@@ -180,6 +236,21 @@ class Tracer(object):
             parent_service = context.service
             parent_sampled = context.is_sampled()
 
+        if self.max_spans_per_trace and context._span_count >= self.max_spans_per_trace:
+            # past the maximum number of spans of the trace, spans are only summarized
+            span = SuppressedSpan(
+                self,
+                name,
+                trace_id=trace_id,
+                parent_id=parent_span_id,
+                service=service or parent_service,
+                resource=resource,
+                span_type=span_type,
+            )
+            span.sampled = parent_sampled
+            context.add_suppressed_span(span)
+            return span
+
         if trace_id:
             # child_of a non-empty context, so either a local child span or from a remote context
 
@@ -312,10 +383,19 @@ class Tracer(object):
 
     def record(self, context):
         """
-        Record the given ``Context`` if it's finished.
+        Record the given ``Context`` if it's finished, or its finished spans when
+        they are sent in chunks.
         """
-        # extract and enqueue the trace if it's sampled
-        trace, sampled = context.get()
+        # extract and enqueue the trace if it's sampled; long traces may be sent in chunks
+        if self.partial_flush_min_spans:
+            trace, sampled = context.get_partial(self.partial_flush_min_spans)
+        else:
+            trace, sampled = context.get()
+        if trace and self.enabled:
+            # stats are computed from all the traces, before sampling
+            trace_stats = getattr(self.writer, 'trace_stats', None)
+            if trace_stats is not None:
+                trace_stats.add_trace(trace)
         if trace and sampled:
             self.write(trace)
 
@@ -0,0 +1,211 @@
+"""
+Client-side aggregation of the finished spans in RED metrics (requests, errors
+and duration), so that traces can be sampled aggressively without losing the
+accuracy of the metrics computed from them.
+"""
+import logging
+import os
+import time
+
+from .ext import http
+from .utils import forksafe
+from .utils.sketch import DDSketch
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_INTERVAL = 10
+DEFAULT_MAX_KEYS = 1000
+DEFAULT_RELATIVE_ACCURACY = 0.01
+
+# spans of new keys are counted in this key once the maximum number of keys is reached
+OVERFLOW_KEY = ('_overflow', '_overflow', '_overflow', '')
+
+# quantiles of the durations sent as gauges
+EMITTED_QUANTILES = (('p50', 0.5), ('p95', 0.95), ('p99', 0.99))
+
+# the DogStatsD protocol limits the length of tags
+MAX_TAG_LENGTH = 200
+
+
+class SpanStats(object):
+    """
+    The spans of an interval with the same service, name, resource and HTTP status:
+    their number, the number of errors, and sketches of the durations, in seconds,
+    of the spans without and with errors.
+    """
+    __slots__ = ['service', 'name', 'resource', 'status', 'hits', 'errors', 'duration',
+                 'ok_sketch', 'error_sketch']
+
+    def __init__(self, key, relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.service, self.name, self.resource, self.status = key
+        self.hits = 0
+        self.errors = 0
+        # sum of the durations
+        self.duration = 0.0
+        self.ok_sketch = DDSketch(relative_accuracy)
+        # created with the first error, errors are rare
+        self.error_sketch = None
+
+    @property
+    def key(self):
+        return self.service, self.name, self.resource, self.status
+
+    def add(self, duration, error):
+        self.hits += 1
+        self.duration += duration
+        if error:
+            self.errors += 1
+            if self.error_sketch is None:
+                self.error_sketch = DDSketch(self.ok_sketch.relative_accuracy)
+            self.error_sketch.add(duration)
+        else:
+            self.ok_sketch.add(duration)
+
+    def merge(self, other):
+        """
+        Add the spans counted by another ``SpanStats`` with the same key.
+        """
+        self.hits += other.hits
+        self.errors += other.errors
+        self.duration += other.duration
+        self.ok_sketch.merge(other.ok_sketch)
+        if other.error_sketch is not None:
+            if self.error_sketch is None:
+                self.error_sketch = DDSketch(self.ok_sketch.relative_accuracy)
+            self.error_sketch.merge(other.error_sketch)
+
+
+class StatsBucket(object):
+    """
+    The ``SpanStats`` of the interval that starts at ``start`` and lasts
+    ``duration`` seconds; ``overflow_spans`` is the number of spans counted in
+    the overflow key because the maximum number of keys was reached.
+    """
+    __slots__ = ['start', 'duration', 'stats', 'overflow_spans']
+
+    def __init__(self, start, duration, stats, overflow_spans=0):
+        self.start = start
+        self.duration = duration
+        self.stats = stats
+        self.overflow_spans = overflow_spans
+
+
+class TraceStatsAggregator(object):
+    """
+    Thread-safe aggregator of the finished spans in ``SpanStats`` by service,
+    name, resource and HTTP status. Every trace is counted, whether it's sampled
+    or not, so that the metrics stay accurate when traces are sampled.
+
+    Stats are flushed every ``interval`` seconds by the flush thread of the writer
+    and sent with the ``emitter``, if any: hits and errors as counts, and the
+    quantiles of the durations as gauges. To bound the memory used, at most
+    ``max_keys`` keys are kept by interval; the spans of the other keys are
+    counted in the ``OVERFLOW_KEY``. The state of a forked process starts from
+    scratch.
+
+    :param MetricsEmitter emitter: sends the stats; without it, they can be
+        retrieved with ``flush()``.
+    :param float relative_accuracy: the relative accuracy of the duration quantiles.
+    """
+    def __init__(self, emitter=None, interval=DEFAULT_INTERVAL, max_keys=DEFAULT_MAX_KEYS,
+                 relative_accuracy=DEFAULT_RELATIVE_ACCURACY):
+        self.emitter = emitter
+        self.interval = interval
+        self.max_keys = max_keys
+        self.relative_accuracy = relative_accuracy
+        self._lock = forksafe.Lock()
+        self._reset()
+
+    def add_trace(self, spans):
+        """
+        Count the finished spans of a trace.
+        """
+        with self._lock:
+            self._check_pid()
+            for span in spans:
+                if span.duration is None:
+                    continue
+                status = span.get_tag(http.STATUS_CODE) or ''
+                key = (span.service or '', span.name or '', span.resource or '', status)
+                stats = self._stats.get(key)
+                if stats is None:
+                    if len(self._stats) >= self.max_keys:
+                        key = OVERFLOW_KEY
+                        self._overflow_spans += 1
+                        stats = self._stats.get(key)
+                    if stats is None:
+                        stats = self._stats[key] = SpanStats(key, self.relative_accuracy)
+                stats.add(span.duration, span.error)
+
+    def flush(self, force=False):
+        """
+        Return the ``StatsBucket`` of the current interval and start a new one, or
+        ``None`` if the interval isn't over, unless ``force`` is set.
+        """
+        now = time.time()
+        with self._lock:
+            self._check_pid()
+            if not force and now < self._start + self.interval:
+                return None
+            bucket = StatsBucket(self._start, now - self._start, list(self._stats.values()), self._overflow_spans)
+            self._start = now
+            self._stats = {}
+            self._overflow_spans = 0
+        return bucket
+
+    def export(self, force=False):
+        """
+        Flush the stats of the interval, if it's over, and send them with the emitter.
+        """
+        if self.emitter is None:
+            return
+        bucket = self.flush(force=force)
+        if bucket is None:
+            return
+        for stats in bucket.stats:
+            _emit_stats(self.emitter, stats)
+        if bucket.overflow_spans:
+            self.emitter.count('overflow_spans', bucket.overflow_spans)
+
+    def _reset(self):
+        """
+        Non-safe if not used with a lock.
+        """
+        self._pid = os.getpid()
+        self._start = time.time()
+        self._stats = {}
+        self._overflow_spans = 0
+
+    def _check_pid(self):
+        """
+        Non-safe if not used with a lock.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+
+
+def _emit_stats(emitter, stats):
+    tags = [
+        _tag('service', stats.service),
+        _tag('name', stats.name),
+        _tag('resource', stats.resource),
+    ]
+    if stats.status:
+        tags.append(_tag(http.STATUS_CODE, stats.status))
+    emitter.count('hits', stats.hits, tags)
+    if stats.errors:
+        emitter.count('errors', stats.errors, tags)
+    for sketch, kind in ((stats.ok_sketch, 'ok'), (stats.error_sketch, 'error')):
+        if sketch is None or not sketch.count:
+            continue
+        kind_tags = tags + ['status:{}'.format(kind)]
+        for name, quantile in EMITTED_QUANTILES:
+            emitter.gauge('duration.{}'.format(name), sketch.quantile(quantile), kind_tags)
+        emitter.gauge('duration.max', sketch.max, kind_tags)
+
+
+def _tag(name, value):
+    # commas separate tags and pipes separate the fields of a DogStatsD packet
+    value = '{}'.format(value).replace(',', '_').replace('|', '_')
+    return '{}:{}'.format(name, value)[:MAX_TAG_LENGTH]
@@ -0,0 +1,228 @@
+"""
+HTTP transport used by the ``API`` to report data to the trace agent. Connections
+are kept alive and reused between flushes so that each report doesn't pay for
+a new TCP handshake.
+"""
+import errno
+import logging
+import os
+import socket
+import time
+
+from .compat import httplib, get_connection_response
+from .utils import forksafe
+
+
+log = logging.getLogger(__name__)
+
+# connections idle for longer than this are discarded instead of being reused;
+# this value must stay below the keep-alive timeout of the trace agent, otherwise
+# the first request after a quiet period is sent over a socket closed by the server
+DEFAULT_MAX_IDLE_TIME = 4
+# the AsyncWorker uses a single thread to flush traces and services, so a couple of
+# idle connections are enough; a size of 0 disables the pooling entirely
+DEFAULT_POOL_SIZE = 2
+
+# errors raised when the server closed an idle keep-alive connection
+CONNECTION_ERRORS = (httplib.HTTPException, socket.error)
+
+# errors of a closed connection while the request is sent: the request is incomplete
+# so the server can't have processed it
+SEND_ERRNOS = (errno.EPIPE, errno.ECONNRESET, errno.ECONNABORTED)
+
+
+class RequestNotSentError(Exception):
+    """
+    Raised when a request failed before the server could process it, so that it
+    can be safely sent again; ``error`` is the original error.
+    """
+    def __init__(self, error):
+        super(RequestNotSentError, self).__init__(error)
+        self.error = error
+
+
+def default_connection_factory(hostname, port):
+    """
+    Default factory used by the ``HTTPTransport`` to create a new connection. The
+    ``HTTPConnection`` class is resolved at call time so that it can be patched.
+    """
+    return httplib.HTTPConnection(hostname, port)
+
+
+def uds_connection_factory(path):
+    """
+    Return a connection factory that connects to the trace agent through the
+    Unix domain socket available at the given ``path``.
+    """
+    def factory(hostname, port):
+        return UDSHTTPConnection(path, hostname, port)
+    return factory
+
+
+class UDSHTTPConnection(httplib.HTTPConnection):
+    """
+    ``HTTPConnection`` that sends requests over a Unix domain socket. The
+    ``hostname`` and ``port`` are only used to fill the ``Host`` header.
+    """
+    def __init__(self, path, *args, **kwargs):
+        # DEV: ``HTTPConnection`` is an old-style class in Python 2
+        httplib.HTTPConnection.__init__(self, *args, **kwargs)
+        self.uds_path = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        sock.connect(self.uds_path)
+        self.sock = sock
+
+
+class Response(object):
+    """
+    Response returned by the ``HTTPTransport``. The body is entirely read before
+    the connection is given back to the pool, so that the same connection can be
+    safely reused for the next request.
+    """
+    __slots__ = ['status', 'reason', 'msg', '_body']
+
+    def __init__(self, status, reason, msg, body):
+        self.status = status
+        self.reason = reason
+        self.msg = msg
+        self._body = body
+
+    def read(self):
+        return self._body
+
+
+class HTTPTransport(object):
+    """
+    Thread-safe pool of keep-alive connections to a single trace agent endpoint.
+
+    :param str hostname: the hostname of the trace agent
+    :param int port: the port of the trace agent
+    :param callable connection_factory: a callable with the ``(hostname, port)``
+        signature that returns a new ``httplib.HTTPConnection`` compatible object
+    :param int pool_size: the maximum number of idle connections kept open; if set
+        to ``0``, a new connection is created and closed for each request
+    :param float max_idle_time: the number of seconds a connection can stay idle
+        before it's discarded
+    """
+    def __init__(self, hostname, port, connection_factory=None, pool_size=DEFAULT_POOL_SIZE,
+                 max_idle_time=DEFAULT_MAX_IDLE_TIME):
+        self.hostname = hostname
+        self.port = port
+        self._connection_factory = connection_factory or default_connection_factory
+        self._pool_size = pool_size
+        self._max_idle_time = max_idle_time
+        self._lock = forksafe.Lock()
+        # list of ``(last_used, connection)`` tuples; the most recent is the last one
+        self._idle = []
+        self._pid = os.getpid()
+
+    def request(self, method, endpoint, body, headers):
+        """
+        Send a request using an idle connection if available. If a reused connection
+        has been closed by the server in the meantime, the request is sent again
+        using a brand new connection, but only if the server can't have processed
+        it: otherwise the same payload could be received twice.
+        """
+        conn = self._acquire()
+        if conn is not None:
+            try:
+                return self._request(conn, method, endpoint, body, headers)
+            except RequestNotSentError as err:
+                log.debug('keep-alive connection to %s:%s lost (%s); reconnecting',
+                          self.hostname, self.port, err.error)
+
+        conn = self._connection_factory(self.hostname, self.port)
+        try:
+            return self._request(conn, method, endpoint, body, headers)
+        except RequestNotSentError as err:
+            raise err.error
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+
+        for _, conn in idle:
+            conn.close()
+
+    def _request(self, conn, method, endpoint, body, headers):
+        """
+        Send the request with the given connection, and raise a ``RequestNotSentError``
+        for the errors proving that the server didn't process the request: the
+        connection was closed while the request was sent, or before any byte of
+        the response was received.
+        """
+        try:
+            try:
+                conn.request(method, endpoint, body, headers)
+            except socket.error as err:
+                if getattr(err, 'errno', None) in SEND_ERRNOS:
+                    raise RequestNotSentError(err)
+                raise
+            try:
+                response = get_connection_response(conn)
+            except httplib.BadStatusLine as err:
+                # an empty status line, also reported by ``RemoteDisconnected`` on Python 3
+                if getattr(err, 'line', None) in ('', "''"):
+                    raise RequestNotSentError(err)
+                raise
+            result = Response(response.status, response.reason, response.msg, response.read())
+        except Exception:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return result
+
+    def _acquire(self):
+        """
+        Return the most recently used connection that isn't expired, or ``None``
+        if a new connection must be created.
+        """
+        expired = []
+        conn = None
+        with self._lock:
+            self._check_pid()
+            deadline = time.time() - self._max_idle_time
+            while self._idle:
+                last_used, candidate = self._idle.pop()
+                if last_used < deadline:
+                    expired.append(candidate)
+                else:
+                    conn = candidate
+                    break
+
+        for candidate in expired:
+            candidate.close()
+        return conn
+
+    def _release(self, conn):
+        with self._lock:
+            self._check_pid()
+            if len(self._idle) < self._pool_size:
+                self._idle.append((time.time(), conn))
+                return
+
+        conn.close()
+
+    def _check_pid(self):
+        """
+        Forget the inherited connections when the process has been forked, so that
+        parent and child never share the same socket.
+
+        Non-safe if not used with a lock.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            self._idle = []
+            self._pid = pid
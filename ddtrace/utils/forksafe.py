@@ -0,0 +1,65 @@
+"""
+Helpers for the state shared with the processes forked from this one, e.g. by a
+pre-fork server (gunicorn, uwsgi, celery).
+"""
+import errno
+import os
+import threading
+
+
+class Lock(object):
+    """
+    Lock that is replaced by a new one in the processes forked from this one. A
+    thread that held it when the process was forked, e.g. the flush thread of the
+    writer, doesn't exist in the child, so the lock would never be released there.
+
+    The pid is checked when the lock is acquired, so that it works whether or not
+    ``os.register_at_fork`` is available.
+    """
+    __slots__ = ['_lock', '_pid']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def acquire(self, blocking=True):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._lock = threading.Lock()
+            self._pid = pid
+        return self._lock.acquire(blocking)
+
+    def release(self):
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._lock.release()
+
+
+def is_alive(pid):
+    """
+    Return ``True`` if the process ``pid`` exists and isn't a zombie, i.e. it's
+    gone but it hasn't been waited for by its parent yet.
+    """
+    if pid == os.getpid():
+        return True
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return not _is_zombie(pid)
+
+
+def _is_zombie(pid):
+    try:
+        with open('/proc/{}/stat'.format(pid)) as f:
+            # the state follows the name of the command, that is in parentheses
+            state = f.read().rsplit(')', 1)[1].split()[0]
+    except (IOError, OSError, IndexError):
+        # there is no procfs on this platform
+        return False
+    return state in ('Z', 'X')
@@ -0,0 +1,43 @@
+import functools
+import os
+import random
+
+
+# forked processes are detected with a hook when it's available (Python 3.7+),
+# otherwise by checking the pid
+_REGISTER_AT_FORK = hasattr(os, 'register_at_fork')
+
+
+class IdGenerator(object):
+    """
+    Generator of random 64-bit trace and span IDs. It has its own pseudo-random
+    generator, seeded from ``os.urandom``, so that IDs don't depend on how the
+    application seeds the global ``random`` module. The generator is seeded
+    again in forked processes, so that a child doesn't generate the same IDs as
+    its parent.
+    """
+    def __init__(self):
+        self._rng = random.Random()
+        self._seed()
+        if _REGISTER_AT_FORK:
+            os.register_at_fork(after_in_child=self._seed)
+            # calls the generator without going through a Python function
+            self.new_id = functools.partial(self._rng.getrandbits, 64)
+
+    def new_id(self):
+        """
+        Return a random 64-bit integer.
+        """
+        if self._pid != os.getpid():
+            self._seed()
+        return self._rng.getrandbits(64)
+
+    def _seed(self):
+        self._rng.seed(os.urandom(16))
+        self._pid = os.getpid()
+
+
+_generator = IdGenerator()
+
+# Generate a random trace_id or span_id
+new_id = _generator.new_id
@@ -0,0 +1,107 @@
+import random
+import time
+
+from . import forksafe
+
+
+class RetryPolicy(object):
+    """
+    Bounded number of attempts, separated by an exponential backoff. The "full
+    jitter" strategy is used so that many processes that failed at the same time
+    don't retry at the same time.
+
+    :param int max_attempts: the maximum number of attempts, including the first one
+    :param float initial_backoff: the backoff in seconds after the first attempt
+    :param float max_backoff: the upper bound of the backoff in seconds
+    :param bool jitter: pick a random backoff between 0 and the computed one
+    """
+    def __init__(self, max_attempts=3, initial_backoff=0.1, max_backoff=2, jitter=True):
+        self.max_attempts = max_attempts
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def backoff(self, attempt):
+        """
+        Return the number of seconds to wait after the given failed attempt,
+        starting from ``1``.
+        """
+        delay = min(self.max_backoff, self.initial_backoff * (2 ** (attempt - 1)))
+        if self.jitter:
+            return random.uniform(0, delay)
+        return delay
+
+
+class CircuitBreaker(object):
+    """
+    Thread-safe circuit breaker that stops calls to a failing service.
+
+    The circuit starts ``closed`` and calls are allowed. After ``failure_threshold``
+    consecutive failures it becomes ``open``: calls are rejected until the reset
+    timeout expires. Then, the circuit is ``half-open`` and a single call is allowed
+    to probe the service: if it succeeds the circuit is closed again, otherwise it's
+    opened with a reset timeout that doubles after each failed probe, up to
+    ``max_reset_timeout``. Reset timeouts are jittered so that many processes don't
+    probe the service at the same time.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=1, max_reset_timeout=60):
+        self._failure_threshold = failure_threshold
+        self._initial_reset_timeout = reset_timeout
+        self._max_reset_timeout = max_reset_timeout
+        self._lock = forksafe.Lock()
+        self._state = self.CLOSED
+        self._failures = 0
+        self._reset_timeout = reset_timeout
+        self._open_until = 0
+
+    def copy(self):
+        """
+        Return a closed circuit breaker with the same settings.
+        """
+        return CircuitBreaker(self._failure_threshold, self._initial_reset_timeout, self._max_reset_timeout)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow(self):
+        """
+        Return ``True`` if a call is allowed. When the reset timeout of an open
+        circuit is expired, the circuit becomes half-open and only the first
+        caller is allowed to probe the service.
+        """
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.time() >= self._open_until:
+                self._state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._reset_timeout = self._initial_reset_timeout
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN:
+                # the probe failed: wait longer before the next one
+                self._reset_timeout = min(self._max_reset_timeout, self._reset_timeout * 2)
+                self._open()
+            elif self._state == self.CLOSED and self._failures >= self._failure_threshold:
+                self._open()
+
+    def _open(self):
+        """
+        Non-safe if not used with a lock.
+        """
+        self._state = self.OPEN
+        self._open_until = time.time() + random.uniform(self._reset_timeout / 2.0, self._reset_timeout)
@@ -0,0 +1,102 @@
+import math
+
+
+# values smaller than this are counted as zeros
+MIN_INDEXABLE_VALUE = 1e-9
+
+
+class DDSketch(object):
+    """
+    Quantile sketch with relative-error guarantees, as described in "DDSketch: A
+    Fast and Fully-Mergeable Quantile Sketch with Relative-Error Guarantees".
+
+    Positive values are counted in logarithmic bins, so that any quantile is
+    returned with a relative error lower than ``relative_accuracy``. Sketches
+    with the same accuracy can be merged, e.g. to aggregate several intervals.
+    The number of bins is bounded by ``max_bins``: past it, the lowest bins are
+    collapsed, so that the accuracy of the lowest quantiles is lost first.
+
+    Non-safe if not used with a lock.
+    """
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('the relative accuracy must be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        """
+        Add a non-negative value to the sketch.
+        """
+        if value < MIN_INDEXABLE_VALUE:
+            self.zero_count += 1
+        else:
+            index = int(math.ceil(math.log(value) / self._log_gamma))
+            self.bins[index] = self.bins.get(index, 0) + 1
+            if len(self.bins) > self.max_bins:
+                self._collapse()
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        """
+        Add the values of another sketch with the same relative accuracy.
+        """
+        if other.gamma != self.gamma:
+            raise ValueError('cannot merge sketches with a different relative accuracy')
+        if not other.count:
+            return
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+    def quantile(self, quantile):
+        """
+        Return an estimation of the given quantile, between ``0`` and ``1``, or
+        ``None`` if the sketch is empty.
+        """
+        if not self.count:
+            return None
+        if quantile <= 0:
+            return self.min
+        if quantile >= 1:
+            return self.max
+        rank = quantile * (self.count - 1)
+        seen = self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                # the middle of the bin, in relative terms
+                value = 2 * self.gamma ** index / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def _collapse(self):
+        """
+        Merge the lowest bins into the lowest one that is kept.
+        """
+        indexes = sorted(self.bins)
+        excess = len(indexes) - self.max_bins
+        target = indexes[excess]
+        for index in indexes[:excess]:
+            self.bins[target] += self.bins.pop(index)
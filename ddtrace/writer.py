@@ -1,6 +1,7 @@
 
 # stdlib
 import atexit
+import json
 import logging
 import threading
 import random
@@ -10,6 +11,16 @@ import time
 from ddtrace import api
 
 from .api import _parse_response_json
+from .constants import SAMPLING_PRIORITY_KEY
+from .endpoints import AgentEndpoint, AgentPool, ROUTING_FAILOVER, _is_successful
+from .ext.priority import AUTO_REJECT, USER_KEEP
+from .ringbuffer import SharedRingBuffer
+from .spool import Spool, DEFAULT_QUOTA as DEFAULT_SPOOL_QUOTA
+from .telemetry import (
+    WriterTelemetry, DEFAULT_EMIT_INTERVAL, DROP_AGENT_UNAVAILABLE, DROP_ENCODING_ERROR, DROP_FILTERED,
+    DROP_INCOMPATIBLE_ENCODING, DROP_QUEUE_FULL, DROP_SEND_FAILED, DROP_SPOOL_FULL,
+)
+from .utils.retry import CircuitBreaker, RetryPolicy
 
 log = logging.getLogger(__name__)
 
@@ -17,69 +28,333 @@ log = logging.getLogger(__name__)
 MAX_TRACES = 1000
 MAX_SERVICES = 1000
 
+# traces are flushed every interval, or sooner if the queue grows past one of
+# the flush thresholds (number of traces or estimated size in bytes)
+DEFAULT_FLUSH_INTERVAL = 1
+DEFAULT_FLUSH_SIZE = MAX_TRACES // 2
+DEFAULT_FLUSH_BYTES = 4 << 20
+
+# rough size of an encoded span, without its strings, and of one of its tags or metrics
+SPAN_SIZE_ESTIMATE = 128
+TAG_SIZE_ESTIMATE = 32
+
+# when the queue is full, traces with a lower eviction priority are dropped first
+EVICTION_PRIORITY_LOW = 0       # traces rejected by the priority sampler
+EVICTION_PRIORITY_DEFAULT = 1
+EVICTION_PRIORITY_HIGH = 2      # traces with errors or kept by the user
+
+# kinds of records written in the shared buffer
+RECORD_TRACE = 0
+RECORD_SERVICES = 1
+
 DEFAULT_TIMEOUT = 5
 LOG_ERR_INTERVAL = 60
 
 
 class AgentWriter(object):
 
-    def __init__(self, hostname='localhost', port=8126, filters=None, priority_sampler=None):
+    def __init__(self, hostname='localhost', port=8126, filters=None, priority_sampler=None, uds_path=None,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL, flush_size=DEFAULT_FLUSH_SIZE,
+                 flush_bytes=DEFAULT_FLUSH_BYTES, max_queued_bytes=0, max_payload_size=api.DEFAULT_MAX_PAYLOAD_SIZE,
+                 retry_policy=None, circuit_breaker=None, api_version=None, encode_on_write=False,
+                 compression=None, shared_buffer_size=0, spool_dir=None, spool_quota=DEFAULT_SPOOL_QUOTA,
+                 connection_factory=None, metrics_emitter=None, metrics_interval=DEFAULT_EMIT_INTERVAL,
+                 agents=None, routing=ROUTING_FAILOVER, trace_stats=None):
+        """
+        :param int max_queued_bytes: if set, the trace queue is bounded by the estimated
+            encoded size of the queued traces rather than by their number. When it's full,
+            the oldest traces are dropped to make room for the new one: unsampled traces
+            first, while traces with errors or kept by the user are only replaced by traces
+            of the same kind.
+        :param int max_payload_size: the maximum size of a payload sent to the trace agent;
+            larger flushes are split in multiple payloads.
+        :param RetryPolicy retry_policy: how payloads that failed are retried.
+        :param CircuitBreaker circuit_breaker: stops sending data while the trace agent is down.
+        :param str api_version: the version of the trace agent API, e.g. ``v0.5``; by default
+            it depends on whether priority sampling is enabled.
+        :param bool encode_on_write: if set, filters are applied and traces are encoded as
+            soon as they're written, so that the encoding cost is spread over the traced
+            threads instead of being paid in a single burst by the flush thread. Queued
+            traces are then measured with their exact size. Ignored if the encoder of the
+            API version doesn't support it.
+        :param str compression: compress payloads with ``gzip``, ``zstd`` or ``lz4``.
+        :param int shared_buffer_size: if set, traces are encoded on write and stored in a
+            shared memory buffer of this size, that is inherited by the processes forked
+            from the current one. A single flush thread, running in the current process,
+            sends the traces of all processes. The writer must then be created before the
+            server forks its workers; traces are dropped if the buffer is full.
+        :param str spool_dir: if set, payloads that can't be sent because the trace agent is
+            down are stored in this directory, and sent again once it's back.
+        :param int spool_quota: the maximum size in bytes of the spooled payloads; the oldest
+            ones are discarded first.
+        :param callable connection_factory: creates the connections to the trace agent, see
+            ``HTTPTransport``.
+        :param MetricsEmitter metrics_emitter: if set, the metrics returned by ``stats()`` are
+            sent with this emitter every ``metrics_interval`` seconds.
+        :param list agents: if set, the trace agents as ``(hostname, port)`` or ``(hostname, port,
+            weight)`` tuples, in order of priority; the first one replaces ``hostname`` and ``port``.
+            Each agent has its own circuit breaker, built like ``circuit_breaker``.
+        :param str routing: how payloads are routed between the ``agents``: ``failover`` sends
+            them to the first available agent, ``round_robin`` spreads them over the available
+            agents in proportion to their weight.
+        :param TraceStatsAggregator trace_stats: if set, every finished trace, sampled or not,
+            is aggregated in RED metrics that are exported by the flush thread. Not supported
+            with a shared buffer.
+        """
         self._pid = None
         self._traces = None
         self._services = None
         self._worker = None
         self._filters = filters
         self._priority_sampler = priority_sampler
+        self._flush_interval = flush_interval
+        self._flush_size = flush_size
+        self._flush_bytes = flush_bytes
+        self._max_queued_bytes = max_queued_bytes
+        self._encode_on_write = encode_on_write
+        self._retry_policy = retry_policy or RetryPolicy()
+        # the circuit breaker outlives the workers, so that a new worker knows the agent is down
+        self._circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._spool = Spool(spool_dir, quota=spool_quota) if spool_dir else None
+        # the telemetry outlives the workers as well, so that counters are cumulative
+        self._telemetry = WriterTelemetry()
+        self._metrics_emitter = metrics_emitter
+        self._metrics_interval = metrics_interval
+        self.trace_stats = trace_stats
         priority_sampling = priority_sampler is not None
-        self.api = api.API(hostname, port, priority_sampling=priority_sampling)
+        agents = [_parse_agent(agent) for agent in agents or []] or [(hostname, port, 1)]
+        endpoints = []
+        for index, (agent_hostname, agent_port, weight) in enumerate(agents):
+            agent_api = api.API(
+                agent_hostname,
+                agent_port,
+                uds_path=uds_path if index == 0 else None,
+                priority_sampling=priority_sampling,
+                max_payload_size=max_payload_size,
+                version=api_version,
+                compression=compression,
+                connection_factory=connection_factory,
+            )
+            # the first agent keeps the circuit breaker given by the caller
+            breaker = self._circuit_breaker if index == 0 else self._circuit_breaker.copy()
+            endpoints.append(AgentEndpoint(agent_api, breaker, weight))
+        # the agents outlive the workers as well, with their health and sampling rates
+        self.agent_pool = AgentPool(endpoints, routing=routing)
+        self.api = self.agent_pool.primary.api
+
+        self._shared_buffer = None
+        self._shared_buffer_pid = None
+        if shared_buffer_size:
+            if self.api.encoder.incremental:
+                # the buffer is created eagerly, so that forked processes inherit it
+                self._shared_buffer = SharedRingBuffer(shared_buffer_size)
+                self._shared_buffer_pid = os.getpid()
+                self._reset_worker()
+            else:
+                log.warning('the shared buffer requires an encoder that joins traces encoded one by one '
+                            'without decoding them; it is not supported with the v0.5 API')
+        if self._shared_buffer is not None and self.trace_stats is not None:
+            # the forked processes don't run a flush thread that would export them
+            log.warning('trace stats are not supported with a shared buffer')
+            self.trace_stats = None
 
     def write(self, spans=None, services=None):
+        if self._shared_buffer is not None:
+            self._write_shared(spans, services)
+            return
+
         # if the worker needs to be reset, do it.
         self._reset_worker()
 
         if spans:
-            self._traces.add(spans)
+            self._telemetry.enqueued(len(spans))
+            if self._encode_on_write and self.api.encoder.incremental:
+                self._write_encoded(spans)
+            else:
+                self._traces.add(spans)
 
         if services:
             self._services.add(services)
 
+    def _write_encoded(self, spans):
+        encoded = self._encode_trace(spans)
+        if encoded is not None:
+            self._traces.add(encoded)
+
+    def _write_shared(self, spans, services):
+        if os.getpid() == self._shared_buffer_pid:
+            # the flush thread only runs in the process that created the buffer
+            self._reset_worker()
+
+        if spans:
+            self._telemetry.enqueued(len(spans))
+            encoded = self._encode_trace(spans)
+            if encoded is not None:
+                data = encoded.data
+                if not isinstance(data, bytes):
+                    data = data.encode('utf-8')
+                if not self._shared_buffer.write(data, RECORD_TRACE, len(encoded)):
+                    log.debug("shared buffer is full, dropping a trace of %d bytes", len(data))
+
+        if services:
+            if not self._shared_buffer.write(json.dumps(services).encode('utf-8'), RECORD_SERVICES):
+                log.debug("shared buffer is full, dropping services")
+
+    def _encode_trace(self, spans):
+        """
+        Filter and encode the given trace; return ``None`` if it's discarded.
+        """
+        traces = [spans]
+        try:
+            traces = _apply_filters(self._filters, traces)
+        except Exception as err:
+            log.error("error while filtering traces:{0}".format(err))
+        if not traces:
+            self._telemetry.dropped(DROP_FILTERED, 1)
+            return None
+
+        trace = traces[0]
+        encoder = self.api.encoder
+        start = time.time()
+        try:
+            data = encoder.encode_trace(trace)
+        except Exception as err:
+            log.error("cannot encode trace: %s", err)
+            self._telemetry.dropped(DROP_ENCODING_ERROR, 1)
+            return None
+        self._telemetry.observe('encode_time', time.time() - start)
+        self._telemetry.count('encoded_bytes', len(data))
+        return EncodedTrace(data, type(encoder), len(trace), _trace_eviction_priority(trace))
+
+    def stats(self):
+        """
+        Return a dictionary with the state of the trace queue for the current process:
+        the number of queued traces and their estimated size in bytes, the maximum
+        number of traces queued at once, and the number of traces and spans dropped
+        because the queue was full. With a shared buffer, it's the state of the buffer
+        shared by all processes.
+
+        It also contains the telemetry of the writer in this process: the number of
+        enqueued traces and spans, of encoded bytes, of sent and spooled traces, the
+        traces dropped by reason (``dropped``), the responses of the trace agent by
+        HTTP status (``http_status``), the number of requests that failed without a
+        response (``send_errors``) and histograms of the time spent encoding and
+        sending (``encode_time`` and ``send_time``, in seconds).
+        """
+        stats = self._queue_stats()
+        telemetry = self._telemetry.snapshot()
+        if stats['dropped_traces']:
+            telemetry['dropped'][DROP_QUEUE_FULL] = stats['dropped_traces']
+        stats.update(telemetry)
+        return stats
+
+    def _queue_stats(self):
+        if self._shared_buffer is not None:
+            stats = _shared_buffer_stats(self._shared_buffer)
+            stats['high_water'] = self._traces.high_water() if self._pid == os.getpid() else 0
+            return stats
+        if self._traces is None or self._pid != os.getpid():
+            return {'queued_traces': 0, 'queued_bytes': 0, 'dropped_traces': 0, 'dropped_spans': 0,
+                    'high_water': 0}
+        stats = self._traces.stats()
+        stats['high_water'] = self._traces.high_water()
+        return stats
+
     def _reset_worker(self):
         # if this queue was created in a different process (i.e. this was
         # forked) reset everything so that we can safely work from it.
         pid = os.getpid()
         if self._pid != pid:
             log.debug("resetting queues. pids(old:%s new:%s)", self._pid, pid)
-            self._traces = Q(max_size=MAX_TRACES)
             self._services = Q(max_size=MAX_SERVICES)
+            if self._shared_buffer is not None:
+                self._traces = SharedQ(
+                    self._shared_buffer,
+                    type(self.api.encoder),
+                    self._services,
+                    flush_size=self._flush_size,
+                    flush_bytes=self._flush_bytes,
+                )
+            else:
+                # the estimators run in the traced threads, on every write: skip
+                # them when there is no byte limit or no eviction to drive
+                bounded = self._max_queued_bytes > 0
+                self._traces = self._create_trace_queue(
+                    max_size=MAX_TRACES,
+                    max_bytes=self._max_queued_bytes,
+                    flush_size=self._flush_size,
+                    flush_bytes=self._flush_bytes,
+                    size_estimator=_estimate_trace_size if bounded or self._flush_bytes > 0 else None,
+                    priority_estimator=_trace_eviction_priority if bounded else None,
+                )
             self._worker = None
             self._pid = pid
 
         # ensure we have an active thread working on this queue
         if not self._worker or not self._worker.is_alive():
-            self._worker = AsyncWorker(
+            self._worker = self._create_worker(
                 self.api,
                 self._traces,
                 self._services,
                 filters=self._filters,
                 priority_sampler=self._priority_sampler,
+                flush_interval=self._flush_interval,
+                retry_policy=self._retry_policy,
+                circuit_breaker=self._circuit_breaker,
+                spool=self._spool,
+                telemetry=self._telemetry,
+                metrics_emitter=self._metrics_emitter,
+                metrics_interval=self._metrics_interval,
+                agent_pool=self.agent_pool,
+                trace_stats=self.trace_stats,
             )
 
+    def _create_trace_queue(self, **kwargs):
+        """
+        Return the queue of the traces waiting to be flushed by the worker.
+        """
+        return Q(**kwargs)
+
+    def _create_worker(self, *args, **kwargs):
+        """
+        Return a started worker that flushes the queues.
+        """
+        return AsyncWorker(*args, **kwargs)
+
 
 class AsyncWorker(object):
 
     def __init__(self, api, trace_queue, service_queue, shutdown_timeout=DEFAULT_TIMEOUT,
-                 filters=None, priority_sampler=None):
+                 filters=None, priority_sampler=None, flush_interval=DEFAULT_FLUSH_INTERVAL,
+                 retry_policy=None, circuit_breaker=None, spool=None, telemetry=None, metrics_emitter=None,
+                 metrics_interval=DEFAULT_EMIT_INTERVAL, agent_pool=None, trace_stats=None):
         self._trace_queue = trace_queue
         self._service_queue = service_queue
         self._lock = threading.Lock()
         self._thread = None
         self._shutdown_timeout = shutdown_timeout
+        self._flush_interval = flush_interval
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._circuit_breaker = circuit_breaker or CircuitBreaker()
+        # the trace agents; by default, only the one of ``api``
+        self._agent_pool = agent_pool or AgentPool([AgentEndpoint(api, self._circuit_breaker)])
+        self._spool = spool
+        self._telemetry = telemetry or WriterTelemetry()
+        self._metrics_emitter = metrics_emitter
+        self._metrics_interval = metrics_interval
+        self._last_emit_ts = time.time()
+        self._trace_stats = trace_stats
+        # set when the worker is stopped, to interrupt the backoff between retries
+        self._stopping = self._create_event()
         self._filters = filters
         self._priority_sampler = priority_sampler
         self._last_error_ts = 0
         self.api = api
         self.start()
 
+    def _create_event(self):
+        return threading.Event()
+
     def is_alive(self):
         return self._thread.is_alive()
 
@@ -98,6 +373,7 @@ class AsyncWorker(object):
         """
         with self._lock:
             if self._thread and self.is_alive():
+                self._stopping.set()
                 self._trace_queue.close()
 
     def join(self, timeout=2):
@@ -112,8 +388,8 @@ class AsyncWorker(object):
             if not self._thread:
                 return
 
-            # wait for in-flight queues to get traced.
-            time.sleep(0.1)
+            # closing the queue wakes up the worker that flushes what is left and exits
+            self._stopping.set()
             self._trace_queue.close()
 
             size = self._trace_queue.size()
@@ -121,10 +397,7 @@ class AsyncWorker(object):
                 key = "ctrl-break" if os.name == 'nt' else 'ctrl-c'
                 log.debug("Waiting %ss for traces to be sent. Hit %s to quit.",
                         self._shutdown_timeout, key)
-                timeout = time.time() + self._shutdown_timeout
-                while time.time() < timeout and self._trace_queue.size():
-                    # FIXME[matt] replace with a queue join
-                    time.sleep(0.05)
+            self._thread.join(self._shutdown_timeout)
 
     def _target(self):
         result_traces = None
@@ -132,42 +405,295 @@ class AsyncWorker(object):
 
         while True:
             traces = self._trace_queue.pop()
+            if traces:
+                # traces encoded on write are already filtered and just need to be joined
+                encoded = [trace for trace in traces if isinstance(trace, EncodedTrace)]
+                if encoded:
+                    traces = [trace for trace in traces if not isinstance(trace, EncodedTrace)]
+                    result_traces = self._send_encoded_traces(encoded)
             if traces:
                 # Before sending the traces, make them go through the
                 # filters
+                count = len(traces)
                 try:
                     traces = self._apply_filters(traces)
                 except Exception as err:
                     log.error("error while filtering traces:{0}".format(err))
+                self._telemetry.dropped(DROP_FILTERED, count - len(traces))
             if traces:
                 # If we have data, let's try to send it.
-                try:
-                    result_traces = self.api.send_traces(traces)
-                except Exception as err:
-                    log.error("cannot send spans to {1}:{2}: {0}".format(err, self.api.hostname, self.api.port))
+                result_traces = self._send_traces(traces)
 
             services = self._service_queue.pop()
             if services:
-                try:
-                    result_services = self.api.send_services(services)
-                except Exception as err:
-                    log.error("cannot send services to {1}:{2}: {0}".format(err, self.api.hostname, self.api.port))
+                endpoint = self._agent_pool.healthy_endpoint()
+                if endpoint is not None:
+                    try:
+                        result_services = endpoint.api.send_services(services)
+                    except Exception as err:
+                        log.error("cannot send services to {1}:{2}: {0}".format(
+                            err, endpoint.api.hostname, endpoint.api.port))
+                else:
+                    # services are only sent when they change: keep them until the agent is back
+                    for service in services:
+                        self._service_queue.add(service)
+
+            if self._spool is not None and self._agent_pool.healthy():
+                self._replay_spool()
 
             if self._trace_queue.closed() and self._trace_queue.size() == 0:
                 # no traces and the queue is closed. our work is done
+                if self._spool is not None:
+                    self._spool.close()
+                self._emit_metrics(force=True)
+                self._export_trace_stats(force=True)
                 return
 
-            if self._priority_sampler:
-                result_traces_json = _parse_response_json(result_traces)
-                if result_traces_json and 'rate_by_service' in result_traces_json:
-                    self._priority_sampler.set_sample_rate_by_service(result_traces_json['rate_by_service'])
+            self._emit_metrics()
+            self._export_trace_stats()
 
             self._log_error_status(result_traces, "traces")
             result_traces = None
             self._log_error_status(result_services, "services")
             result_services = None
 
-            time.sleep(1)  # replace with a blocking pop.
+            # sleep until the next flush, unless the queue fills up or is closed
+            self._trace_queue.wait(self._flush_interval)
+
+    def _send_traces(self, traces):
+        """
+        Encode and send the given traces, unless the circuit breaker is open because
+        the trace agent is down: in that case traces are spooled, or dropped without
+        spending time encoding them.
+        """
+        return self._send(len(traces), self.api.encode_traces, traces)
+
+    def _send_encoded_traces(self, encoded):
+        """
+        Join and send traces encoded on write. Traces encoded with an encoder that
+        isn't the one of the API anymore, because it has been downgraded, are dropped.
+        """
+        encoder = type(self.api.encoder)
+        if any(trace.encoder is not encoder for trace in encoded):
+            count = len(encoded)
+            encoded = [trace for trace in encoded if trace.encoder is encoder]
+            log.debug("dropping %d traces encoded in a format not supported by the API", count - len(encoded))
+            self._telemetry.dropped(DROP_INCOMPATIBLE_ENCODING, count - len(encoded))
+
+        if not encoded:
+            return None
+        return self._send(len(encoded), self.api.join_traces, [trace.data for trace in encoded])
+
+    def _send(self, count, to_payloads, items):
+        """
+        Send the payloads returned by ``to_payloads(items)``. If the trace agent is
+        down, they're spooled if a spool is available, otherwise dropped.
+        """
+        available = self._agent_available()
+        if not available and self._spool is None:
+            log.debug("trace agent is unavailable, dropping %d traces", count)
+            self._telemetry.dropped(DROP_AGENT_UNAVAILABLE, count)
+            return None
+
+        start = time.time()
+        try:
+            payloads = to_payloads(items)
+        except Exception as err:
+            log.error("cannot encode traces: %s", err)
+            self._telemetry.dropped(DROP_ENCODING_ERROR, count)
+            return None
+        self._telemetry.observe('encode_time', time.time() - start)
+        self._telemetry.count('encoded_bytes', sum(len(payload.data) for payload in payloads if payload.data))
+
+        if not available:
+            for payload in payloads:
+                self._spool_payload(payload)
+            return None
+        return self._send_payloads(payloads)
+
+    def _agent_available(self):
+        """
+        Return ``False`` if the circuit breakers of all the trace agents are open
+        because they're down. Half-open circuits are probed first.
+        """
+        return self._agent_pool.available()
+
+    def _send_payloads(self, payloads):
+        """
+        Send the given payloads, returning the response of the first one that failed,
+        otherwise the response of the last one.
+        """
+        result = None
+        for payload in payloads:
+            response = self._send_payload(payload)
+            if result is None or getattr(result, 'status', 0) < 400:
+                result = response
+        return result
+
+    def _send_payload(self, payload):
+        """
+        Send a single payload, retrying it according to the retry policy if the trace
+        agent is unreachable or fails; retries go to another agent if one is available.
+        Retries stop as soon as the circuit breakers of all agents are open or the worker
+        is stopped.
+        """
+        endpoint = None
+        attempt = 0
+        while True:
+            attempt += 1
+            error = None
+            endpoint = self._agent_pool.select(avoid=endpoint, accepts=lambda e: e.accepts(payload, self.api))
+            if endpoint is None:
+                # the trace agents went down in the meantime
+                response = None
+            else:
+                response = self._timed_send(payload, endpoint)
+                if isinstance(response, Exception):
+                    response, error = None, response
+
+                if error is None and _is_successful(response):
+                    endpoint.circuit_breaker.record_success()
+                    if response.status < 400:
+                        self._telemetry.count('sent_traces', payload.count)
+                    else:
+                        self._telemetry.dropped(DROP_SEND_FAILED, payload.count)
+                    self._update_rates(endpoint, response)
+                    return response
+
+                endpoint.circuit_breaker.record_failure()
+
+            if endpoint is None or not self._should_retry(attempt):
+                if self._spool is not None:
+                    self._spool_payload(payload)
+                else:
+                    self._telemetry.dropped(DROP_SEND_FAILED, payload.count)
+                    if error is not None:
+                        log.error("cannot send spans to {1}:{2}: {0}".format(
+                            error, endpoint.api.hostname, endpoint.api.port))
+                return response
+            log.debug("retrying to send %d traces (attempt %d)", payload.count, attempt + 1)
+
+    def _update_rates(self, endpoint, response):
+        """
+        Apply the sampling rates by service reported by the trace agent, if the
+        agent pool keeps them.
+        """
+        if not self._priority_sampler:
+            return
+        result = _parse_response_json(response)
+        if not result or 'rate_by_service' not in result:
+            return
+        rate_by_service = self._agent_pool.update_rates(endpoint, result['rate_by_service'])
+        if rate_by_service is not None:
+            self._priority_sampler.set_sample_rate_by_service(rate_by_service)
+
+    def _timed_send(self, payload, endpoint):
+        """
+        Send a payload once to the given agent and record how long it took; return
+        the response or the exception raised.
+        """
+        start = time.time()
+        try:
+            response = endpoint.send_payload(payload, self.api)
+        except Exception as err:
+            self._telemetry.count('send_errors')
+            return err
+        finally:
+            self._telemetry.observe('send_time', time.time() - start)
+        if response is not None:
+            self._telemetry.response(response.status)
+        return response
+
+    def _spool_payload(self, payload):
+        try:
+            if self._spool.write(payload, self.api.payload_format):
+                self._telemetry.count('spooled_traces', payload.count)
+                return
+            log.debug("spool quota exceeded, dropping %d traces", payload.count)
+        except Exception as err:
+            log.error("cannot spool %d traces: %s", payload.count, err)
+        self._telemetry.dropped(DROP_SPOOL_FULL, payload.count)
+
+    def _emit_metrics(self, force=False):
+        """
+        Send the writer metrics with the emitter, if any, once per metrics interval.
+        """
+        if self._metrics_emitter is None:
+            return
+        now = time.time()
+        if not force and now < self._last_emit_ts + self._metrics_interval:
+            return
+        self._last_emit_ts = now
+        queue_stats = self._trace_queue.stats()
+        queue_stats['high_water'] = self._trace_queue.high_water(reset=True)
+        try:
+            self._telemetry.emit(self._metrics_emitter, queue_stats)
+        except Exception as err:
+            log.debug("cannot emit the writer metrics: %s", err)
+
+    def _export_trace_stats(self, force=False):
+        """
+        Export the trace stats, if any, once per interval of the aggregator.
+        """
+        if self._trace_stats is None:
+            return
+        try:
+            self._trace_stats.export(force=force)
+        except Exception as err:
+            log.debug("cannot export the trace stats: %s", err)
+
+    def _replay_spool(self):
+        """
+        Send again the payloads spooled while the trace agent was down.
+        """
+        try:
+            sent = self._spool.replay(self._replay_payload)
+        except Exception as err:
+            log.error("cannot replay spooled traces: %s", err)
+            return
+        if sent:
+            log.debug("replayed %d spooled payloads", sent)
+
+    def _replay_payload(self, payload, payload_format):
+        """
+        Send a spooled payload once; return ``True`` if it doesn't need to be sent again.
+        Payloads in a format that none of the agents uses, e.g. spooled by a process
+        whose API was downgraded, are dropped.
+        """
+        def accepts(endpoint):
+            return endpoint.api.payload_format == payload_format
+
+        if not any(accepts(endpoint) for endpoint in self._agent_pool.endpoints):
+            log.debug("dropping %d spooled traces encoded for %s", payload.count, payload_format)
+            self._telemetry.dropped(DROP_INCOMPATIBLE_ENCODING, payload.count)
+            return True
+        endpoint = self._agent_pool.select(accepts=accepts)
+        if endpoint is None:
+            return False
+        response = self._timed_send(payload, endpoint)
+        if isinstance(response, Exception):
+            response = None
+        if _is_successful(response):
+            endpoint.circuit_breaker.record_success()
+            if response.status < 400:
+                self._telemetry.count('sent_traces', payload.count)
+            else:
+                self._telemetry.dropped(DROP_SEND_FAILED, payload.count)
+            return True
+        endpoint.circuit_breaker.record_failure()
+        return False
+
+    def _should_retry(self, attempt):
+        """
+        Return ``True``, after waiting for the backoff, if a payload must be sent again
+        after the given failed attempt.
+        """
+        if attempt >= self._retry_policy.max_attempts:
+            return False
+        if not self._agent_pool.healthy():
+            return False
+        # the backoff is interrupted if the worker is stopped
+        return not self._stopping.wait(self._retry_policy.backoff(attempt))
 
     def _log_error_status(self, result, result_name):
         log_level = log.debug
@@ -186,29 +712,138 @@ class AsyncWorker(object):
         tracer. There is no need for a lock since the traces are owned by the
         AsyncWorker at that point.
         """
-        if self._filters is not None:
-            filtered_traces = []
-            for trace in traces:
-                for filtr in self._filters:
-                    trace = filtr.process_trace(trace)
-                    if trace is None:
-                        break
-                if trace is not None:
-                    filtered_traces.append(trace)
-            return filtered_traces
-        return traces
+        return _apply_filters(self._filters, traces)
+
+
+class EncodedTrace(object):
+    """
+    A trace encoded when it was written, with what is needed to queue it: the
+    encoder type, the number of spans and the eviction priority.
+    """
+    __slots__ = ['data', 'encoder', 'spans', 'priority']
+
+    def __init__(self, data, encoder, spans, priority):
+        self.data = data
+        self.encoder = encoder
+        self.spans = spans
+        self.priority = priority
+
+    def __len__(self):
+        return self.spans
+
+
+def _apply_filters(filters, traces):
+    """
+    Make each trace go through the given filters, and return the traces
+    that are not discarded.
+    """
+    if filters is not None:
+        filtered_traces = []
+        for trace in traces:
+            for filtr in filters:
+                trace = filtr.process_trace(trace)
+                if trace is None:
+                    break
+            if trace is not None:
+                filtered_traces.append(trace)
+        return filtered_traces
+    return traces
+
+
+def _parse_agent(agent):
+    """
+    Return the ``(hostname, port, weight)`` of a trace agent given as a ``(hostname,
+    port)`` or ``(hostname, port, weight)`` tuple.
+    """
+    if len(agent) == 2:
+        return agent[0], agent[1], 1
+    return tuple(agent)
+
+
+def _estimate_trace_size(trace):
+    """
+    Return a rough estimation of the encoded size of the given trace, in bytes.
+    It's computed in the traced thread on every write, so the tags and metrics
+    are only counted rather than measured; the name, resource and service are
+    measured because they make a span weigh a few hundred bytes or a few
+    kilobytes (e.g. SQL queries). The exact size is known for traces encoded
+    on write.
+    """
+    if isinstance(trace, EncodedTrace):
+        return len(trace.data)
+
+    size = 0
+    try:
+        for span in trace:
+            size += SPAN_SIZE_ESTIMATE + len(span.name or '') + len(span.resource or '') + len(span.service or '')
+            if span._meta:
+                size += TAG_SIZE_ESTIMATE * len(span._meta)
+            if span._metrics:
+                size += TAG_SIZE_ESTIMATE * len(span._metrics)
+    except TypeError:
+        # the name or the resource may not be a string if it wasn't set by the integration
+        size = SPAN_SIZE_ESTIMATE * len(trace)
+    return size
+
+
+def _trace_eviction_priority(trace):
+    """
+    Return how much the given trace is worth keeping when the queue is full.
+    The sampling priority is attached to the root span, that is the first one.
+    """
+    if isinstance(trace, EncodedTrace):
+        return trace.priority
+
+    priority = trace[0].get_metric(SAMPLING_PRIORITY_KEY) if trace else None
+    if priority is not None and priority >= USER_KEEP:
+        return EVICTION_PRIORITY_HIGH
+
+    for span in trace:
+        if span.error:
+            return EVICTION_PRIORITY_HIGH
+
+    if priority is not None and priority <= AUTO_REJECT:
+        return EVICTION_PRIORITY_LOW
+    return EVICTION_PRIORITY_DEFAULT
 
 
 class Q(object):
     """
     Q is a threadsafe queue that let's you pop everything at once and
     will randomly overwrite elements when it's over the max size.
+
+    If ``max_bytes`` is set, the queue is also bounded by the size of its elements
+    computed with the ``size_estimator``. When there is no room left, the oldest
+    elements with the lowest priority, computed with the ``priority_estimator``, are
+    dropped to make room for the new one; elements with a higher priority than the
+    new one are never dropped, so if that isn't enough the new element is dropped
+    instead.
+
+    A consumer can ``wait()`` for the queue to be ready to be flushed: that happens
+    when it reaches ``flush_size`` elements or, if a ``size_estimator`` is given,
+    when the estimated size of its elements reaches ``flush_bytes``.
     """
-    def __init__(self, max_size=1000):
+    def __init__(self, max_size=1000, max_bytes=0, flush_size=0, flush_bytes=0, size_estimator=None,
+                 priority_estimator=None):
         self._things = []
+        self._sizes = []
+        self._priorities = []
+        self._bytes = 0
         self._lock = threading.Lock()
+        self._flush_ready = threading.Condition(self._lock)
         self._max_size = max_size
+        self._max_bytes = max_bytes
+        self._flush_size = flush_size
+        self._flush_bytes = flush_bytes
+        self._size_estimator = size_estimator
+        self._priority_estimator = priority_estimator
         self._closed = False
+        # elements dropped because the queue was full, and the number of items they
+        # contained (i.e. the spans of the dropped traces)
+        self._dropped = 0
+        self._dropped_items = 0
+        # the maximum number of elements queued at once
+        self._high_water = 0
 
     def size(self):
         with self._lock:
@@ -217,22 +852,70 @@ class Q(object):
     def close(self):
         with self._lock:
             self._closed = True
+            self._flush_ready.notify_all()
 
     def closed(self):
         with self._lock:
             return self._closed
 
+    def stats(self):
+        with self._lock:
+            return {
+                'queued_traces': len(self._things),
+                'queued_bytes': self._bytes,
+                'dropped_traces': self._dropped,
+                'dropped_spans': self._dropped_items,
+            }
+
+    def high_water(self, reset=False):
+        """
+        Return the maximum number of elements queued at once since the queue was
+        created, or since the previous call that reset it.
+        """
+        with self._lock:
+            high_water = self._high_water
+            if reset:
+                self._high_water = len(self._things)
+            return high_water
+
     def add(self, thing):
+        size = self._size_estimator(thing) if self._size_estimator else 0
+        priority = self._priority_estimator(thing) if self._priority_estimator else 0
+
         with self._lock:
             if self._closed:
                 return False
 
-            if len(self._things) < self._max_size or self._max_size <= 0:
-                self._things.append(thing)
-                return True
+            if self._max_bytes > 0:
+                added = self._make_room(size, priority)
+                if added:
+                    self._append(thing, size, priority)
+                else:
+                    self._count_dropped(thing)
+            elif len(self._things) < self._max_size or self._max_size <= 0:
+                self._append(thing, size, priority)
+                added = True
             else:
                 idx = random.randrange(0, len(self._things))
+                self._count_dropped(self._things[idx])
                 self._things[idx] = thing
+                self._bytes += size - self._sizes[idx]
+                self._sizes[idx] = size
+                self._priorities[idx] = priority
+                added = False
+
+            if self._is_flush_ready():
+                self._flush_ready.notify()
+            return added
+
+    def wait(self, timeout):
+        """
+        Block until the queue is ready to be flushed, it is closed, or the
+        ``timeout`` (in seconds) expires.
+        """
+        with self._lock:
+            if not self._closed and not self._is_flush_ready():
+                self._flush_ready.wait(timeout)
 
     def pop(self):
         with self._lock:
@@ -240,4 +923,154 @@ class Q(object):
                 return None
             things = self._things
             self._things = []
+            self._sizes = []
+            self._priorities = []
+            self._bytes = 0
             return things
+
+    def _append(self, thing, size, priority):
+        """
+        Non-safe if not used with a lock.
+        """
+        self._things.append(thing)
+        self._sizes.append(size)
+        self._priorities.append(priority)
+        self._bytes += size
+        self._high_water = max(self._high_water, len(self._things))
+
+    def _count_dropped(self, thing):
+        """
+        Non-safe if not used with a lock.
+        """
+        self._dropped += 1
+        try:
+            self._dropped_items += len(thing)
+        except TypeError:
+            pass
+
+    def _make_room(self, size, priority):
+        """
+        Drop the elements with a priority lower than or equal to the given one,
+        starting from the lowest and oldest, until there is room for an element of
+        the given size. Nothing is dropped if that isn't enough to make room for it.
+
+        Non-safe if not used with a lock.
+        """
+        extra_bytes = self._bytes + size - self._max_bytes
+        extra_things = len(self._things) + 1 - self._max_size if self._max_size > 0 else 0
+        if extra_bytes <= 0 and extra_things <= 0:
+            return True
+        if size > self._max_bytes:
+            return False
+
+        candidates = sorted(
+            (p, idx) for idx, p in enumerate(self._priorities) if p <= priority
+        )
+        evicted = set()
+        for _, idx in candidates:
+            if extra_bytes <= 0 and extra_things <= 0:
+                break
+            evicted.add(idx)
+            extra_bytes -= self._sizes[idx]
+            extra_things -= 1
+
+        if extra_bytes > 0 or extra_things > 0:
+            return False
+
+        things, sizes, priorities = [], [], []
+        for idx, thing in enumerate(self._things):
+            if idx in evicted:
+                self._count_dropped(thing)
+                self._bytes -= self._sizes[idx]
+            else:
+                things.append(thing)
+                sizes.append(self._sizes[idx])
+                priorities.append(self._priorities[idx])
+        self._things, self._sizes, self._priorities = things, sizes, priorities
+        return True
+
+    def _is_flush_ready(self):
+        """
+        Non-safe if not used with a lock.
+        """
+        if self._flush_size > 0 and len(self._things) >= self._flush_size:
+            return True
+        return self._flush_bytes > 0 and self._bytes >= self._flush_bytes
+
+
+class SharedQ(object):
+    """
+    Queue interface on top of a ``SharedRingBuffer``, used by the ``AsyncWorker``
+    of the process that created the buffer to flush the traces of all processes.
+    Traces are popped as ``EncodedTrace`` encoded with the given ``encoder`` type,
+    while services are moved to the ``service_queue``.
+
+    Since other processes can't notify the worker, the buffer is polled every
+    ``poll_interval`` seconds to know if it's ready to be flushed.
+    """
+    def __init__(self, shared_buffer, encoder, service_queue, flush_size=0, flush_bytes=0, poll_interval=0.1):
+        self._buffer = shared_buffer
+        self._encoder = encoder
+        self._service_queue = service_queue
+        self._flush_size = flush_size
+        self._flush_bytes = flush_bytes
+        self._poll_interval = poll_interval
+        self._closed = threading.Event()
+        # the maximum number of records read at once
+        self._high_water = 0
+
+    def size(self):
+        return self._buffer.stats()['records']
+
+    def close(self):
+        self._closed.set()
+
+    def closed(self):
+        return self._closed.is_set()
+
+    def stats(self):
+        return _shared_buffer_stats(self._buffer)
+
+    def high_water(self, reset=False):
+        high_water = self._high_water
+        if reset:
+            self._high_water = 0
+        return high_water
+
+    def wait(self, timeout):
+        """
+        Block until the buffer is ready to be flushed, the queue is closed, or the
+        ``timeout`` (in seconds) expires.
+        """
+        deadline = time.time() + timeout
+        while not self._is_flush_ready():
+            remaining = deadline - time.time()
+            if remaining <= 0 or self._closed.wait(min(self._poll_interval, remaining)):
+                return
+
+    def pop(self):
+        traces = []
+        records = self._buffer.read()
+        self._high_water = max(self._high_water, len(records))
+        for kind, spans, data in records:
+            if kind == RECORD_SERVICES:
+                self._service_queue.add(json.loads(data.decode('utf-8')))
+            else:
+                traces.append(EncodedTrace(data, self._encoder, spans, EVICTION_PRIORITY_DEFAULT))
+        return traces or None
+
+    def _is_flush_ready(self):
+        stats = self._buffer.stats()
+        if self._flush_size > 0 and stats['records'] >= self._flush_size:
+            return True
+        return self._flush_bytes > 0 and stats['bytes'] >= self._flush_bytes
+
+
+def _shared_buffer_stats(shared_buffer):
+    stats = shared_buffer.stats()
+    return {
+        'queued_traces': stats['records'],
+        'queued_bytes': stats['bytes'],
+        'dropped_traces': stats['dropped_records'],
+        'dropped_spans': stats['dropped_items'],
+    }
@@ -1,11 +1,40 @@
+import gc
+import os
+import random
+import signal
+import sys
+import threading
 import time
 import timeit
+import traceback
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2
+    asyncio = None
 
 from ddtrace import Tracer
+from ddtrace.api import API
+from ddtrace.compat import StringIO
+from ddtrace.compression import get_compressor
+from ddtrace.context import Context, LockFreeContext
+from ddtrace.span import Span
+from ddtrace.utils.ids import new_id
+from ddtrace.encoding import MsgpackEncoder, StreamingMsgpackEncoder, StringTableMsgpackEncoder
+from ddtrace.transport import HTTPTransport
+from ddtrace.writer import AgentWriter
 
-from .test_tracer import DummyWriter
+from .test_tracer import DummyWriter, get_dummy_tracer
+from .util import StandInAgent
 from os import getpid
 
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
 
 REPEAT = 10
 NUMBER = 10000
@@ -39,6 +68,24 @@ def benchmark_tracer_trace():
     print("- trace execution time: {:8.6f}".format(min(result)))
 
 
+def _trace_nested(tracer, depth=5):
+    with tracer.trace("nested", service="s"):
+        if depth:
+            _trace_nested(tracer, depth - 1)
+
+
+def benchmark_tracer_trace_nested():
+    print("## nested tracer.trace() benchmark: {} loops ##".format(NUMBER))
+    for name, context_class in (('Context', Context), ('LockFreeContext', LockFreeContext)):
+        tracer = Tracer()
+        tracer.writer = DummyWriter()
+        # the Context used by the thread, as if created by the provider
+        tracer.context_provider._local._locals.context = context_class()
+        timer = timeit.Timer(lambda: _trace_nested(tracer))
+        result = timer.repeat(repeat=REPEAT, number=NUMBER)
+        print("- {} execution time: {:8.6f}".format(name, min(result)))
+
+
 def benchmark_tracer_wrap():
     tracer = Tracer()
     tracer.writer = DummyWriter()
@@ -80,7 +127,285 @@ def benchmark_getpid():
     print("- getpid execution time: {:8.6f}".format(min(result)))
 
 
+def benchmark_api_transport():
+    # a flush of a single small trace, so that the cost of the connection dominates
+    data = b'[[{"trace_id":1,"span_id":1,"name":"a","resource":"r","service":"s"}]]'
+
+    def flush(api):
+        api._put('/v0.3/traces', data, 1)
+
+    print("## API._put() transport benchmark against a stand-in agent: {} loops ##".format(NUMBER))
+    with StandInAgent() as agent:
+        # keep-alive connections (default)
+        api = API(agent.hostname, agent.port)
+        timer = timeit.Timer(lambda: flush(api))
+        result = timer.repeat(repeat=REPEAT, number=NUMBER)
+        api.close()
+        print("- keep-alive execution time: {:8.6f}".format(min(result)))
+
+        # a new connection for each flush
+        api = API(agent.hostname, agent.port)
+        api._transport = HTTPTransport(agent.hostname, agent.port, pool_size=0)
+        connections = agent.connections
+        timer = timeit.Timer(lambda: flush(api))
+        result = timer.repeat(repeat=REPEAT, number=NUMBER)
+        print("- connection per flush execution time: {:8.6f} ({} connections)".format(
+            min(result), agent.connections - connections))
+
+
+def _django_traces(count=100):
+    # requests of a Django application running a few psycopg queries
+    tracer = get_dummy_tracer()
+    for i in range(count):
+        with tracer.trace('django.request', service='django', resource='app.views.UserView', span_type='http') as root:
+            root.set_tag('http.method', 'GET')
+            root.set_tag('http.url', '/users/{}/'.format(i))
+            root.set_tag('http.status_code', '200')
+            root.set_tag('django.user.is_authenticated', 'True')
+            with tracer.trace('django.middleware', service='django', resource='AuthenticationMiddleware'):
+                pass
+            for _ in range(8):
+                with tracer.trace('postgres.query', service='postgres', span_type='sql') as span:
+                    span.resource = 'SELECT "auth_user"."id" FROM "auth_user" WHERE "auth_user"."id" = %s'
+                    span.set_tag('sql.query', span.resource)
+                    span.set_tag('out.host', 'db.local')
+                    span.set_tag('out.port', '5432')
+                    span.set_tag('db.name', 'app')
+                    span.set_tag('db.user', 'app')
+                    span.set_metric('db.rowcount', 1)
+            with tracer.trace('django.template', service='django', resource='users/detail.html', span_type='template'):
+                pass
+    return tracer.writer.pop_traces()
+
+
+def benchmark_encoders():
+    traces = _django_traces()
+    spans = sum(len(trace) for trace in traces)
+    number = 10
+
+    print("## encode_traces() benchmark: {} spans, {} loops ##".format(spans, number))
+    for encoder in (MsgpackEncoder(), StreamingMsgpackEncoder(), StringTableMsgpackEncoder()):
+        timer = timeit.Timer(lambda: encoder.encode_traces(traces))
+        result = min(timer.repeat(repeat=REPEAT, number=number))
+        print("- {} execution time: {:8.6f} ({:.0f} spans/sec)".format(
+            type(encoder).__name__, result, spans * number / result))
+
+        if tracemalloc:
+            tracemalloc.start()
+            encoder.encode_traces(traces)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            print("- {} peak memory: {} bytes".format(type(encoder).__name__, peak))
+
+        print("- {} payload size: {} bytes".format(type(encoder).__name__, len(encoder.encode_traces(traces))))
+
+
+def benchmark_compression():
+    traces = _django_traces()
+    number = 10
+
+    print("## payload compression benchmark: {} loops ##".format(number))
+    for encoder in (MsgpackEncoder(), StringTableMsgpackEncoder()):
+        data = encoder.encode_traces(traces)
+        for name in ('gzip', 'zstd', 'lz4'):
+            compressor = get_compressor(name)
+            if compressor is None:
+                continue
+            timer = timeit.Timer(lambda: compressor.compress(data))
+            result = min(timer.repeat(repeat=REPEAT, number=number))
+            size = len(compressor.compress(data))
+            print("- {} {} execution time: {:8.6f} ({} -> {} bytes, ratio {:.3f})".format(
+                type(encoder).__name__, name, result, len(data), size, float(size) / len(data)))
+
+
+def _event_loop_lag(writer, duration=3, tick=0.001):
+    # a loop serving small requests, and a timer measuring how late its callbacks run
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    tracer = Tracer()
+    tracer.writer = writer
+    lags = []
+    end = time.time() + duration
+
+    def request():
+        with tracer.trace('aiohttp.request', service='web', resource='GET /users/', span_type='http') as root:
+            root.set_tag('http.status_code', '200')
+            for _ in range(8):
+                with tracer.trace('postgres.query', service='postgres', span_type='sql') as span:
+                    span.set_tag('db.name', 'app')
+        if time.time() < end:
+            loop.call_soon(request)
+
+    def timer(expected):
+        now = loop.time()
+        lags.append(now - expected)
+        if time.time() < end:
+            loop.call_at(now + tick, timer, now + tick)
+        else:
+            loop.stop()
+
+    loop.call_soon(request)
+    loop.call_soon(timer, loop.time())
+    loop.run_forever()
+    if hasattr(writer, 'flush'):
+        loop.run_until_complete(writer.flush(loop))
+    loop.close()
+    asyncio.set_event_loop(None)
+    lags.sort()
+    return lags
+
+
+def benchmark_event_loop_lag():
+    from ddtrace.contrib.asyncio import AsyncioWriter
+    print("## asyncio event loop lag benchmark ##")
+    # the agent runs in another process, so that it doesn't compete for the GIL
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            with StandInAgent() as agent:
+                os.write(write_fd, str(agent.port).encode('utf-8'))
+                time.sleep(3600)
+        finally:
+            os._exit(0)
+    port = int(os.read(read_fd, 16))
+
+    for writer_class in (AgentWriter, AsyncioWriter):
+        writer = writer_class('127.0.0.1', port, flush_interval=0.1)
+        lags = _event_loop_lag(writer)
+        print("- {} lag: p50 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms".format(
+            writer_class.__name__, lags[len(lags) // 2] * 1000, lags[int(len(lags) * 0.99)] * 1000,
+            lags[-1] * 1000))
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+
+def _allocations(create, number=NUMBER):
+    # memory blocks and bytes allocated by each call of ``create``, whose results are kept alive
+    results = []
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    for _ in range(number):
+        results.append(create())
+    blocks = (sys.getallocatedblocks() - blocks) / float(number)
+
+    size = None
+    if tracemalloc:
+        results = []
+        gc.collect()
+        tracemalloc.start()
+        for _ in range(number):
+            results.append(create())
+        size, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        size /= float(number)
+    return blocks, size
+
+
+def benchmark_span_allocations():
+    tracer = get_dummy_tracer()
+
+    def tagged_span():
+        span = Span(tracer=None, name='a', service='s', resource='r')
+        span.set_tag('a', 'b')
+        span.set_metric('b', 1)
+        return span
+
+    def child_span():
+        # the root span gets the pid tag, its children no tags
+        with tracer.trace('child') as span:
+            return span
+
+    cases = [
+        ('span without tags', lambda: Span(tracer=None, name='a', service='s', resource='r')),
+        ('span with a tag and a metric', tagged_span),
+        ('tracer.trace() child span', child_span),
+    ]
+
+    print("## span allocations benchmark: {} spans ##".format(NUMBER))
+    with tracer.trace('root'):
+        for name, create in cases:
+            blocks, size = _allocations(create)
+            print("- {}: {:.1f} blocks{}".format(
+                name, blocks, ", {:.0f} bytes".format(size) if size is not None else ""))
+            timer = timeit.Timer(create)
+            print("- {} creation time: {:8.6f}".format(name, min(timer.repeat(repeat=REPEAT, number=NUMBER))))
+    tracer.writer.pop()
+
+
+def _random_id():
+    # the previous implementation, on the global ``random`` module
+    return random.getrandbits(64)
+
+
+def _threaded_time(func, threads=4, number=NUMBER):
+    # wall time of ``threads`` threads calling ``func`` ``number`` times each
+    def run():
+        for _ in range(number):
+            func()
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - start
+
+
+def benchmark_new_id():
+    print("## span ID generator benchmark: {} loops ##".format(NUMBER))
+    for name, func in (('random.getrandbits', _random_id), ('IdGenerator', new_id)):
+        result = timeit.Timer(func).repeat(repeat=REPEAT, number=NUMBER)
+        print("- {} execution time: {:8.6f}".format(name, min(result)))
+        result = min(_threaded_time(func) for _ in range(REPEAT))
+        print("- {} execution time with 4 threads: {:8.6f}".format(name, result))
+
+
+def _exc_info(depth=10):
+    if depth:
+        return _exc_info(depth - 1)
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        return sys.exc_info()
+
+
+def _format_exception(exc_info):
+    # what set_exc_info() used to do in the traced code
+    buff = StringIO()
+    traceback.print_exception(*exc_info, file=buff, limit=20)
+    return buff.getvalue()
+
+
+def _set_exc_info(exc_info):
+    span = Span(tracer=None, name='test.span')
+    span.set_exc_info(*exc_info)
+    return span
+
+
+def benchmark_set_exc_info():
+    number = NUMBER // 10
+    print("## exception formatting benchmark: {} loops ##".format(number))
+    exc_info = _exc_info()
+    result = timeit.Timer(lambda: _format_exception(exc_info)).repeat(repeat=REPEAT, number=number)
+    print("- formatting in the traced code: {:8.6f}".format(min(result)))
+    result = timeit.Timer(lambda: _set_exc_info(exc_info)).repeat(repeat=REPEAT, number=number)
+    print("- set_exc_info in the traced code: {:8.6f}".format(min(result)))
+    result = timeit.Timer(lambda: _set_exc_info(exc_info).to_dict()).repeat(repeat=REPEAT, number=number)
+    print("- set_exc_info and encoding: {:8.6f}".format(min(result)))
+
+
 if __name__ == '__main__':
     benchmark_tracer_wrap()
     benchmark_tracer_trace()
+    benchmark_tracer_trace_nested()
     benchmark_getpid()
+    benchmark_api_transport()
+    benchmark_encoders()
+    benchmark_compression()
+    benchmark_span_allocations()
+    benchmark_new_id()
+    benchmark_set_exc_info()
+    if asyncio:
+        benchmark_event_loop_lag()
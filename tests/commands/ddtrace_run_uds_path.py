@@ -0,0 +1,9 @@
+from __future__ import print_function
+
+from ddtrace import tracer
+
+from nose.tools import eq_
+
+if __name__ == '__main__':
+    eq_(tracer.writer.api.uds_path, "/var/run/datadog/apm.socket")
+    print("Test success")
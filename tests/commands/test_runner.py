@@ -15,7 +15,8 @@ class DdtraceRunTest(unittest.TestCase):
         """
         Clear DATADOG_* env vars between tests
         """
-        for k in ('DATADOG_ENV', 'DATADOG_TRACE_ENABLED', 'DATADOG_SERVICE_NAME', 'DATADOG_TRACE_DEBUG'):
+        for k in ('DATADOG_ENV', 'DATADOG_TRACE_ENABLED', 'DATADOG_SERVICE_NAME', 'DATADOG_TRACE_DEBUG',
+                  'DATADOG_TRACE_AGENT_UDS_PATH'):
             if k in os.environ:
                 del os.environ[k]
 
@@ -99,6 +100,16 @@ class DdtraceRunTest(unittest.TestCase):
         )
         assert out.startswith(b"Test success")
 
+    def test_uds_path_from_env(self):
+        """
+        DATADOG_TRACE_AGENT_UDS_PATH reports traces through a Unix domain socket
+        """
+        os.environ["DATADOG_TRACE_AGENT_UDS_PATH"] = "/var/run/datadog/apm.socket"
+        out = subprocess.check_output(
+            ['ddtrace-run', 'python', 'tests/commands/ddtrace_run_uds_path.py']
+        )
+        assert out.startswith(b"Test success")
+
     def test_priority_sampling_from_env(self):
         """
         DATADOG_PRIORITY_SAMPLING enables Distributed Sampling
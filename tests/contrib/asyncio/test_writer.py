@@ -0,0 +1,257 @@
+import asyncio
+import gc
+import json
+import mock
+import socket
+import time
+import weakref
+
+from unittest import TestCase
+from nose.tools import eq_, ok_
+
+from ddtrace.contrib.asyncio import context_provider, AsyncioWriter
+from ddtrace.contrib.asyncio.writer import _Flush
+from ddtrace.encoding import JSONEncoder
+from ddtrace.sampler import RateByServiceSampler
+from ddtrace.span import Span
+from ddtrace.tracer import Tracer
+from ddtrace.tracestats import TraceStatsAggregator
+from ddtrace.writer import AgentWriter
+
+from ...util import StandInAgent
+
+
+def _run(loop, fn):
+    """
+    Call ``fn`` from the running ``loop`` and wait for the future it returns.
+    """
+    result = asyncio.Future(loop=loop)
+
+    def call():
+        fn().add_done_callback(lambda future: result.set_result(future.result()))
+
+    loop.call_soon(call)
+    return loop.run_until_complete(result)
+
+
+def _write_in(loop, writer, name):
+    """
+    Write a trace from a callback of ``loop`` and stop it.
+    """
+    loop.call_soon(writer.write, [Span(tracer=None, name=name)])
+    loop.call_soon(loop.stop)
+    loop.run_forever()
+
+
+class AsyncioWriterTests(TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        self.agent = StandInAgent().start()
+        self.addCleanup(self.agent.stop)
+        self.addCleanup(self.loop.close)
+
+    def _writer(self, **kwargs):
+        with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+            return AsyncioWriter(self.agent.hostname, self.agent.port, **kwargs)
+
+    def _names(self, request):
+        return [trace[0]['name'] for trace in json.loads(request[3].decode('utf-8'))]
+
+    def test_flush(self):
+        # traces are buffered in the loop and sent when flushed
+        writer = self._writer(flush_interval=60)
+
+        def write():
+            for i in range(3):
+                writer.write(spans=[Span(tracer=None, name='span.{}'.format(i))])
+            writer.write(services={'web': {'app': 'aiohttp', 'app_type': 'web'}})
+            eq_(writer.stats()['queued_traces'], 3)
+            eq_(self.agent.requests, [])
+            return writer.flush()
+
+        eq_(_run(self.loop, write), 0)
+        paths = [path for _, path, _, _ in self.agent.requests]
+        eq_(paths, ['/v0.3/traces', '/v0.3/services'])
+        eq_(self.agent.requests[0][2]['X-Datadog-Trace-Count'], '3')
+        eq_(self._names(self.agent.requests[0]), ['span.0', 'span.1', 'span.2'])
+        eq_(writer.stats()['queued_traces'], 0)
+
+    def test_flush_size(self):
+        # the buffer is flushed without waiting for the interval once it's full
+        writer = self._writer(flush_interval=60, flush_size=2)
+        done = asyncio.Future(loop=self.loop)
+
+        def write():
+            writer.write(spans=[Span(tracer=None, name='first')])
+            writer.write(spans=[Span(tracer=None, name='second')])
+            # wait for the flush started by the writer itself
+            writer.flush().add_done_callback(lambda _: done.set_result(None))
+
+        self.loop.call_soon(write)
+        self.loop.run_until_complete(done)
+        eq_(len(self.agent.requests), 1)
+        eq_(self._names(self.agent.requests[0]), ['first', 'second'])
+
+    def test_flush_interval(self):
+        writer = self._writer(flush_interval=0.05)
+        self.loop.call_soon(writer.write, [Span(tracer=None, name='first')])
+        deadline = time.time() + 5
+        while not self.agent.requests and time.time() < deadline:
+            self.loop.run_until_complete(asyncio.sleep(0.01))
+        eq_(self._names(self.agent.requests[0]), ['first'])
+
+    def test_encode_batches(self):
+        # large flushes are encoded in many loop iterations, and sent in a single payload
+        writer = self._writer(flush_interval=60)
+
+        def write():
+            for i in range(120):
+                writer.write(spans=[Span(tracer=None, name='span.{}'.format(i))])
+            return writer.flush()
+
+        # a single trace is encoded per loop iteration
+        with mock.patch('ddtrace.contrib.asyncio.writer.ENCODE_TIME_BUDGET', 0):
+            with mock.patch.object(_Flush, '_encode', autospec=True, side_effect=_Flush._encode) as encode:
+                _run(self.loop, write)
+        eq_(encode.call_count, 120)
+        eq_(len(self.agent.requests), 1)
+        eq_(self.agent.requests[0][2]['X-Datadog-Trace-Count'], '120')
+
+    def test_downgrade(self):
+        # traces are encoded again and sent to the previous API version
+        self.agent._server.endpoints = ['/v0.3/traces', '/v0.3/services']
+        writer = self._writer(api_version='v0.4', flush_interval=60)
+
+        def write():
+            writer.write(spans=[Span(tracer=None, name='first')])
+            return writer.flush()
+
+        eq_(_run(self.loop, write), 0)
+        paths = [path for _, path, _, _ in self.agent.requests]
+        eq_(paths, ['/v0.4/traces', '/v0.3/traces'])
+        eq_(self._names(self.agent.requests[1]), ['first'])
+
+    def test_rate_by_service(self):
+        self.agent._server.response = (200, b'{"rate_by_service": {"service:,env:": 0.5}}')
+        sampler = RateByServiceSampler()
+        writer = self._writer(priority_sampler=sampler, flush_interval=60)
+
+        def write():
+            writer.write(spans=[Span(tracer=None, name='first')])
+            return writer.flush()
+
+        _run(self.loop, write)
+        eq_(sampler._by_service_samplers['service:,env:'].sample_rate, 0.5)
+
+    def test_chunked_response(self):
+        # large responses of the agent are chunked
+        rates = dict(('service:web-{},env:'.format(i), 0.5) for i in range(100))
+        with StandInAgent(content=json.dumps({'rate_by_service': rates}).encode('utf-8'), chunked=True) as agent:
+            sampler = RateByServiceSampler()
+            with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+                writer = AsyncioWriter(agent.hostname, agent.port, priority_sampler=sampler, flush_interval=60)
+
+            def write():
+                writer.write(spans=[Span(tracer=None, name='first')])
+                return writer.flush()
+
+            eq_(_run(self.loop, write), 0)
+        eq_(sampler._by_service_samplers['service:web-99,env:'].sample_rate, 0.5)
+
+    def test_closed_loops_collected(self):
+        # the buffers don't keep their loops alive, and the traces left in them are
+        # sent by the flush thread
+        writer = self._writer(flush_interval=60)
+        loops = []
+        with mock.patch.object(writer, '_get_thread_writer') as thread_writer:
+            for i in range(3):
+                loop = asyncio.new_event_loop()
+                _write_in(loop, writer, 'loop.{}'.format(i))
+                loop.close()
+                loops.append(weakref.ref(loop))
+                del loop
+                gc.collect()
+            eq_([loop() for loop in loops], [None, None, None])
+            eq_(len(writer._buffers), 0)
+            _run(self.loop, writer.flush)
+        names = [call[1]['spans'][0].name for call in thread_writer.return_value.write.call_args_list]
+        eq_(sorted(names), ['loop.0', 'loop.1', 'loop.2'])
+        eq_(writer._orphans, [])
+
+    def test_closed_loop_removed(self):
+        # the buffer of a loop closed but still referenced is removed
+        writer = self._writer(flush_interval=60)
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        _write_in(loop, writer, 'closed')
+        loop.close()
+
+        with mock.patch.object(writer, '_get_thread_writer') as thread_writer:
+            _run(self.loop, writer.flush)
+        eq_(list(writer._buffers.keys()), [self.loop])
+        eq_(thread_writer.return_value.write.call_args[1]['spans'][0].name, 'closed')
+
+    def test_agent_unreachable(self):
+        # traces that can't be sent are dropped and accounted
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+            writer = AsyncioWriter('127.0.0.1', port, flush_interval=60)
+
+        def write():
+            writer.write(spans=[Span(tracer=None, name='first')])
+            return writer.flush()
+
+        eq_(_run(self.loop, write), 1)
+        eq_(writer.stats()['dropped_traces'], 1)
+
+    def test_no_loop(self):
+        # traces written outside of an event loop are sent by a flush thread
+        writer = self._writer()
+        writer.write(spans=[Span(tracer=None, name='thread')])
+        ok_(isinstance(writer._thread_writer, AgentWriter))
+        eq_(writer.stats()['queued_traces'], 0)
+        eq_(writer._thread_writer.stats()['queued_traces'], 1)
+        writer._thread_writer._worker.stop()
+        writer._thread_writer._worker.join()
+
+
+class TracerNativeWriterTests(TestCase):
+    def test_configure(self):
+        # the writer of the context provider is used, with the agent settings
+        tracer = Tracer()
+        tracer.configure(hostname='agent', port=8127, compression='gzip')
+        tracer.configure(context_provider=context_provider, native_writer=True)
+        ok_(isinstance(tracer.writer, AsyncioWriter))
+        eq_(tracer.writer.api.hostname, 'agent')
+        eq_(tracer.writer.api.port, 8127)
+        eq_(tracer.writer.api.compression, 'gzip')
+
+        tracer.configure(native_writer=False)
+        ok_(isinstance(tracer.writer, AgentWriter))
+
+    def test_configure_trace_stats(self):
+        # the trace stats are kept and exported by the flush thread of the writer
+        stats = TraceStatsAggregator()
+        tracer = Tracer()
+        tracer.configure(trace_stats=stats)
+        tracer.configure(context_provider=context_provider, native_writer=True)
+        ok_(isinstance(tracer.writer, AsyncioWriter))
+        ok_(tracer.writer.trace_stats is stats)
+
+        with mock.patch('ddtrace.writer.AsyncWorker') as worker:
+            loop = asyncio.new_event_loop()
+            self.addCleanup(loop.close)
+            # nothing is buffered, the flush thread is started anyway
+            loop.call_soon(tracer.writer.write)
+            loop.call_soon(loop.stop)
+            loop.run_forever()
+        eq_(worker.call_args[1]['trace_stats'], stats)
+
+    def test_default_provider(self):
+        # the default provider doesn't have a native writer
+        tracer = Tracer()
+        tracer.configure(native_writer=True)
+        ok_(isinstance(tracer.writer, AgentWriter))
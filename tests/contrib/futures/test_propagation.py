@@ -4,6 +4,7 @@ import concurrent
 from unittest import TestCase
 from nose.tools import eq_, ok_
 
+from ddtrace.context import Context, LockFreeContext
 from ddtrace.contrib.futures import patch, unpatch
 
 from tests.opentracer.utils import init_tracer
@@ -53,6 +54,20 @@ class PropagationTestCase(TestCase):
         eq_(executor.name, 'executor.thread')
         ok_(executor._parent is main)
 
+    def test_propagation_thread_safe(self):
+        # the Context shared by both threads must be thread-safe
+        def fn():
+            return self.tracer.context_provider.active()
+
+        with override_global_tracer(self.tracer):
+            ctx = LockFreeContext()
+            self.tracer.context_provider.activate(ctx)
+            with self.tracer.trace('main.thread'):
+                ok_(type(ctx) is LockFreeContext)
+                with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+                    ok_(executor.submit(fn).result() is ctx)
+                ok_(type(ctx) is Context)
+
     def test_propagation_with_params(self):
         # instrumentation must proxy arguments if available
 
@@ -3,7 +3,7 @@ import gevent.pool
 import ddtrace
 
 from ddtrace.constants import SAMPLING_PRIORITY_KEY
-from ddtrace.context import Context
+from ddtrace.context import Context, LockFreeContext
 from ddtrace.contrib.gevent import patch, unpatch
 from ddtrace.ext.priority import USER_KEEP
 
@@ -50,6 +50,8 @@ class TestGeventTracer(TestCase):
         ctx_greenlet = getattr(main_greenlet, '__datadog_context', None)
         ok_(ctx_tracer is ctx_greenlet)
         eq_(len(ctx_tracer._trace), 0)
+        # the greenlets of a hub run in the same thread, so the Context isn't locked
+        ok_(isinstance(ctx_tracer, LockFreeContext))
 
     def test_get_call_context(self):
         # it should return the context attached to the provider
@@ -0,0 +1,156 @@
+import gevent
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import ddtrace
+
+from ddtrace.contrib.gevent import patch, unpatch, GeventWriter
+from ddtrace.contrib.gevent.writer import GeventQ, GeventWorker
+from ddtrace.encoding import JSONEncoder
+from ddtrace.span import Span
+from ddtrace.tracer import Tracer
+from ddtrace.writer import AgentWriter
+
+from unittest import TestCase
+from nose.tools import eq_, ok_
+from tests.test_tracer import get_dummy_tracer
+from tests.util import StandInAgent
+
+
+def _wait_for(condition, timeout=5):
+    # yield to the other greenlets until the condition is true
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        gevent.sleep(0.01)
+
+
+class GeventWriterTests(TestCase):
+    def setUp(self):
+        self.agent = StandInAgent().start()
+        self.addCleanup(self.agent.stop)
+
+    def _writer(self, **kwargs):
+        with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+            writer = GeventWriter(self.agent.hostname, self.agent.port, **kwargs)
+        self.addCleanup(writer.api.close)
+        return writer
+
+    def _stop(self, writer):
+        writer._worker.stop()
+        writer._worker.join()
+
+    def test_flush(self):
+        # traces are flushed by a greenlet
+        writer = self._writer(flush_interval=60)
+        writer.write(spans=[Span(tracer=None, name='first')])
+        writer.write(services={'web': {'app': 'flask', 'app_type': 'web'}})
+        ok_(isinstance(writer._worker, GeventWorker))
+        ok_(isinstance(writer._traces, GeventQ))
+        ok_(isinstance(writer._worker._thread, gevent.Greenlet))
+
+        self._stop(writer)
+        paths = [path for _, path, _, _ in self.agent.requests]
+        eq_(paths, ['/v0.3/traces', '/v0.3/services'])
+        eq_(self.agent.requests[0][2]['X-Datadog-Trace-Count'], '1')
+
+    def _started(self, **kwargs):
+        # a writer whose worker has already sent its first trace and waits for the next flush
+        writer = self._writer(**kwargs)
+        writer.write(spans=[Span(tracer=None, name='first')])
+        _wait_for(lambda: self.agent.requests)
+        eq_(len(self.agent.requests), 1)
+        return writer
+
+    def test_wait_cooperative(self):
+        # the worker waiting for the next flush doesn't block the other greenlets
+        writer = self._started(flush_interval=60)
+        writer.write(spans=[Span(tracer=None, name='second')])
+        start = time.time()
+        gevent.spawn(lambda: None).join()
+        gevent.sleep(0.05)
+        ok_(time.time() - start < 1)
+        ok_(writer._worker.is_alive())
+        eq_(len(self.agent.requests), 1)
+        self._stop(writer)
+        eq_(len(self.agent.requests), 2)
+
+    def test_flush_size(self):
+        # the worker is woken up as soon as the queue is full
+        writer = self._started(flush_interval=60, flush_size=2)
+        writer.write(spans=[Span(tracer=None, name='second')])
+        gevent.sleep(0.05)
+        eq_(len(self.agent.requests), 1)
+        writer.write(spans=[Span(tracer=None, name='third')])
+        _wait_for(lambda: len(self.agent.requests) > 1)
+        eq_(self.agent.requests[1][2]['X-Datadog-Trace-Count'], '2')
+        self._stop(writer)
+
+    def _write_from_thread(self, writer, name):
+        # write from a thread that isn't monkey patched, whose hub never runs
+        thread = threading.Thread(target=writer.write, kwargs={'spans': [Span(tracer=None, name=name)]})
+        thread.start()
+        thread.join()
+
+    def test_write_from_thread(self):
+        # the greenlet is spawned in the hub of the writer when a thread writes first
+        writer = self._writer(flush_interval=0.05)
+        self._write_from_thread(writer, 'first')
+        _wait_for(lambda: self.agent.requests)
+        eq_(len(self.agent.requests), 1)
+        eq_(writer._worker._thread.parent, gevent.get_hub())
+        self._stop(writer)
+
+    def test_flush_size_from_thread(self):
+        # the worker is woken up through its hub when a thread fills the queue
+        writer = self._started(flush_interval=60, flush_size=2)
+        self._write_from_thread(writer, 'second')
+        self._write_from_thread(writer, 'third')
+        _wait_for(lambda: len(self.agent.requests) > 1)
+        eq_(self.agent.requests[1][2]['X-Datadog-Trace-Count'], '2')
+        self._stop(writer)
+
+    def test_uds(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'apm.socket')
+        with StandInAgent(uds_path=path) as agent:
+            with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+                writer = GeventWriter(uds_path=path, flush_interval=60)
+            writer.write(spans=[Span(tracer=None, name='first')])
+            self._stop(writer)
+            writer.api.close()
+            eq_(len(agent.requests), 1)
+
+
+class GeventPatchWriterTests(TestCase):
+    def setUp(self):
+        self._original_tracer = ddtrace.tracer
+
+    def tearDown(self):
+        unpatch()
+        ddtrace.tracer = self._original_tracer
+
+    def test_patch(self):
+        # the gevent writer is opted in with the gevent context provider
+        ddtrace.tracer = Tracer()
+        ddtrace.tracer.configure(hostname='agent', port=8127)
+        patch()
+        ok_(type(ddtrace.tracer.writer) is AgentWriter)
+        ddtrace.tracer.configure(native_writer=True)
+        ok_(isinstance(ddtrace.tracer.writer, GeventWriter))
+        eq_(ddtrace.tracer.writer.api.hostname, 'agent')
+        eq_(ddtrace.tracer.writer.api.port, 8127)
+
+        unpatch()
+        ok_(type(ddtrace.tracer.writer) is AgentWriter)
+
+    def test_patch_custom_writer(self):
+        # a writer set by the user is kept
+        ddtrace.tracer = get_dummy_tracer()
+        writer = ddtrace.tracer.writer
+        patch()
+        ok_(ddtrace.tracer.writer is writer)
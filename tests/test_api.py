@@ -1,12 +1,19 @@
 import mock
+import msgpack
 import warnings
 
 from unittest import TestCase
 from nose.tools import eq_, ok_
 
+from json import loads
+
 from tests.test_tracer import get_dummy_tracer
+from tests.util import StandInAgent
 from ddtrace.api import _parse_response_json, API
 from ddtrace.compat import iteritems, httplib
+from ddtrace.encoding import JSONEncoder
+from ddtrace.span import Span
+from ddtrace.tracer import Tracer
 
 class ResponseMock:
     def __init__(self, content):
@@ -87,3 +94,160 @@ class APITests(TestCase):
 
         self.conn.request.assert_called_once()
         self.conn.close.assert_called_once()
+
+
+class APIChunkingTests(TestCase):
+    def _traces(self, count):
+        # fixed ids so that all traces have the same encoded size
+        return [
+            [
+                Span(tracer=None, name='client.testing', trace_id=1, span_id=1, start=1),
+                Span(tracer=None, name='client.testing.child', trace_id=1, span_id=2, parent_id=1, start=1),
+            ]
+            for _ in range(count)
+        ]
+
+    def test_encode_traces_chunks(self):
+        # traces are split in payloads smaller than the max payload size
+        traces = self._traces(10)
+        encoder = JSONEncoder()
+        trace_size = len(encoder.encode_trace(traces[0]))
+        max_payload_size = 3 * trace_size + 8
+        api = API('localhost', 8126, encoder=encoder, max_payload_size=max_payload_size)
+
+        payloads = api.encode_traces(traces)
+        eq_([p.count for p in payloads], [3, 3, 3, 1])
+        for payload in payloads:
+            ok_(len(payload.data) <= max_payload_size)
+            eq_(len(loads(payload.data)), payload.count)
+
+    def test_encode_traces_large_trace(self):
+        # a trace larger than the max payload size is sent alone
+        traces = self._traces(3)
+        api = API('localhost', 8126, encoder=JSONEncoder(), max_payload_size=1)
+        eq_([p.count for p in api.encode_traces(traces)], [1, 1, 1])
+
+    def test_send_traces_chunks(self):
+        # each chunk is sent with its own trace count
+        traces = self._traces(10)
+        encoder = JSONEncoder()
+        trace_size = len(encoder.encode_trace(traces[0]))
+        with StandInAgent() as agent:
+            api = API(agent.hostname, agent.port, encoder=encoder, max_payload_size=4 * trace_size + 9)
+            response = api.send_traces(traces)
+            api.close()
+
+            eq_(response.status, 200)
+            requests = agent.requests
+            eq_(len(requests), 3)
+            for _, path, headers, body in requests:
+                eq_(path, '/v0.3/traces')
+                eq_(headers['X-Datadog-Trace-Count'], str(len(loads(body.decode('utf-8')))))
+            eq_(sum(int(headers['X-Datadog-Trace-Count']) for _, _, headers, _ in requests), 10)
+
+    def test_send_traces_chunks_downgrade(self):
+        # the API is downgraded once and each chunk is sent again to the fallback endpoint
+        traces = self._traces(4)
+        encoder = JSONEncoder()
+        trace_size = len(encoder.encode_trace(traces[0]))
+        with StandInAgent(endpoints=['/v0.2/traces']) as agent:
+            api = API(agent.hostname, agent.port, encoder=encoder, max_payload_size=2 * trace_size + 7)
+            response = api.send_traces(traces)
+            api.close()
+
+            eq_(response.status, 200)
+            paths = [path for _, path, _, _ in agent.requests]
+            eq_(paths, ['/v0.3/traces', '/v0.2/traces', '/v0.2/traces'])
+            eq_([headers['X-Datadog-Trace-Count'] for _, _, headers, _ in agent.requests], ['2', '2', '2'])
+
+    def test_join_traces(self):
+        # traces encoded ahead of time are joined in chunks
+        traces = self._traces(10)
+        encoder = JSONEncoder()
+        encoded = [encoder.encode_trace(trace) for trace in traces]
+        api = API('localhost', 8126, encoder=encoder, max_payload_size=3 * len(encoded[0]) + 8)
+
+        payloads = api.join_traces(encoded)
+        eq_([p.count for p in payloads], [3, 3, 3, 1])
+        eq_([p.traces for p in payloads], [None] * 4)
+        eq_(loads(payloads[0].data), loads(encoder.encode_traces(traces[:3])))
+
+    def test_send_joined_traces_downgrade(self):
+        # traces encoded ahead of time are sent again if the fallback encoder is the same
+        traces = self._traces(2)
+        encoder = JSONEncoder()
+        with StandInAgent(endpoints=['/v0.2/traces']) as agent:
+            api = API(agent.hostname, agent.port, encoder=encoder)
+            payload = api.join_traces([encoder.encode_trace(trace) for trace in traces])[0]
+            response = api.send_payload(payload)
+            api.close()
+
+            eq_(response.status, 200)
+            eq_([path for _, path, _, _ in agent.requests], ['/v0.3/traces', '/v0.2/traces'])
+            eq_(agent.requests[1][3], agent.requests[0][3])
+
+    def test_send_traces_chunks_error(self):
+        # the response of a failed chunk is returned
+        traces = self._traces(2)
+        with StandInAgent(status=500) as agent:
+            api = API(agent.hostname, agent.port, encoder=JSONEncoder(), max_payload_size=1)
+            response = api.send_traces(traces)
+            api.close()
+
+            eq_(response.status, 500)
+            eq_(len(agent.requests), 2)
+
+
+class APIStringTableTests(TestCase):
+    def setUp(self):
+        # the v0.5 API requires msgpack; the pure Python implementation is enough for testing
+        patcher = mock.patch('ddtrace.api.MSGPACK_ENCODING', True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_send_traces(self):
+        # traces are sent to the v0.5 endpoint with a string table
+        tracer = get_dummy_tracer()
+        tracer.trace('client.testing').finish()
+        with StandInAgent(endpoints=['/v0.5/traces']) as agent:
+            api = API(agent.hostname, agent.port, version='v0.5')
+            response = api.send_traces([tracer.writer.pop()])
+            api.close()
+
+            eq_(response.status, 200)
+            _, path, headers, body = agent.requests[0]
+            eq_(path, '/v0.5/traces')
+            eq_(headers['Content-Type'], 'application/msgpack')
+            strings, traces = msgpack.unpackb(body, encoding='utf-8')
+            eq_(strings[traces[0][0][1]], 'client.testing')
+
+    def test_downgrade(self):
+        # older agents are detected and traces are sent again to the v0.4 endpoint
+        tracer = get_dummy_tracer()
+        tracer.trace('client.testing').finish()
+        with StandInAgent(endpoints=['/v0.4/traces', '/v0.4/services']) as agent:
+            api = API(agent.hostname, agent.port, version='v0.5')
+            response = api.send_traces([tracer.writer.pop()])
+            eq_(response.status, 200)
+            response = api.send_services([{'client.service': {'app': 'django', 'app_type': 'web'}}])
+            eq_(response.status, 200)
+            api.close()
+
+            eq_([path for _, path, _, _ in agent.requests], ['/v0.5/traces', '/v0.4/traces', '/v0.4/services'])
+            eq_(agent.requests[1][2]['X-Datadog-Trace-Count'], '1')
+
+    def test_msgpack_not_available(self):
+        # without msgpack, the v0.4 API is used
+        with mock.patch('ddtrace.api.MSGPACK_ENCODING', False), mock.patch('ddtrace.api.log') as log:
+            api = API('localhost', 8126, version='v0.5')
+        eq_(api._traces, '/v0.4/traces')
+        # and the downgrade is logged
+        eq_(log.warning.call_count, 1)
+
+    def test_tracer_configure(self):
+        # the API version is kept when the tracer is reconfigured
+        tracer = Tracer()
+        tracer.configure(api_version='v0.5')
+        eq_(tracer.writer.api._traces, '/v0.5/traces')
+        tracer.configure(priority_sampling=True)
+        eq_(tracer.writer.api._traces, '/v0.5/traces')
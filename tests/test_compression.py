@@ -0,0 +1,113 @@
+import gzip
+import io
+import json
+import mock
+
+from unittest import TestCase, skipUnless
+from nose.tools import eq_, ok_
+
+from ddtrace import compression
+from ddtrace.api import API
+from ddtrace.compression import get_compressor, GzipCompressor
+from ddtrace.encoding import JSONEncoder
+from ddtrace.tracer import Tracer
+
+from .test_tracer import get_dummy_tracer
+from .util import StandInAgent
+
+
+def _gunzip(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+def _traces(count=50):
+    # requests of a web application running a few SQL queries
+    tracer = get_dummy_tracer()
+    for i in range(count):
+        with tracer.trace('django.request', service='django', resource='app.views.UserView', span_type='http') as root:
+            root.set_tag('http.url', '/users/{}/'.format(i))
+            root.set_tag('http.status_code', '200')
+            for _ in range(5):
+                with tracer.trace('postgres.query', service='postgres', span_type='sql') as span:
+                    span.resource = 'SELECT "auth_user"."id" FROM "auth_user" WHERE "auth_user"."id" = %s'
+                    span.set_tag('out.host', 'db.local')
+                    span.set_tag('db.name', 'app')
+    return tracer.writer.pop_traces()
+
+
+class CompressionTests(TestCase):
+    def test_get_compressor(self):
+        eq_(get_compressor(None), None)
+        eq_(get_compressor(''), None)
+        ok_(isinstance(get_compressor('gzip'), GzipCompressor))
+        eq_(get_compressor('gzip', level=1).level, 1)
+        with self.assertRaises(ValueError):
+            get_compressor('brotli')
+
+    def test_get_compressor_not_available(self):
+        # payloads are not compressed if the library is not installed
+        with mock.patch.object(compression, 'zstandard', None):
+            eq_(get_compressor('zstd'), None)
+        with mock.patch.object(compression, 'lz4_frame', None):
+            eq_(get_compressor('lz4'), None)
+
+    def test_gzip(self):
+        data = b'{"name": "client.testing"}' * 10
+        eq_(_gunzip(GzipCompressor().compress(data)), data)
+
+    @skipUnless(compression.zstandard, 'zstandard is not installed')
+    def test_zstd(self):
+        data = b'{"name": "client.testing"}' * 10
+        compressed = get_compressor('zstd').compress(data)
+        eq_(compression.zstandard.ZstdDecompressor().decompress(compressed), data)
+
+    @skipUnless(compression.lz4_frame, 'lz4 is not installed')
+    def test_lz4(self):
+        data = b'{"name": "client.testing"}' * 10
+        compressed = get_compressor('lz4').compress(data)
+        eq_(compression.lz4_frame.decompress(compressed), data)
+
+
+class APICompressionTests(TestCase):
+    def test_send_traces(self):
+        # payloads are compressed and the trace agent receives the same traces
+        traces = _traces()
+        encoder = JSONEncoder()
+        raw = encoder.encode_traces(traces).encode('utf-8')
+        with StandInAgent() as agent:
+            api = API(agent.hostname, agent.port, encoder=encoder, compression='gzip')
+            response = api.send_traces(traces)
+            api.close()
+
+            eq_(response.status, 200)
+            _, _, headers, body = agent.requests[0]
+            eq_(headers['Content-Encoding'], 'gzip')
+            eq_(headers['Content-Type'], 'application/json')
+            eq_(headers['X-Datadog-Trace-Count'], '50')
+            eq_(json.loads(_gunzip(body).decode('utf-8')), json.loads(raw.decode('utf-8')))
+
+            # the repeated strings of a flush compress well
+            ratio = float(len(body)) / len(raw)
+            ok_(ratio < 0.1, 'unexpected compression ratio: {:.3f}'.format(ratio))
+
+    def test_threshold(self):
+        # small payloads are sent uncompressed
+        with StandInAgent() as agent:
+            api = API(agent.hostname, agent.port, encoder=JSONEncoder(), compression='gzip',
+                      compression_threshold=100)
+            api.send_services([{'client.service': {'app': 'django', 'app_type': 'web'}}])
+            api._put('/v0.3/traces', b'[]' * 50, 1)
+            api.close()
+
+            eq_([headers.get('Content-Encoding') for _, _, headers, _ in agent.requests], [None, 'gzip'])
+            eq_(_gunzip(agent.requests[1][3]), b'[]' * 50)
+
+    def test_tracer_configure(self):
+        # the compression is kept when the tracer is reconfigured
+        tracer = Tracer()
+        tracer.configure(compression='gzip')
+        eq_(tracer.writer.api.compression, 'gzip')
+        tracer.configure(priority_sampling=True)
+        eq_(tracer.writer.api.compression, 'gzip')
+        tracer.configure(compression='')
+        eq_(tracer.writer.api._compressor, None)
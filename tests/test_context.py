@@ -1,12 +1,14 @@
 import mock
+import sys
 import threading
 
 from unittest import TestCase
 from nose.tools import eq_, ok_
 from tests.test_tracer import get_dummy_tracer
 
+from ddtrace.constants import SAMPLING_PRIORITY_KEY
 from ddtrace.span import Span
-from ddtrace.context import Context, ThreadLocalContext
+from ddtrace.context import Context, LockFreeContext, ThreadLocalContext
 from ddtrace.ext.priority import USER_REJECT, AUTO_REJECT, AUTO_KEEP, USER_KEEP
 
 
@@ -92,6 +94,40 @@ class TestTracingContext(TestCase):
         ok_(ctx._current_span is None)
         ok_(ctx._sampled is True)
 
+    def test_get_partial(self):
+        # the finished spans are returned once there are enough of them
+        ctx = Context(sampling_priority=AUTO_KEEP)
+        root = Span(tracer=None, name='root')
+        ctx.add_span(root)
+        children = []
+        for _ in range(3):
+            child = Span(tracer=None, name='child', trace_id=root.trace_id, parent_id=root.span_id)
+            child._parent = root
+            ctx.add_span(child)
+            children.append(child)
+        for child in children[:2]:
+            child._finished = True
+            ctx.close_span(child)
+        eq_(ctx.get_partial(3), (None, None))
+
+        trace, sampled = ctx.get_partial(2)
+        eq_(trace, children[:2])
+        ok_(sampled is True)
+        eq_(ctx._trace, [root, children[2]])
+        eq_(ctx._finished_spans, 0)
+        ok_(ctx._current_span is root)
+        # the first span of each chunk has the sampling priority
+        eq_(children[0].get_metric(SAMPLING_PRIORITY_KEY), AUTO_KEEP)
+        eq_(children[1].get_metric(SAMPLING_PRIORITY_KEY), None)
+
+        # the last chunk is returned once the trace is finished, whatever its size
+        for span in (children[2], root):
+            span._finished = True
+            ctx.close_span(span)
+        eq_(ctx.get_partial(10), ([root, children[2]], True))
+        eq_(root.get_metric(SAMPLING_PRIORITY_KEY), AUTO_KEEP)
+        eq_(ctx._trace, [])
+
     def test_get_trace_empty(self):
         # it should return None if the Context is not finished
         ctx = Context()
@@ -203,6 +239,32 @@ class TestTracingContext(TestCase):
 
         eq_(100, len(ctx._trace))
 
+    def test_finish_from_other_threads(self):
+        # spans finished by other threads, e.g. in the callbacks of a driver,
+        # while the owner thread keeps tracing, must not be lost
+        tracer = get_dummy_tracer()
+        if hasattr(sys, 'setswitchinterval'):
+            # switch threads as often as possible to expose races
+            self.addCleanup(sys.setswitchinterval, sys.getswitchinterval())
+            sys.setswitchinterval(1e-6)
+        for _ in range(20):
+            root = tracer.trace('root')
+            spans = [tracer.start_span('query', child_of=root) for _ in range(50)]
+            threads = [threading.Thread(target=span.finish) for span in spans]
+            for t in threads:
+                t.start()
+            for _ in range(50):
+                with tracer.trace('local'):
+                    pass
+            for t in threads:
+                t.join()
+            root.finish()
+
+            traces = tracer.writer.pop_traces()
+            eq_(len(traces), 1)
+            eq_(len(traces[0]), 101)
+            eq_(tracer.get_call_context()._trace, [])
+
     def test_clone(self):
         ctx = Context()
         ctx.sampling_priority = 2
@@ -222,6 +284,55 @@ class TestTracingContext(TestCase):
         eq_(cloned_ctx._finished_spans, 0)
 
 
+class TestLockFreeContext(TestCase):
+    """
+    Tests related to the ``LockFreeContext`` used by a single execution flow.
+    """
+    def test_trace(self):
+        # it behaves as a Context, without taking the lock
+        ctx = LockFreeContext(sampling_priority=AUTO_KEEP)
+        ctx._lock = mock.Mock()
+        root = Span(tracer=None, name='root')
+        ctx.add_span(root)
+        child = Span(tracer=None, name='child', trace_id=root.trace_id, parent_id=root.span_id)
+        child._parent = root
+        ctx.add_span(child)
+        eq_(ctx.trace_id, root.trace_id)
+        eq_(ctx.span_id, child.span_id)
+        ok_(ctx.get_current_span() is child)
+        ok_(ctx.is_sampled())
+
+        ctx.close_span(child)
+        ok_(not ctx.is_finished())
+        eq_(ctx.get(), (None, None))
+        ctx.close_span(root)
+        ok_(ctx.is_finished())
+        eq_(ctx.get(), ([root, child], True))
+        eq_(root.get_metric(SAMPLING_PRIORITY_KEY), AUTO_KEEP)
+        eq_(ctx._trace, [])
+        eq_(ctx._lock.method_calls, [])
+
+    def test_clone(self):
+        ctx = LockFreeContext()
+        ctx.add_span(Span(tracer=None, name='root'))
+        cloned_ctx = ctx.clone()
+        ok_(isinstance(cloned_ctx, LockFreeContext))
+        eq_(cloned_ctx._current_span, ctx._current_span)
+        # a thread-safe Context is cloned as a thread-safe Context
+        ok_(type(Context().clone()) is Context)
+
+    def test_make_thread_safe(self):
+        # the Context keeps its state once it's thread-safe
+        ctx = LockFreeContext()
+        span = Span(tracer=None, name='root')
+        ctx.add_span(span)
+        ok_(ctx._make_thread_safe() is ctx)
+        ok_(type(ctx) is Context)
+        ok_(ctx.get_current_span() is span)
+        ctx.close_span(span)
+        eq_(ctx.get(), ([span], True))
+
+
 class TestThreadContext(TestCase):
     """
     Ensures that a ``ThreadLocalContext`` makes the Context
@@ -232,6 +343,8 @@ class TestThreadContext(TestCase):
         # always the same instance
         l_ctx = ThreadLocalContext()
         eq_(l_ctx.get(), l_ctx.get())
+        # other threads may use the Context, e.g. to finish spans in callbacks
+        ok_(type(l_ctx.get()) is Context)
 
     def test_set_context(self):
         # the Context can be set in the current Thread
@@ -6,7 +6,9 @@ from nose.tools import eq_, ok_
 
 from ddtrace.span import Span
 from ddtrace.compat import msgpack_type, string_type
-from ddtrace.encoding import JSONEncoder, MsgpackEncoder
+from ddtrace.encoding import (
+    JSONEncoder, MsgpackEncoder, StreamingMsgpackEncoder, StringTable, StringTableMsgpackEncoder
+)
 
 
 class TestEncoders(TestCase):
@@ -64,3 +66,168 @@ class TestEncoders(TestCase):
         for i in range(2):
             for j in range(2):
                 eq_(b'client.testing', items[i][j][b'name'])
+
+    def test_join_encoded_json(self):
+        # traces encoded one by one can be joined in a single payload
+        traces = [
+            [Span(name='client.testing', tracer=None), Span(name='client.testing', tracer=None)],
+            [Span(name='client.testing', tracer=None)],
+        ]
+
+        encoder = JSONEncoder()
+        payload = encoder.join_encoded([encoder.encode_trace(trace) for trace in traces])
+        eq_(json.loads(payload), json.loads(encoder.encode_traces(traces)))
+        eq_(json.loads(encoder.join_encoded([])), [])
+
+    def test_join_encoded_msgpack(self):
+        # traces encoded one by one can be joined in a single payload
+        traces = [
+            [Span(name='client.testing', tracer=None), Span(name='client.testing', tracer=None)],
+            [Span(name='client.testing', tracer=None)],
+        ]
+
+        encoder = MsgpackEncoder()
+        payload = encoder.join_encoded([encoder.encode_trace(trace) for trace in traces])
+        eq_(msgpack.unpackb(payload), msgpack.unpackb(encoder.encode_traces(traces)))
+        eq_(msgpack.unpackb(encoder.join_encoded([])), [])
+
+    def test_encode_traces_streaming_msgpack(self):
+        # the streaming encoder output is the same as the MsgpackEncoder one
+        full = Span(name='client.testing', service='s', resource='r', span_type='web', tracer=None)
+        full.set_tag('component', 'django')
+        full.set_metric('rows', 42)
+        full.error = True
+        full.finish()
+        traces = [
+            [full, Span(name='client.testing', tracer=None)],
+            [Span(name='client.testing', tracer=None)],
+        ]
+
+        encoder = StreamingMsgpackEncoder()
+        expected = MsgpackEncoder()
+        spans = encoder.encode_traces(traces)
+        ok_(isinstance(spans, msgpack_type))
+        eq_(msgpack.unpackb(spans), msgpack.unpackb(expected.encode_traces(traces)))
+        eq_(msgpack.unpackb(encoder.encode_trace(traces[0])), msgpack.unpackb(expected.encode_trace(traces[0])))
+        eq_(msgpack.unpackb(spans)[0][0][b'error'], 1)
+
+        # the buffer is reset between calls
+        eq_(msgpack.unpackb(encoder.encode_traces([])), [])
+        eq_(msgpack.unpackb(encoder.encode_traces(traces)), msgpack.unpackb(spans))
+
+
+class TestStringTableEncoder(TestCase):
+    """
+    Ensures that the v0.5 encoder sends each string once per payload.
+    """
+    def _decode(self, data):
+        strings, traces = msgpack.unpackb(data, encoding='utf-8')
+        return strings, traces
+
+    def test_encode_traces(self):
+        span = Span(name='postgres.query', service='db', resource='SELECT 1', span_type='sql', tracer=None)
+        span.set_tag('sql.db', 'db')
+        span.set_metric('sql.rows', 2)
+        span.error = True
+        span.finish()
+        child = Span(name='postgres.query', service='db', resource='SELECT 1', parent_id=span.span_id, tracer=None)
+        traces = [[span, child], [Span(name='postgres.query', tracer=None)]]
+
+        encoder = StringTableMsgpackEncoder()
+        strings, items = self._decode(encoder.encode_traces(traces))
+
+        # repeated strings are only sent once
+        eq_(strings, ['', 'db', 'postgres.query', 'SELECT 1', 'sql.db', 'sql.rows', 'sql'])
+        eq_(len(items), 2)
+        eq_([len(trace) for trace in items], [2, 1])
+
+        fields = items[0][0]
+        eq_(len(fields), 12)
+        eq_([strings[i] for i in fields[:3]], ['db', 'postgres.query', 'SELECT 1'])
+        eq_(fields[3:6], [span.trace_id, span.span_id, 0])
+        eq_(fields[6], span.start_ns)
+        eq_(fields[7], span.duration_ns)
+        eq_(fields[8], 1)
+        eq_(dict((strings[k], strings[v]) for k, v in fields[9].items()), {'sql.db': 'db'})
+        eq_(dict((strings[k], v) for k, v in fields[10].items()), {'sql.rows': 2})
+        eq_(strings[fields[11]], 'sql')
+
+        # unset fields use the empty string and zero
+        fields = items[1][0]
+        eq_(fields[0], 0)
+        eq_(fields[7:], [0, 0, {}, {}, 0])
+
+    def test_encode_chunks(self):
+        # each chunk has its own string table and is smaller than the max size
+        traces = [
+            [Span(name='name.{}'.format(i), resource='resource.{}'.format(i), tracer=None)]
+            for i in range(10)
+        ]
+        encoder = StringTableMsgpackEncoder()
+        single = len(encoder.encode_traces(traces[:1]))
+        max_size = 3 * single
+
+        chunks = encoder.encode_chunks(traces, max_size)
+        ok_(len(chunks) > 1)
+        eq_(sum(len(chunk) for _, chunk in chunks), 10)
+        for data, chunk in chunks:
+            ok_(len(data) <= max_size)
+            eq_(data, encoder.encode_traces(chunk))
+            strings, items = self._decode(data)
+            eq_(len(strings), 1 + 2 * len(chunk))
+            eq_(len(items), len(chunk))
+
+    def _resolve(self, data):
+        # replace the indexes in the string table with the strings
+        strings, traces = self._decode(data)
+        return [
+            [
+                [strings[fields[0]], strings[fields[1]], strings[fields[2]]] + fields[3:9] + [
+                    dict((strings[k], strings[v]) for k, v in fields[9].items()),
+                    dict((strings[k], v) for k, v in fields[10].items()),
+                    strings[fields[11]],
+                ]
+                for fields in trace
+            ]
+            for trace in traces
+        ]
+
+    def test_join_encoded(self):
+        # traces encoded one by one are joined with a merged string table
+        span = Span(name='postgres.query', service='db', resource='SELECT 1', span_type='sql', tracer=None)
+        span.set_tag('sql.db', 'db')
+        span.set_metric('sql.rows', 2)
+        traces = [
+            [span, Span(name='postgres.query', service='db', parent_id=span.span_id, tracer=None)],
+            [Span(name='redis.command', service='cache', resource='GET', tracer=None)],
+            [Span(name='postgres.query', service='db', resource='SELECT 2', tracer=None)],
+        ]
+
+        encoder = StringTableMsgpackEncoder()
+        joined = encoder.join_encoded([encoder.encode_trace(trace) for trace in traces])
+        eq_(self._resolve(joined), self._resolve(encoder.encode_traces(traces)))
+        strings, _ = self._decode(joined)
+        eq_(len(strings), len(set(strings)))
+
+        # and in chunks, as the traces of a shared buffer
+        chunks = encoder.join_chunks([encoder.encode_trace(trace) for trace in traces], 1 << 20)
+        eq_([count for _, count in chunks], [3])
+        eq_(self._resolve(chunks[0][0]), self._resolve(joined))
+
+    def test_string_table(self):
+        table = StringTable()
+        eq_(table.index(None), 0)
+        eq_(table.index(''), 0)
+        eq_(table.index('a'), 1)
+        eq_(table.index('a'), 1)
+        eq_(table.index(42), 2)
+        eq_(list(table), ['', 'a', '42'])
+        eq_(table.size, len(msgpack.packb(list(table), use_bin_type=True)) - 1)
+
+        # strings added after a mark can be removed
+        mark = table.mark()
+        table.index('b' * 40)
+        eq_(table.size, len(msgpack.packb(list(table), use_bin_type=True)) - 1)
+        table.rollback(mark)
+        eq_(list(table), ['', 'a', '42'])
+        eq_(table.index('b'), 3)
@@ -0,0 +1,138 @@
+import mock
+
+from unittest import TestCase
+from nose.tools import eq_, ok_
+
+from ddtrace.encoding import JSONEncoder
+from ddtrace.endpoints import AgentEndpoint, AgentPool, ROUTING_ROUND_ROBIN
+from ddtrace.span import Span
+from ddtrace.utils.retry import CircuitBreaker, RetryPolicy
+from ddtrace.writer import AgentWriter
+
+from .util import StandInAgent
+
+
+def _endpoint(name, weight=1, **kwargs):
+    api = mock.Mock(hostname=name, port=8126, uds_path=None)
+    return AgentEndpoint(api, CircuitBreaker(**kwargs), weight)
+
+
+class AgentPoolTests(TestCase):
+    def test_failover(self):
+        # payloads go to the first available agent
+        primary, secondary = _endpoint('primary', failure_threshold=1), _endpoint('secondary')
+        pool = AgentPool([primary, secondary])
+        ok_(pool.select() is primary)
+        ok_(pool.select(avoid=primary) is secondary)
+
+        primary.circuit_breaker.record_failure()
+        ok_(pool.select() is secondary)
+        ok_(pool.healthy())
+        ok_(pool.healthy_endpoint() is secondary)
+
+        for _ in range(5):
+            secondary.circuit_breaker.record_failure()
+        eq_(pool.select(), None)
+        ok_(not pool.healthy())
+
+    def test_round_robin(self):
+        # payloads are spread in proportion to the weights, without bursts
+        first, second = _endpoint('first', weight=3), _endpoint('second')
+        pool = AgentPool([first, second], routing=ROUTING_ROUND_ROBIN)
+        names = [pool.select().api.hostname for _ in range(8)]
+        eq_(names, ['first', 'first', 'second', 'first'] * 2)
+
+    def test_probe(self):
+        # an agent whose circuit is half-open is probed before it's used again
+        primary, secondary = _endpoint('primary', failure_threshold=1, reset_timeout=0), _endpoint('secondary')
+        pool = AgentPool([primary, secondary])
+        primary.circuit_breaker.record_failure()
+        primary.api.probe.return_value = mock.Mock(status=500)
+        ok_(pool.select() is secondary)
+        primary.api.probe.return_value = mock.Mock(status=200)
+        ok_(pool.select() is primary)
+        eq_(primary.circuit_breaker.state, CircuitBreaker.CLOSED)
+
+    def test_sticky_rates(self):
+        # with round-robin, the rates of a single agent are applied while it's healthy
+        first, second = _endpoint('first'), _endpoint('second', failure_threshold=1)
+        pool = AgentPool([first, second], routing=ROUTING_ROUND_ROBIN)
+        eq_(pool.update_rates(second, {'service:,env:': 0.5}), {'service:,env:': 0.5})
+        eq_(pool.update_rates(first, {'service:,env:': 0.1}), None)
+        eq_(first.rate_by_service, {'service:,env:': 0.1})
+        eq_(pool.update_rates(second, {'service:,env:': 0.4}), {'service:,env:': 0.4})
+
+        second.circuit_breaker.record_failure()
+        eq_(pool.update_rates(first, {'service:,env:': 0.2}), {'service:,env:': 0.2})
+
+    def test_failover_rates(self):
+        # with failover, the rates of the agent that receives the traffic are applied
+        primary, secondary = _endpoint('primary'), _endpoint('secondary')
+        pool = AgentPool([primary, secondary])
+        eq_(pool.update_rates(secondary, {'service:,env:': 0.5}), {'service:,env:': 0.5})
+        eq_(pool.update_rates(primary, {'service:,env:': 0.1}), {'service:,env:': 0.1})
+
+    def test_unknown_routing(self):
+        with self.assertRaises(ValueError):
+            AgentPool([_endpoint('primary')], routing='random')
+
+
+class AgentWriterFailoverTests(TestCase):
+    def _writer(self, agents, **kwargs):
+        with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+            writer = AgentWriter(agents=agents, flush_interval=60, **kwargs)
+        for endpoint in writer.agent_pool.endpoints:
+            self.addCleanup(endpoint.api.close)
+        return writer
+
+    def _stop(self, writer):
+        writer._worker.stop()
+        writer._worker.join()
+
+    def test_failover(self):
+        # traces spill over to the secondary agent when the primary one fails
+        with StandInAgent(status=503) as primary, StandInAgent() as secondary:
+            writer = self._writer(
+                [(primary.hostname, primary.port), (secondary.hostname, secondary.port)],
+                retry_policy=RetryPolicy(max_attempts=2, jitter=False, initial_backoff=0),
+            )
+            ok_(writer.api is writer.agent_pool.primary.api)
+            writer._reset_worker()
+            writer._worker._send_traces([[Span(tracer=None, name='first')]])
+            self._stop(writer)
+
+            eq_(len(primary.requests), 1)
+            eq_(len(secondary.requests), 1)
+            eq_(writer.stats()['sent_traces'], 1)
+
+    def test_round_robin(self):
+        with StandInAgent() as first, StandInAgent() as second:
+            writer = self._writer(
+                [(first.hostname, first.port, 1), (second.hostname, second.port, 1)],
+                routing=ROUTING_ROUND_ROBIN,
+            )
+            writer._reset_worker()
+            writer._worker._send_traces([[Span(tracer=None, name='first')]])
+            writer._worker._send_traces([[Span(tracer=None, name='second')]])
+            self._stop(writer)
+
+            eq_(len(first.requests), 1)
+            eq_(len(second.requests), 1)
+
+    def test_rate_by_service(self):
+        # the sampling rates of the agent that received the traces are applied
+        content = b'{"rate_by_service": {"service:,env:": 0.5}}'
+        with StandInAgent(status=503) as primary, StandInAgent(content=content) as secondary:
+            sampler = mock.Mock()
+            writer = self._writer(
+                [(primary.hostname, primary.port), (secondary.hostname, secondary.port)],
+                priority_sampler=sampler,
+                circuit_breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60),
+            )
+            writer._reset_worker()
+            writer._worker._send_traces([[Span(tracer=None, name='first')]])
+            self._stop(writer)
+
+            sampler.set_sample_rate_by_service.assert_called_once_with({'service:,env:': 0.5})
+            eq_(writer.agent_pool.primary.circuit_breaker.state, CircuitBreaker.OPEN)
+            eq_(writer.agent_pool.endpoints[1].circuit_breaker.state, CircuitBreaker.CLOSED)
@@ -1,7 +1,12 @@
+import mock
+import time
+
 from unittest import TestCase
+from nose.tools import eq_, ok_
 
-from ddtrace.filters import FilterRequestsOnUrl
+from ddtrace.filters import FilterDuplicateErrorStacks, FilterRequestsOnUrl
 from ddtrace.span import Span
+from ddtrace.ext import errors
 from ddtrace.ext.http import URL
 
 class FilterRequestOnUrlTests(TestCase):
@@ -32,3 +37,75 @@ class FilterRequestOnUrlTests(TestCase):
         filtr = FilterRequestsOnUrl(['http://domain\.example\.com', 'http://anotherdomain\.example\.com'])
         trace = filtr.process_trace([span])
         self.assertIsNotNone(trace)
+
+
+def _fail(exc_type=ValueError):
+    raise exc_type('failure')
+
+
+def _error_span(exc_type=ValueError, render=False):
+    span = Span(name='Name', tracer=None)
+    try:
+        _fail(exc_type)
+    except exc_type:
+        span.set_traceback()
+    if render:
+        span.get_tag(errors.ERROR_STACK)
+    return span
+
+
+class FilterDuplicateErrorStacksTests(TestCase):
+    def test_duplicates(self):
+        filtr = FilterDuplicateErrorStacks()
+        ok = Span(name='Name', tracer=None)
+        trace = filtr.process_trace([ok, _error_span(), _error_span(), _error_span(KeyError)])
+        eq_(len(trace), 4)
+        eq_(ok.meta, {})
+
+        first, second, other = trace[1:]
+        fingerprint = first.get_tag(errors.ERROR_FINGERPRINT)
+        ok_(fingerprint)
+        eq_(second.get_tag(errors.ERROR_FINGERPRINT), fingerprint)
+        ok_(other.get_tag(errors.ERROR_FINGERPRINT) != fingerprint)
+        eq_(first.get_metric(errors.ERROR_OCCURRENCES), 1)
+        eq_(second.get_metric(errors.ERROR_OCCURRENCES), 2)
+        eq_(other.get_metric(errors.ERROR_OCCURRENCES), 1)
+
+        # only the first stack of a fingerprint is sent
+        ok_(first.get_tag(errors.ERROR_STACK))
+        eq_(second.get_tag(errors.ERROR_STACK), None)
+        ok_(other.get_tag(errors.ERROR_STACK))
+        eq_(second.get_tag(errors.ERROR_MSG), 'failure')
+
+    def test_formatted_stacks(self):
+        # stacks already formatted have the same fingerprint as the captured ones
+        filtr = FilterDuplicateErrorStacks()
+        first, second = filtr.process_trace([_error_span(render=True), _error_span()])
+        eq_(first.get_tag(errors.ERROR_FINGERPRINT), second.get_tag(errors.ERROR_FINGERPRINT))
+        eq_(second.get_metric(errors.ERROR_OCCURRENCES), 2)
+        eq_(second.get_tag(errors.ERROR_STACK), None)
+
+    def test_interval(self):
+        filtr = FilterDuplicateErrorStacks(interval=60)
+        filtr.process_trace([_error_span()])
+        with mock.patch('time.time', return_value=time.time() + 60):
+            span, = filtr.process_trace([_error_span()])
+        eq_(span.get_metric(errors.ERROR_OCCURRENCES), 1)
+        ok_(span.get_tag(errors.ERROR_STACK))
+
+    def test_max_fingerprints(self):
+        # the stacks of the fingerprints past the limit are always sent
+        filtr = FilterDuplicateErrorStacks(max_fingerprints=1)
+        filtr.process_trace([_error_span()])
+        first, second = filtr.process_trace([_error_span(KeyError), _error_span(KeyError)])
+        eq_(second.get_metric(errors.ERROR_OCCURRENCES), 1)
+        ok_(second.get_tag(errors.ERROR_STACK))
+        eq_(len(filtr._occurrences), 1)
+
+    def test_without_stack(self):
+        filtr = FilterDuplicateErrorStacks()
+        span = Span(name='Name', tracer=None)
+        span.error = 1
+        span.set_tag(errors.ERROR_TYPE, 'ValueError')
+        filtr.process_trace([span])
+        eq_(span.get_tag(errors.ERROR_FINGERPRINT), None)
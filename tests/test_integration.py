@@ -245,7 +245,7 @@ class TestAPITransport(TestCase):
         self.api_json = API('localhost', 8126, encoder=JSONEncoder())
         self.api_msgpack = API('localhost', 8126, encoder=MsgpackEncoder())
 
-    @mock.patch('ddtrace.api.httplib.HTTPConnection')
+    @mock.patch('ddtrace.transport.httplib.HTTPConnection')
     def test_send_presampler_headers(self, mocked_http):
         # register a single trace with a span and send them to the trace agent
         self.tracer.trace('client.testing').finish()
@@ -272,7 +272,7 @@ class TestAPITransport(TestCase):
         for k, v in expected_headers.items():
             eq_(v, headers[k])
 
-    @mock.patch('ddtrace.api.httplib.HTTPConnection')
+    @mock.patch('ddtrace.transport.httplib.HTTPConnection')
     def test_send_presampler_headers_not_in_services(self, mocked_http):
         # register some services and send them to the trace agent
         services = [{
@@ -0,0 +1,219 @@
+import json
+import mock
+import os
+import signal
+import time
+
+from unittest import TestCase, skipUnless
+from nose.tools import eq_, ok_
+
+from ddtrace.encoding import JSONEncoder
+from ddtrace.ringbuffer import SharedRingBuffer
+from ddtrace.span import Span
+from ddtrace.utils.forksafe import is_alive
+from ddtrace.writer import AgentWriter, EncodedTrace, Q, SharedQ, RECORD_SERVICES, RECORD_TRACE
+
+from .util import StandInAgent
+
+
+def _fork(target):
+    """
+    Run ``target`` in a forked process and wait for it to exit.
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            target()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+
+
+class SharedRingBufferTests(TestCase):
+    def test_write_read(self):
+        ring = SharedRingBuffer(1024)
+        ok_(ring.write(b'first', kind=1, items=2))
+        ok_(ring.write(b'second'))
+        eq_(ring.stats(), {'records': 2, 'bytes': 2 * 9 + 11, 'dropped_records': 0, 'dropped_items': 0})
+
+        eq_(ring.read(), [(1, 2, b'first'), (0, 0, b'second')])
+        eq_(ring.read(), [])
+        eq_(ring.stats()['records'], 0)
+        eq_(ring.stats()['bytes'], 0)
+
+    def test_wrap_around(self):
+        # records are split at the end of the buffer
+        ring = SharedRingBuffer(32)
+        for i in range(10):
+            data = str(i).encode('utf-8') * 10
+            ok_(ring.write(data))
+            eq_(ring.read(), [(0, 0, data)])
+
+    def test_overflow(self):
+        # records are dropped and accounted when the buffer is full
+        ring = SharedRingBuffer(32)
+        ok_(ring.write(b'a' * 20, items=1))
+        ok_(not ring.write(b'b' * 20, items=3))
+        ok_(not ring.write(b'c' * 40, items=4))
+        eq_(ring.stats(), {'records': 1, 'bytes': 29, 'dropped_records': 2, 'dropped_items': 7})
+        eq_(ring.read(), [(0, 1, b'a' * 20)])
+        ok_(ring.write(b'b' * 20, items=3))
+
+    def test_locked(self):
+        # a record is dropped instead of blocking if the buffer is locked for too long
+        ring = SharedRingBuffer(32)
+        with mock.patch.object(ring, '_lock') as lock:
+            lock.acquire.return_value = False
+            ok_(not ring.write(b'a'))
+
+    def test_read_locked(self):
+        # reading doesn't block if the buffer is locked for too long
+        ring = SharedRingBuffer(32)
+        ok_(ring.write(b'a'))
+        with mock.patch.object(ring, '_lock') as lock:
+            lock.acquire.return_value = False
+            eq_(ring.read(), [])
+            eq_(ring.stats()['records'], 1)
+            ok_(not lock.release.called)
+        eq_(ring.read(), [(0, 0, b'a')])
+
+    @skipUnless(hasattr(os, 'fork'), 'os.fork() is not available')
+    def test_killed_owner(self):
+        # the lock held by a process killed while writing is taken over
+        ring = SharedRingBuffer(1024)
+        ok_(ring.write(b'first'))
+
+        def killed():
+            ring._acquire()
+            os.kill(os.getpid(), signal.SIGKILL)
+
+        _fork(killed)
+        ok_(ring.write(b'second'))
+        eq_(ring.read(), [(0, 0, b'first'), (0, 0, b'second')])
+        # and released afterwards
+        ok_(ring._lock.acquire(False))
+        ring._lock.release()
+
+    @skipUnless(os.path.exists('/proc/self/stat'), 'zombie processes are only detected with procfs')
+    def test_killed_owner_contended(self):
+        # a lock held by a killed process that isn't waited for yet is taken over by a
+        # single one of the processes waiting for it
+        ring = SharedRingBuffer(1 << 16)
+        holder = os.fork()
+        if holder == 0:
+            try:
+                ring._acquire()
+            finally:
+                os.kill(os.getpid(), signal.SIGKILL)
+        deadline = time.time() + 5
+        while is_alive(holder) and time.time() < deadline:
+            time.sleep(0.01)
+
+        def contend(name):
+            pid = os.fork()
+            if pid == 0:
+                written = False
+                try:
+                    written = all(ring.write('{}.{}'.format(name, i).encode('utf-8')) for i in range(50))
+                finally:
+                    os._exit(0 if written else 1)
+            return pid
+
+        contenders = [contend('first'), contend('second')]
+        statuses = [os.waitpid(pid, 0)[1] for pid in contenders]
+        os.waitpid(holder, 0)
+
+        eq_(statuses, [0, 0])
+        expected = ['{}.{}'.format(name, i).encode('utf-8') for name in ('first', 'second') for i in range(50)]
+        eq_(sorted(data for _, _, data in ring.read()), sorted(expected))
+        eq_(ring.stats()['records'], 0)
+        ok_(ring._lock.acquire(False))
+        ring._lock.release()
+
+    @skipUnless(hasattr(os, 'fork'), 'os.fork() is not available')
+    def test_fork(self):
+        # records written by forked processes are read by the parent
+        ring = SharedRingBuffer(1024)
+        for i in range(3):
+            _fork(lambda: ring.write('child.{}'.format(i).encode('utf-8')))
+        eq_(ring.read(), [(0, 0, b'child.0'), (0, 0, b'child.1'), (0, 0, b'child.2')])
+
+
+class SharedQTests(TestCase):
+    def test_pop(self):
+        # traces are popped as encoded traces, and services are moved to their queue
+        ring = SharedRingBuffer(1024)
+        services = Q()
+        queue = SharedQ(ring, JSONEncoder, services)
+        ring.write(b'[{}]', RECORD_TRACE, 1)
+        ring.write(json.dumps({'web': {'app': 'django'}}).encode('utf-8'), RECORD_SERVICES)
+        eq_(queue.size(), 2)
+
+        traces = queue.pop()
+        eq_(len(traces), 1)
+        ok_(isinstance(traces[0], EncodedTrace))
+        eq_(traces[0].data, b'[{}]')
+        eq_(traces[0].encoder, JSONEncoder)
+        eq_(len(traces[0]), 1)
+        eq_(services.pop(), [{'web': {'app': 'django'}}])
+        eq_(queue.pop(), None)
+
+    def test_wait(self):
+        # the worker is woken up when the buffer is ready to be flushed
+        ring = SharedRingBuffer(1024)
+        queue = SharedQ(ring, JSONEncoder, Q(), flush_size=2, poll_interval=0.01)
+        ring.write(b'[]')
+        ring.write(b'[]')
+        start = time.time()
+        queue.wait(60)
+
+        queue.pop()
+        queue.close()
+        queue.wait(60)
+        ok_(queue.closed())
+        ok_(time.time() - start < 1)
+
+
+@skipUnless(hasattr(os, 'fork'), 'os.fork() is not available')
+class AgentWriterSharedBufferTests(TestCase):
+    def test_flush(self):
+        # the traces of forked processes are flushed by the process that created the writer
+        with StandInAgent() as agent:
+            with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+                writer = AgentWriter(agent.hostname, agent.port, shared_buffer_size=1 << 16, flush_interval=60)
+            for i in range(3):
+                _fork(lambda: writer.write(
+                    spans=[Span(tracer=None, name='child.{}'.format(i))],
+                    services={'web': {'app': 'django', 'app_type': 'web'}},
+                ))
+            writer.write(spans=[Span(tracer=None, name='parent')])
+            # services are queued in the shared buffer as well
+            eq_(writer.stats()['queued_traces'], 7)
+
+            writer._worker.stop()
+            writer._worker.join()
+            writer.api.close()
+
+            paths = [path for _, path, _, _ in agent.requests]
+            eq_(paths, ['/v0.3/traces', '/v0.3/services'])
+            _, _, headers, body = agent.requests[0]
+            eq_(headers['X-Datadog-Trace-Count'], '4')
+            traces = json.loads(body.decode('utf-8'))
+            eq_([trace[0]['name'] for trace in traces], ['child.0', 'child.1', 'child.2', 'parent'])
+
+    def test_overflow(self):
+        # traces that don't fit in the shared buffer are dropped and accounted
+        with mock.patch('ddtrace.writer.AsyncWorker'):
+            writer = AgentWriter(shared_buffer_size=64, flush_interval=60)
+        _fork(lambda: writer.write(spans=[Span(tracer=None, name='child')] * 2))
+        stats = writer.stats()
+        eq_(stats['queued_traces'], 0)
+        eq_(stats['dropped_traces'], 1)
+        eq_(stats['dropped_spans'], 2)
+
+    def test_not_incremental(self):
+        # the shared buffer isn't used if traces can't be encoded one by one
+        with mock.patch('ddtrace.encoding.JSONEncoder.incremental', False):
+            with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+                writer = AgentWriter(shared_buffer_size=1 << 16)
+        eq_(writer._shared_buffer, None)
@@ -1,13 +1,12 @@
 from __future__ import division
 
 import unittest
-import random
 
 from ddtrace.span import Span
 from ddtrace.sampler import RateSampler, AllSampler, RateByServiceSampler, _key, _default_key
 from ddtrace.compat import iteritems
 from tests.test_tracer import get_dummy_tracer
-from .util import patch_time
+from .util import patch_time, seed_ids
 from ddtrace.constants import SAMPLING_PRIORITY_KEY, SAMPLE_RATE_METRIC_KEY
 
 
@@ -20,7 +19,7 @@ class RateSamplerTest(unittest.TestCase):
 
             tracer.sampler = RateSampler(sample_rate)
 
-            random.seed(1234)
+            seed_ids(1234)
 
             iterations = int(1e4 / sample_rate)
 
@@ -44,7 +43,7 @@ class RateSamplerTest(unittest.TestCase):
 
         tracer.sampler = RateSampler(0.5)
 
-        random.seed(1234)
+        seed_ids(1234)
 
         for i in range(10):
             span = tracer.trace(i)
@@ -81,7 +80,7 @@ class RateByServiceSamplerTest(unittest.TestCase):
             tracer.writer = writer
             tracer.priority_sampler.set_sample_rate(sample_rate)
 
-            random.seed(1234)
+            seed_ids(1234)
 
             iterations = int(1e4 / sample_rate)
 
@@ -1,3 +1,4 @@
+import mock
 import time
 
 from nose.tools import eq_
@@ -127,6 +128,67 @@ def test_finish_set_span_duration():
     s.finish()
     assert s.duration == 1337.0
 
+def test_timing_ns():
+    # the start and duration are integers in nanoseconds
+    s = Span(tracer=None, name='test.span')
+    assert isinstance(s.start_ns, int)
+    assert abs(s.start - time.time()) < 1
+    s.finish()
+    assert isinstance(s.duration_ns, int)
+    assert s.duration_ns >= 0
+    eq_(s.duration, s.duration_ns / 1e9)
+
+    d = s.to_dict()
+    eq_(d['start'], s.start_ns)
+    eq_(d['duration'], s.duration_ns)
+
+
+def test_duration_monotonic():
+    # the duration is immune to the jumps of the wall clock
+    s = Span(tracer=None, name='test.span')
+    with mock.patch('time.time', return_value=s.start - 3600):
+        s.finish()
+    assert 0 <= s.duration < 1, s.duration
+
+
+def test_explicit_start():
+    # the duration of a span started in the past is measured with the wall clock
+    s = Span(tracer=None, name='test.span', start=1500000000.5)
+    eq_(s.start_ns, 1500000000500000000)
+    s.finish(finish_time=1500000002.5)
+    eq_(s.duration_ns, 2000000000)
+
+    s = Span(tracer=None, name='test.span')
+    s.start = time.time() - 10
+    s.finish()
+    assert 9 < s.duration < 11, s.duration
+
+
+def test_lazy_tags():
+    # the dictionaries of the tags and metrics are allocated when they're needed
+    s = Span(tracer=None, name='test.span')
+    eq_(s.get_tag('a'), None)
+    eq_(s.get_metric('a'), None)
+    s._remove_tag('a')
+    assert s._meta is None
+    assert s._metrics is None
+    assert 'meta' not in s.to_dict()
+    assert 'metrics' not in s.to_dict()
+
+    s.set_tag('a', 1)
+    s.set_metric('b', 2)
+    eq_(s.meta, {'a': '1'})
+    eq_(s.metrics, {'b': 2})
+
+    # the dictionaries can still be used and replaced directly
+    s = Span(tracer=None, name='test.span')
+    s.meta['a'] = 'b'
+    eq_(s.get_tag('a'), 'b')
+    s.metrics = {'b': 2}
+    eq_(s.get_metric('b'), 2)
+    eq_(s.to_dict()['meta'], {'a': 'b'})
+
+
 def test_traceback_with_error():
     s = Span(None, "test.span")
     try:
@@ -148,6 +210,45 @@ def test_traceback_without_error():
     assert not s.get_tag(errors.ERROR_TYPE)
     assert "in test_traceback_without_error" in s.get_tag(errors.ERROR_STACK)
 
+def _fail():
+    raise ValueError('no value')
+
+def test_deferred_traceback():
+    # the traceback is captured without being formatted, until the span is encoded
+    s = Span(None, "test.span")
+    try:
+        _fail()
+    except ValueError:
+        s.set_traceback()
+
+    if s._exc_stack is None:
+        raise SkipTest("tracebacks are formatted right away on this version of Python")
+    eq_(s.get_tag(errors.ERROR_MSG), 'no value')
+    assert errors.ERROR_STACK not in s._meta
+    stack = s.to_dict()['meta'][errors.ERROR_STACK]
+    assert s._exc_stack is None
+    assert stack.startswith("Traceback (most recent call last):")
+    assert "in _fail\n    raise ValueError('no value')" in stack
+    assert stack.endswith("ValueError: no value\n")
+
+def test_deferred_traceback_overridden():
+    # a stack set after the exception takes precedence, and removed exceptions aren't rendered
+    s = Span(None, "test.span")
+    try:
+        _fail()
+    except ValueError:
+        s.set_traceback()
+    s.set_tag(errors.ERROR_STACK, 'custom')
+    eq_(s.get_tag(errors.ERROR_STACK), 'custom')
+
+    try:
+        _fail()
+    except ValueError:
+        s.set_traceback()
+    s._remove_exc_info()
+    assert not s.error
+    eq_(s.meta, {})
+
 def test_ctx_mgr():
     dt = DummyTracer()
     s = Span(dt, "bar")
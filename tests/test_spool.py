@@ -0,0 +1,264 @@
+import mock
+import os
+import shutil
+import tempfile
+
+from unittest import TestCase
+from nose.tools import eq_, ok_
+
+from ddtrace.api import API, Payload
+from ddtrace.encoding import JSONEncoder
+from ddtrace.span import Span
+from ddtrace.spool import Spool
+from ddtrace.telemetry import DROP_INCOMPATIBLE_ENCODING, DROP_SEND_FAILED
+from ddtrace.utils.retry import CircuitBreaker, RetryPolicy
+from ddtrace.writer import AsyncWorker, Q
+
+from .util import StandInAgent
+
+
+FORMAT = 'v0.3 application/json'
+
+
+class Collector(object):
+    """Collects the replayed payloads, failing after ``limit`` of them"""
+    def __init__(self, limit=None):
+        self.payloads = []
+        self.formats = []
+        self.limit = limit
+
+    def __call__(self, payload, payload_format):
+        if self.limit is not None and len(self.payloads) >= self.limit:
+            return False
+        self.payloads.append((bytes(payload.data), payload.count))
+        self.formats.append(payload_format)
+        return True
+
+
+class SpoolTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _files(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_replay(self):
+        # spooled payloads are replayed in order, then removed
+        spool = Spool(self.directory)
+        ok_(spool.write(Payload(b'first', None, 1), FORMAT))
+        ok_(spool.write(Payload('second', [[], []]), FORMAT))
+        ok_(spool.size() > 0)
+
+        collector = Collector()
+        eq_(spool.replay(collector), 2)
+        eq_(collector.payloads, [(b'first', 1), (b'second', 2)])
+        eq_(self._files(), [])
+        eq_(spool.replay(collector), 0)
+
+    def test_segments(self):
+        # segments are closed once they reach their maximum size
+        spool = Spool(self.directory, segment_size=64)
+        for i in range(4):
+            spool.write(Payload(b'x' * 30, None, 1), FORMAT)
+        spool.close()
+        files = self._files()
+        eq_(len(files), 4)
+        ok_(all(name.endswith('-{}.seg'.format(os.getpid())) for name in files))
+
+    def test_replay_failure(self):
+        # the replay stops when a payload can't be sent, and resumes where it stopped
+        spool = Spool(self.directory, segment_size=64)
+        for i in range(5):
+            spool.write(Payload(str(i).encode('utf-8') * 30, None, 1), FORMAT)
+
+        collector = Collector(limit=3)
+        eq_(spool.replay(collector), 3)
+        collector.limit = None
+        eq_(spool.replay(collector), 2)
+        eq_([data[:1] for data, _ in collector.payloads], [b'0', b'1', b'2', b'3', b'4'])
+        eq_(self._files(), [])
+
+    def test_replay_rate(self):
+        # payloads are replayed at the given rate
+        spool = Spool(self.directory, replay_rate=100)
+        for i in range(3):
+            spool.write(Payload(b'x' * 60, None, 1), FORMAT)
+        spool.close()
+
+        collector = Collector()
+        with mock.patch('ddtrace.spool.time.time', return_value=1000):
+            spool = Spool(self.directory, replay_rate=100)
+            eq_(spool.replay(collector), 1)
+            eq_(spool.replay(collector), 0)
+        with mock.patch('ddtrace.spool.time.time', return_value=1001):
+            eq_(spool.replay(collector), 1)
+
+    def test_corrupted_segment(self):
+        # a corrupted record and the rest of its segment are discarded
+        spool = Spool(self.directory)
+        spool.write(Payload(b'first', None, 1), FORMAT)
+        spool.write(Payload(b'second', None, 1), FORMAT)
+        spool.write(Payload(b'third', None, 1), FORMAT)
+        spool.close()
+
+        path = os.path.join(self.directory, self._files()[0])
+        with open(path, 'r+b') as f:
+            content = f.read()
+            f.seek(content.index(b'second'))
+            f.write(b'SECOND')
+
+        collector = Collector()
+        eq_(spool.replay(collector), 1)
+        eq_(collector.payloads, [(b'first', 1)])
+        eq_(spool.discarded_payloads, 1)
+        eq_(self._files(), [])
+
+    def test_truncated_segment(self):
+        # a segment truncated by a crash is replayed up to the last complete record
+        spool = Spool(self.directory)
+        spool.write(Payload(b'first', None, 1), FORMAT)
+        spool.write(Payload(b'second', None, 1), FORMAT)
+        spool.close()
+
+        path = os.path.join(self.directory, self._files()[0])
+        with open(path, 'r+b') as f:
+            f.truncate(os.path.getsize(path) - 3)
+
+        collector = Collector()
+        eq_(spool.replay(collector), 1)
+        eq_(collector.payloads, [(b'first', 1)])
+        eq_(self._files(), [])
+
+    def test_quota(self):
+        # the oldest segments are discarded to stay under the quota
+        spool = Spool(self.directory, segment_size=64, quota=250)
+        for i in range(6):
+            ok_(spool.write(Payload(str(i).encode('utf-8') * 40, None, 1), FORMAT))
+        ok_(spool.size() <= 250)
+        ok_(spool.discarded_bytes > 0)
+
+        # a payload larger than the quota is dropped
+        ok_(not spool.write(Payload(b'x' * 300, None, 1), FORMAT))
+
+        collector = Collector()
+        spool.replay(collector)
+        eq_([data[:1] for data, _ in collector.payloads], [b'3', b'4', b'5'])
+
+    def test_formats(self):
+        # payloads in another format are stored in another segment that records it
+        spool = Spool(self.directory)
+        spool.write(Payload(b'first', None, 1), FORMAT)
+        spool.write(Payload(b'second', None, 1), 'v0.4 application/msgpack')
+        spool.write(Payload(b'third', None, 1), 'v0.4 application/msgpack')
+        spool.close()
+        eq_(len(self._files()), 2)
+
+        collector = Collector()
+        eq_(spool.replay(collector), 3)
+        eq_(collector.formats, [FORMAT, 'v0.4 application/msgpack', 'v0.4 application/msgpack'])
+
+    def test_old_segment(self):
+        # segments without a payload format are discarded
+        with open(os.path.join(self.directory, '{:020d}-1.seg'.format(1)), 'wb') as f:
+            f.write(b'DDSPOOL1' + b'\x05\x00\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00first')
+
+        spool = Spool(self.directory)
+        collector = Collector()
+        eq_(spool.replay(collector), 0)
+        eq_(collector.payloads, [])
+        eq_(spool.discarded_payloads, 1)
+        eq_(self._files(), [])
+
+    def test_recover(self):
+        # segments left by a process that is gone are replayed
+        spool = Spool(self.directory)
+        spool.write(Payload(b'first', None, 1), FORMAT)
+        path = spool._file.name
+        spool._file.close()
+        spool._file = None
+        dead_pid = 2 ** 22 + 1
+        os.rename(path, path.replace('-{}.open'.format(os.getpid()), '-{}.open'.format(dead_pid)))
+
+        collector = Collector()
+        eq_(Spool(self.directory).replay(collector), 1)
+        eq_(collector.payloads, [(b'first', 1)])
+
+
+class AsyncWorkerSpoolTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_spool_and_replay(self):
+        # payloads that can't be sent are spooled, and replayed when the agent is back
+        spool = Spool(self.directory)
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        with StandInAgent(status=500) as agent:
+            api = API(agent.hostname, agent.port, encoder=JSONEncoder())
+            worker = AsyncWorker(
+                api, Q(), Q(), flush_interval=60, spool=spool, circuit_breaker=breaker,
+                retry_policy=RetryPolicy(max_attempts=1),
+            )
+            self.addCleanup(worker.join)
+            self.addCleanup(worker.stop)
+
+            worker._send_traces([[Span(tracer=None, name='first')]])
+            eq_(breaker.state, CircuitBreaker.OPEN)
+            # the circuit is open: traces are spooled without being sent
+            worker._send_traces([[Span(tracer=None, name='second')]])
+            eq_(len(agent.requests), 1)
+            ok_(spool.size() > 0)
+
+            # the agent is back
+            agent._server.response = (200, b'{}')
+            breaker.record_success()
+            worker._replay_spool()
+            api.close()
+
+            eq_(len(agent.requests), 3)
+            eq_(agent.requests[1][3], agent.requests[0][3])
+            ok_(b'second' in agent.requests[2][3])
+            eq_(spool.size(), 0)
+
+    def _worker(self, api, spool):
+        worker = AsyncWorker(api, Q(), Q(), flush_interval=60, spool=spool, retry_policy=RetryPolicy(max_attempts=1))
+        self.addCleanup(worker.join)
+        self.addCleanup(worker.stop)
+        return worker
+
+    def test_replay_other_format(self):
+        # payloads spooled in a format that the agent doesn't use anymore are dropped
+        spool = Spool(self.directory)
+        spool.write(Payload(b'\x91\x90', None, 1), 'v0.4 application/msgpack')
+        with StandInAgent() as agent:
+            api = API(agent.hostname, agent.port, encoder=JSONEncoder())
+            worker = self._worker(api, spool)
+            worker._replay_spool()
+            api.close()
+
+            eq_(agent.requests, [])
+        eq_(spool.size(), 0)
+        stats = worker._telemetry.snapshot()
+        eq_(stats['dropped'], {DROP_INCOMPATIBLE_ENCODING: 1})
+        eq_(stats['sent_traces'], 0)
+
+    def test_replay_rejected(self):
+        # payloads rejected by the agent aren't replayed again, nor counted as sent
+        spool = Spool(self.directory)
+        with StandInAgent(status=400) as agent:
+            api = API(agent.hostname, agent.port, encoder=JSONEncoder())
+            spool.write(Payload(b'[[]]', None, 1), api.payload_format)
+            worker = self._worker(api, spool)
+            worker._replay_spool()
+            api.close()
+
+            eq_(len(agent.requests), 1)
+        eq_(spool.size(), 0)
+        stats = worker._telemetry.snapshot()
+        eq_(stats['dropped'], {DROP_SEND_FAILED: 1})
+        eq_(stats['sent_traces'], 0)
@@ -0,0 +1,183 @@
+import mock
+import socket
+
+from unittest import TestCase
+from nose.tools import eq_, ok_
+
+from ddtrace.encoding import JSONEncoder
+from ddtrace.filters import FilterRequestsOnUrl
+from ddtrace.span import Span
+from ddtrace.telemetry import DogStatsdEmitter, Histogram, MetricsEmitter, WriterTelemetry
+from ddtrace.utils.retry import CircuitBreaker, RetryPolicy
+from ddtrace.writer import AgentWriter, Q
+
+from .util import StandInAgent
+
+
+class RecordingEmitter(MetricsEmitter):
+    """Emitter that records the metrics it receives"""
+    def __init__(self):
+        self.counts = []
+        self.gauges = {}
+
+    def count(self, name, value, tags=None):
+        self.counts.append((name, value, sorted(tags or [])))
+
+    def gauge(self, name, value, tags=None):
+        self.gauges[name] = value
+
+
+class HistogramTests(TestCase):
+    def test_snapshot(self):
+        histogram = Histogram()
+        eq_(histogram.snapshot()['p99'], 0.0)
+        for _ in range(98):
+            histogram.observe(0.001)
+        histogram.observe(0.5)
+        histogram.observe(1.5)
+
+        snapshot = histogram.snapshot()
+        eq_(snapshot['count'], 100)
+        eq_(snapshot['max'], 1.5)
+        ok_(abs(snapshot['sum'] - 2.098) < 1e-9)
+        # percentiles are the upper bound of their bucket
+        ok_(0.001 <= snapshot['p50'] < 0.002)
+        ok_(0.5 <= snapshot['p99'] < 1)
+        eq_(histogram.percentile(1), 1.5)
+
+
+class WriterTelemetryTests(TestCase):
+    def test_snapshot(self):
+        telemetry = WriterTelemetry()
+        telemetry.enqueued(3)
+        telemetry.enqueued(2)
+        telemetry.dropped('filtered', 1)
+        telemetry.dropped('filtered', 0)
+        telemetry.response(200)
+        telemetry.response(200)
+        telemetry.observe('send_time', 0.01)
+
+        stats = telemetry.snapshot()
+        eq_(stats['enqueued_traces'], 2)
+        eq_(stats['enqueued_spans'], 5)
+        eq_(stats['dropped'], {'filtered': 1})
+        eq_(stats['http_status'], {200: 2})
+        eq_(stats['send_time']['count'], 1)
+        eq_(stats['encode_time']['count'], 0)
+
+    def test_emit(self):
+        # counters are emitted as the difference since the previous emission
+        telemetry = WriterTelemetry()
+        emitter = RecordingEmitter()
+        telemetry.enqueued(3)
+        telemetry.response(200)
+        telemetry.observe('encode_time', 0.002)
+        telemetry.emit(emitter, {'queued_traces': 1, 'queued_bytes': 10, 'dropped_traces': 2, 'high_water': 4},
+                       tags=['env:test'])
+        ok_(('enqueued.traces', 1, ['env:test']) in emitter.counts)
+        ok_(('enqueued.spans', 3, ['env:test']) in emitter.counts)
+        ok_(('dropped.traces', 2, ['env:test', 'reason:queue_full']) in emitter.counts)
+        ok_(('http.responses', 1, ['env:test', 'status:200']) in emitter.counts)
+        eq_(emitter.gauges['queue.traces'], 1)
+        eq_(emitter.gauges['queue.high_water'], 4)
+        eq_(emitter.gauges['encode.time.max'], 0.002)
+        ok_('send.time.max' not in emitter.gauges)
+
+        emitter = RecordingEmitter()
+        telemetry.enqueued(1)
+        telemetry.emit(emitter, {'dropped_traces': 2})
+        eq_(sorted(emitter.counts), [('enqueued.spans', 1, []), ('enqueued.traces', 1, [])])
+        ok_('encode.time.max' not in emitter.gauges)
+
+
+class DogStatsdEmitterTests(TestCase):
+    def test_send(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(5)
+        self.addCleanup(server.close)
+
+        emitter = DogStatsdEmitter('127.0.0.1', server.getsockname()[1], tags=['service:web'])
+        emitter.count('dropped.traces', 2, ['reason:queue_full'])
+        emitter.gauge('queue.traces', 10)
+        emitter.close()
+
+        eq_(server.recv(1024), b'datadog.tracer.writer.dropped.traces:2|c|#service:web,reason:queue_full')
+        eq_(server.recv(1024), b'datadog.tracer.writer.queue.traces:10|g|#service:web')
+
+
+class AgentWriterTelemetryTests(TestCase):
+    def _writer(self, agent, **kwargs):
+        with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+            writer = AgentWriter(agent.hostname, agent.port, flush_interval=60, **kwargs)
+        self.addCleanup(writer.api.close)
+        return writer
+
+    def _stop(self, writer):
+        writer._worker.stop()
+        writer._worker.join()
+
+    def test_stats(self):
+        with StandInAgent() as agent:
+            writer = self._writer(agent)
+            # the traces are queued before the worker starts
+            with mock.patch('ddtrace.writer.AsyncWorker'):
+                writer.write(spans=[Span(tracer=None, name='first')] * 2)
+                writer.write(spans=[Span(tracer=None, name='second')])
+            writer._worker = None
+            writer._reset_worker()
+            self._stop(writer)
+
+            stats = writer.stats()
+            eq_(stats['enqueued_traces'], 2)
+            eq_(stats['enqueued_spans'], 3)
+            eq_(stats['sent_traces'], 2)
+            eq_(stats['encoded_bytes'], len(agent.requests[0][3]))
+            eq_(stats['http_status'], {200: 1})
+            eq_(stats['high_water'], 2)
+            eq_(stats['dropped'], {})
+            eq_(stats['encode_time']['count'], 1)
+            eq_(stats['send_time']['count'], 1)
+
+    def test_dropped(self):
+        # dropped traces are counted by reason
+        with StandInAgent(status=500) as agent:
+            writer = self._writer(
+                agent,
+                filters=[FilterRequestsOnUrl('http://example.com/health')],
+                retry_policy=RetryPolicy(max_attempts=1),
+                circuit_breaker=CircuitBreaker(failure_threshold=1, reset_timeout=60),
+            )
+            health = Span(tracer=None, name='health')
+            health.set_tag('http.url', 'http://example.com/health')
+            writer.write(spans=[health])
+            writer.write(spans=[Span(tracer=None, name='first')])
+            # the first flush fails, and opens the circuit
+            writer._worker._send_traces([[Span(tracer=None, name='second')]])
+            self._stop(writer)
+
+            stats = writer.stats()
+            eq_(stats['dropped'], {'filtered': 1, 'send_failed': 1, 'agent_unavailable': 1})
+            eq_(stats['http_status'], {500: 1})
+
+    def test_queue_full(self):
+        with mock.patch('ddtrace.writer.AsyncWorker'):
+            writer = AgentWriter(flush_interval=60)
+        writer._reset_worker()
+        writer._traces = Q(max_size=1)
+        writer.write(spans=[Span(tracer=None, name='first')])
+        writer.write(spans=[Span(tracer=None, name='second')])
+        eq_(writer.stats()['dropped'], {'queue_full': 1})
+
+    def test_emitter(self):
+        # metrics are emitted by the worker
+        emitter = RecordingEmitter()
+        with StandInAgent() as agent:
+            writer = self._writer(agent, metrics_emitter=emitter, metrics_interval=0)
+            writer.write(spans=[Span(tracer=None, name='first')])
+            self._stop(writer)
+
+        ok_(('sent.traces', 1, []) in emitter.counts)
+        ok_(('http.responses', 1, ['status:200']) in emitter.counts)
+        ok_('send.time.p99' in emitter.gauges)
+        eq_(emitter.gauges['queue.traces'], 0)
@@ -12,9 +12,12 @@ from unittest.case import SkipTest
 
 from ddtrace.encoding import JSONEncoder, MsgpackEncoder
 from ddtrace.ext import system
+from ddtrace.span import SuppressedSpan
 from ddtrace.tracer import Tracer
 from ddtrace.writer import AgentWriter
+from ddtrace.constants import SAMPLING_PRIORITY_KEY, SUPPRESSED_SPANS_COUNT_KEY, SUPPRESSED_SPANS_DURATION_KEY
 from ddtrace.context import Context
+from ddtrace.sampler import RateByServiceSampler
 
 
 def test_tracer_vars():
@@ -485,6 +488,81 @@ def test_start_child_from_context():
     eq_(child, child._context._current_span)
 
 
+def test_partial_flush():
+    # the finished spans of a long trace are sent in chunks
+    tracer = get_dummy_tracer()
+    tracer.configure(partial_flush_min_spans=5)
+    tracer.priority_sampler = RateByServiceSampler()
+    with tracer.trace('root') as root:
+        for _ in range(12):
+            with tracer.trace('child'):
+                pass
+    traces = tracer.writer.pop_traces()
+    eq_([len(trace) for trace in traces], [5, 5, 3])
+    # the last chunk contains the root span, with the sampling priority
+    eq_(traces[2][0], root)
+    ok_(root.get_metric(SAMPLING_PRIORITY_KEY) is not None)
+    eq_(len(set(span.trace_id for trace in traces for span in trace)), 1)
+
+    # disabled by default
+    tracer.configure(partial_flush_min_spans=0)
+    with tracer.trace('root'):
+        for _ in range(12):
+            with tracer.trace('child'):
+                pass
+    eq_([len(trace) for trace in tracer.writer.pop_traces()], [13])
+
+
+def test_max_spans_per_trace():
+    # the spans past the maximum are only summarized on the root span
+    tracer = get_dummy_tracer()
+    tracer.configure(max_spans_per_trace=3)
+    with tracer.trace('root') as root:
+        with tracer.trace('parent') as parent:
+            for _ in range(5):
+                with tracer.trace('query') as span:
+                    span.set_tag('sql.query', 'SELECT 1')
+                    with tracer.trace('nested'):
+                        pass
+        # spans started past the maximum don't become active
+        ok_(isinstance(span, SuppressedSpan))
+        eq_(span.trace_id, root.trace_id)
+        eq_(span.parent_id, parent.span_id)
+        eq_(span.get_tag('sql.query'), None)
+        ok_(tracer.current_span() is root)
+        with tracer.trace('suppressed') as suppressed:
+            pass
+
+    spans = tracer.writer.pop()
+    eq_([span.name for span in spans], ['root', 'parent', 'query'])
+    eq_(spans[2].get_tag('sql.query'), 'SELECT 1')
+    eq_(root.get_metric(SUPPRESSED_SPANS_COUNT_KEY.format('query')), 4)
+    eq_(root.get_metric(SUPPRESSED_SPANS_COUNT_KEY.format('nested')), 5)
+    eq_(root.get_metric(SUPPRESSED_SPANS_COUNT_KEY.format('suppressed')), 1)
+    eq_(root.get_metric(SUPPRESSED_SPANS_DURATION_KEY.format('suppressed')), suppressed.duration)
+    ok_(root.get_metric(SUPPRESSED_SPANS_DURATION_KEY.format('query')) > 0)
+
+    # the next trace starts from scratch
+    with tracer.trace('root') as root:
+        with tracer.trace('child'):
+            pass
+    eq_(len(tracer.writer.pop()), 2)
+    eq_(root.metrics.get(SUPPRESSED_SPANS_COUNT_KEY.format('query')), None)
+
+
+def test_suppressed_span_after_trace():
+    # a suppressed span finished after its trace isn't summarized in the next one
+    tracer = get_dummy_tracer()
+    tracer.configure(max_spans_per_trace=1)
+    root = tracer.trace('root')
+    span = tracer.trace('late')
+    root.finish()
+    span.finish()
+    with tracer.trace('root') as root:
+        pass
+    eq_(root.get_metric(SUPPRESSED_SPANS_COUNT_KEY.format('late')), None)
+
+
 class DummyWriter(AgentWriter):
     """ DummyWriter is a small fake writer used for tests. not thread-safe. """
 
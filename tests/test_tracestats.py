@@ -0,0 +1,132 @@
+import mock
+
+from unittest import TestCase
+from nose.tools import eq_, ok_
+
+from ddtrace.encoding import JSONEncoder
+from ddtrace.ext import http
+from ddtrace.span import Span
+from ddtrace.tracer import Tracer
+from ddtrace.tracestats import OVERFLOW_KEY, TraceStatsAggregator
+from ddtrace.writer import AgentWriter
+
+from .test_telemetry import RecordingEmitter
+from .test_tracer import get_dummy_tracer
+from .util import StandInAgent
+
+
+class RejectAllSampler(object):
+    def sample(self, span):
+        return False
+
+
+def _span(name='request', resource='GET /', duration=0.1, error=0, status=None, service='web'):
+    span = Span(tracer=None, name=name, service=service, resource=resource)
+    span.duration = duration
+    span.error = error
+    if status is not None:
+        span.set_tag(http.STATUS_CODE, status)
+    return span
+
+
+class TraceStatsAggregatorTests(TestCase):
+    def test_aggregate(self):
+        aggregator = TraceStatsAggregator()
+        aggregator.add_trace([_span(status=200), _span(name='db', resource='SELECT', duration=0.01)])
+        aggregator.add_trace([_span(status=200, duration=0.3), _span(status=500, error=1)])
+        unfinished = _span()
+        unfinished.duration = None
+        aggregator.add_trace([unfinished])
+
+        bucket = aggregator.flush(force=True)
+        stats = dict((stats.key, stats) for stats in bucket.stats)
+        eq_(sorted(stats), [('web', 'db', 'SELECT', ''), ('web', 'request', 'GET /', '200'),
+                            ('web', 'request', 'GET /', '500')])
+        ok_200 = stats[('web', 'request', 'GET /', '200')]
+        eq_(ok_200.hits, 2)
+        eq_(ok_200.errors, 0)
+        ok_(abs(ok_200.duration - 0.4) < 1e-9)
+        eq_(ok_200.ok_sketch.max, 0.3)
+        eq_(ok_200.error_sketch, None)
+        error_500 = stats[('web', 'request', 'GET /', '500')]
+        eq_(error_500.errors, 1)
+        eq_(error_500.error_sketch.count, 1)
+
+        # a new interval starts after a flush
+        eq_(aggregator.flush(force=True).stats, [])
+
+    def test_interval(self):
+        aggregator = TraceStatsAggregator(interval=60)
+        aggregator.add_trace([_span()])
+        eq_(aggregator.flush(), None)
+        with mock.patch('time.time', return_value=aggregator._start + 60):
+            bucket = aggregator.flush()
+        eq_(bucket.duration, 60)
+        eq_(len(bucket.stats), 1)
+
+    def test_max_keys(self):
+        # spans of new keys are counted in the overflow key past the limit
+        aggregator = TraceStatsAggregator(max_keys=2)
+        aggregator.add_trace([_span(resource='GET /{}'.format(i)) for i in range(5)])
+        aggregator.add_trace([_span(resource='GET /0')])
+
+        bucket = aggregator.flush(force=True)
+        stats = dict((stats.key, stats.hits) for stats in bucket.stats)
+        eq_(len(stats), 3)
+        eq_(stats[('web', 'request', 'GET /0', '')], 2)
+        eq_(stats[OVERFLOW_KEY], 3)
+        eq_(bucket.overflow_spans, 3)
+
+    def test_export(self):
+        emitter = RecordingEmitter()
+        aggregator = TraceStatsAggregator(emitter)
+        aggregator.add_trace([_span(resource='GET /a,b', status=500, error=1)])
+        aggregator.export(force=True)
+
+        tags = ['http.status_code:500', 'name:request', 'resource:GET /a_b', 'service:web']
+        ok_(('hits', 1, tags) in emitter.counts)
+        ok_(('errors', 1, tags) in emitter.counts)
+        eq_(emitter.gauges['duration.max'], 0.1)
+        ok_(abs(emitter.gauges['duration.p99'] - 0.1) < 0.001)
+
+
+class TracerTraceStatsTests(TestCase):
+    def test_unsampled_traces(self):
+        # traces dropped by the sampler are counted as well
+        tracer = get_dummy_tracer()
+        tracer.writer.trace_stats = TraceStatsAggregator()
+        tracer.sampler = RejectAllSampler()
+        for _ in range(3):
+            with tracer.trace('request', service='web'):
+                pass
+
+        eq_(tracer.writer.pop(), [])
+        stats = tracer.writer.trace_stats.flush(force=True).stats
+        eq_(len(stats), 1)
+        eq_(stats[0].hits, 3)
+
+    def test_flush_thread(self):
+        # the stats are exported by the flush thread of the writer
+        emitter = RecordingEmitter()
+        with StandInAgent() as agent:
+            with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+                writer = AgentWriter(agent.hostname, agent.port, flush_interval=60,
+                                     trace_stats=TraceStatsAggregator(emitter, interval=60))
+            self.addCleanup(writer.api.close)
+            writer.trace_stats.add_trace([_span()])
+            writer.write(spans=[_span()])
+            writer._worker.stop()
+            writer._worker.join()
+
+        ok_(('hits', 1, ['name:request', 'resource:GET /', 'service:web']) in emitter.counts)
+
+    def test_configure(self):
+        # the trace stats are kept when the writer is rebuilt by configure()
+        tracer = Tracer()
+        stats = TraceStatsAggregator()
+        tracer.configure(trace_stats=stats)
+        ok_(tracer.writer.trace_stats is stats)
+
+        tracer.configure(hostname='agent', port=8127, priority_sampling=True)
+        eq_(tracer.writer.api.hostname, 'agent')
+        ok_(tracer.writer.trace_stats is stats)
@@ -0,0 +1,253 @@
+import errno
+import json
+import mock
+import os
+import shutil
+import socket
+import tempfile
+
+from unittest import TestCase
+from nose.tools import eq_, ok_
+
+from ddtrace.api import API
+from ddtrace.compat import httplib
+from ddtrace.encoding import JSONEncoder
+from ddtrace.tracer import Tracer
+from ddtrace.transport import HTTPTransport, UDSHTTPConnection
+
+from .test_tracer import get_dummy_tracer
+from .util import StandInAgent
+
+
+def _make_connection(will_close=False):
+    conn = mock.MagicMock(spec=httplib.HTTPConnection)
+    conn.getresponse.return_value.will_close = will_close
+    conn.getresponse.return_value.status = 200
+    conn.getresponse.return_value.read.return_value = b'{}'
+    return conn
+
+
+class HTTPTransportTests(TestCase):
+    def test_connection_reused(self):
+        # a keep-alive connection is reused for subsequent requests
+        conn = _make_connection()
+        factory = mock.Mock(return_value=conn)
+        transport = HTTPTransport('localhost', 8126, connection_factory=factory)
+
+        transport.request('PUT', '/v0.3/traces', '[]', {})
+        response = transport.request('PUT', '/v0.3/traces', '[]', {})
+
+        eq_(factory.call_count, 1)
+        eq_(conn.request.call_count, 2)
+        eq_(conn.close.call_count, 0)
+        eq_(response.status, 200)
+        eq_(response.read(), b'{}')
+
+        transport.close()
+        eq_(conn.close.call_count, 1)
+
+    def test_connection_closed_by_server(self):
+        # the connection is not pooled if the server asks to close it
+        conn = _make_connection(will_close=True)
+        factory = mock.Mock(return_value=conn)
+        transport = HTTPTransport('localhost', 8126, connection_factory=factory)
+
+        transport.request('PUT', '/v0.3/traces', '[]', {})
+        transport.request('PUT', '/v0.3/traces', '[]', {})
+
+        eq_(factory.call_count, 2)
+        eq_(conn.close.call_count, 2)
+
+    def test_no_pooling(self):
+        # with a pool size of 0, a connection is created for each request
+        conn = _make_connection()
+        factory = mock.Mock(return_value=conn)
+        transport = HTTPTransport('localhost', 8126, connection_factory=factory, pool_size=0)
+
+        transport.request('PUT', '/v0.3/traces', '[]', {})
+        transport.request('PUT', '/v0.3/traces', '[]', {})
+
+        eq_(factory.call_count, 2)
+        eq_(conn.close.call_count, 2)
+
+    def test_reconnect_on_error(self):
+        # when a reused connection has been dropped, the request is sent again
+        # using a new connection
+        stale = _make_connection()
+        fresh = _make_connection()
+        factory = mock.Mock(side_effect=[stale, fresh])
+        transport = HTTPTransport('localhost', 8126, connection_factory=factory)
+
+        transport.request('PUT', '/v0.3/traces', '[]', {})
+        stale.request.side_effect = socket.error(errno.ECONNRESET, 'connection reset by peer')
+        response = transport.request('PUT', '/v0.3/traces', '[]', {})
+
+        eq_(response.status, 200)
+        eq_(factory.call_count, 2)
+        eq_(stale.close.call_count, 1)
+        eq_(fresh.request.call_count, 1)
+
+    def test_reconnect_on_empty_response(self):
+        # a reused connection closed before any byte of the response was received
+        stale = _make_connection()
+        fresh = _make_connection()
+        factory = mock.Mock(side_effect=[stale, fresh])
+        transport = HTTPTransport('localhost', 8126, connection_factory=factory)
+
+        transport.request('PUT', '/v0.3/traces', '[]', {})
+        stale.getresponse.side_effect = httplib.BadStatusLine('')
+        response = transport.request('PUT', '/v0.3/traces', '[]', {})
+
+        eq_(response.status, 200)
+        eq_(fresh.request.call_count, 1)
+
+    def test_no_retry_once_sent(self):
+        # the request may have been processed once it has been sent, so it's not
+        # sent again when reading the response fails
+        for error in (socket.error(errno.ECONNRESET, 'connection reset by peer'), socket.timeout('timed out'),
+                      httplib.BadStatusLine('garbage'), socket.error('unknown error')):
+            stale = _make_connection()
+            fresh = _make_connection()
+            factory = mock.Mock(side_effect=[stale, fresh])
+            transport = HTTPTransport('localhost', 8126, connection_factory=factory)
+
+            transport.request('PUT', '/v0.3/traces', '[]', {})
+            stale.getresponse.side_effect = error
+            with self.assertRaises(type(error)):
+                transport.request('PUT', '/v0.3/traces', '[]', {})
+            eq_(factory.call_count, 1)
+            eq_(stale.close.call_count, 1)
+
+        # neither when sending it fails for another reason than a closed connection
+        stale = _make_connection()
+        factory = mock.Mock(return_value=stale)
+        transport = HTTPTransport('localhost', 8126, connection_factory=factory)
+        transport.request('PUT', '/v0.3/traces', '[]', {})
+        stale.request.side_effect = socket.timeout('timed out')
+        with self.assertRaises(socket.timeout):
+            transport.request('PUT', '/v0.3/traces', '[]', {})
+        eq_(factory.call_count, 1)
+
+    def test_new_connection_not_sent_error_is_raised(self):
+        # the original error is raised for brand new connections
+        conn = _make_connection()
+        conn.request.side_effect = socket.error(errno.EPIPE, 'broken pipe')
+        transport = HTTPTransport('localhost', 8126, connection_factory=mock.Mock(return_value=conn))
+
+        with self.assertRaises(socket.error):
+            transport.request('PUT', '/v0.3/traces', '[]', {})
+
+    def test_new_connection_error_is_raised(self):
+        # errors of brand new connections are not retried
+        conn = _make_connection()
+        conn.request.side_effect = socket.error('connection refused')
+        factory = mock.Mock(return_value=conn)
+        transport = HTTPTransport('localhost', 8126, connection_factory=factory)
+
+        with self.assertRaises(socket.error):
+            transport.request('PUT', '/v0.3/traces', '[]', {})
+
+        eq_(factory.call_count, 1)
+        eq_(conn.close.call_count, 1)
+
+    def test_idle_connection_expired(self):
+        # connections idle for too long are discarded
+        conn = _make_connection()
+        factory = mock.Mock(return_value=conn)
+        transport = HTTPTransport('localhost', 8126, connection_factory=factory, max_idle_time=5)
+
+        with mock.patch('ddtrace.transport.time.time', side_effect=[10, 10, 20, 20]):
+            transport.request('PUT', '/v0.3/traces', '[]', {})
+            transport.request('PUT', '/v0.3/traces', '[]', {})
+
+        eq_(factory.call_count, 2)
+        eq_(conn.close.call_count, 1)
+
+    def test_fork_discards_connections(self):
+        # connections inherited from the parent process are never reused
+        conn = _make_connection()
+        factory = mock.Mock(return_value=conn)
+        transport = HTTPTransport('localhost', 8126, connection_factory=factory)
+
+        transport.request('PUT', '/v0.3/traces', '[]', {})
+        with mock.patch('ddtrace.transport.os.getpid', return_value=-1):
+            transport.request('PUT', '/v0.3/traces', '[]', {})
+
+        eq_(factory.call_count, 2)
+
+
+class StandInAgentTransportTests(TestCase):
+    def test_keep_alive(self):
+        # the same TCP connection is used for all flushes
+        with StandInAgent() as agent:
+            api = API(agent.hostname, agent.port)
+            for _ in range(5):
+                response = api._put('/v0.3/traces', b'[]', 1)
+                eq_(response.status, 200)
+            api.close()
+
+            eq_(len(agent.requests), 5)
+            eq_(agent.connections, 1)
+
+    def test_connection_per_request(self):
+        # without pooling, each flush opens a new TCP connection
+        with StandInAgent() as agent:
+            api = API(agent.hostname, agent.port)
+            api._transport = HTTPTransport(agent.hostname, agent.port, pool_size=0)
+            for _ in range(5):
+                api._put('/v0.3/traces', b'[]', 1)
+
+            eq_(len(agent.requests), 5)
+            eq_(agent.connections, 5)
+            ok_(all(headers['X-Datadog-Trace-Count'] == '1' for _, _, headers, _ in agent.requests))
+
+
+class UDSTransportTests(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.uds_path = os.path.join(self.tmpdir, 'apm.socket')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_send_traces(self):
+        # traces are reported through the Unix domain socket
+        tracer = get_dummy_tracer()
+        tracer.trace('client.testing').finish()
+        traces = [tracer.writer.pop()]
+
+        with StandInAgent(uds_path=self.uds_path) as agent:
+            api = API('localhost', 8126, uds_path=self.uds_path, encoder=JSONEncoder())
+            response = api.send_traces(traces)
+            response = api.send_traces(traces)
+            api.close()
+
+            eq_(response.status, 200)
+            eq_(agent.connections, 1)
+            eq_(len(agent.requests), 2)
+            method, path, headers, body = agent.requests[0]
+            eq_(path, '/v0.3/traces')
+            eq_(headers['X-Datadog-Trace-Count'], '1')
+            eq_(json.loads(body.decode('utf-8'))[0][0]['name'], 'client.testing')
+
+    def test_downgrade(self):
+        # the API downgrade also happens through the Unix domain socket
+        endpoints = ['/v0.2/traces', '/v0.2/services']
+        with StandInAgent(uds_path=self.uds_path, endpoints=endpoints) as agent:
+            api = API('localhost', 8126, uds_path=self.uds_path, encoder=JSONEncoder())
+            response = api.send_services([{'client.service': {'app': 'django', 'app_type': 'web'}}])
+            api.close()
+
+            eq_(response.status, 200)
+            eq_([path for _, path, _, _ in agent.requests], ['/v0.3/services', '/v0.2/services'])
+
+    def test_tracer_configure(self):
+        # the socket path is kept when the tracer is reconfigured
+        tracer = Tracer()
+        tracer.configure(uds_path=self.uds_path)
+        eq_(tracer.writer.api.uds_path, self.uds_path)
+        tracer.configure(priority_sampling=True)
+        eq_(tracer.writer.api.uds_path, self.uds_path)
+        ok_(isinstance(tracer.writer.api._transport._connection_factory('localhost', 8126), UDSHTTPConnection))
+        tracer.configure(uds_path='')
+        ok_(not tracer.writer.api.uds_path)
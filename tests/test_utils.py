@@ -1,11 +1,24 @@
+import mock
 import os
+import random
+import signal
+import threading
+import time
 import unittest
 import warnings
 
+from unittest import skipUnless
+
 from nose.tools import eq_, ok_
 
+from ddtrace.sampler import RateByServiceSampler
+from ddtrace.telemetry import WriterTelemetry
 from ddtrace.utils.deprecation import deprecation, deprecated, format_message
 from ddtrace.utils.formats import asbool, get_env
+from ddtrace.utils.forksafe import is_alive
+from ddtrace.utils.ids import IdGenerator
+from ddtrace.utils.retry import CircuitBreaker, RetryPolicy
+from ddtrace.utils.sketch import DDSketch
 
 
 class TestUtilities(unittest.TestCase):
@@ -89,3 +102,223 @@ class TestUtilities(unittest.TestCase):
             ok_(len(w) == 1)
             ok_(issubclass(w[-1].category, DeprecationWarning))
             ok_('decorator' in str(w[-1].message))
+
+
+class TestRetry(unittest.TestCase):
+    def test_backoff(self):
+        # the backoff doubles after each attempt, up to the max backoff
+        policy = RetryPolicy(initial_backoff=0.1, max_backoff=0.3, jitter=False)
+        eq_(policy.backoff(1), 0.1)
+        eq_(policy.backoff(2), 0.2)
+        eq_(policy.backoff(3), 0.3)
+        eq_(policy.backoff(10), 0.3)
+
+    def test_backoff_jitter(self):
+        # the jittered backoff is between 0 and the computed backoff
+        policy = RetryPolicy(initial_backoff=0.1, max_backoff=1)
+        for attempt in range(1, 10):
+            ok_(0 <= policy.backoff(attempt) <= min(1, 0.1 * 2 ** (attempt - 1)))
+
+    def test_circuit_breaker_opens(self):
+        # the circuit opens after consecutive failures only
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        eq_(breaker.state, CircuitBreaker.CLOSED)
+        ok_(breaker.allow())
+        breaker.record_failure()
+        eq_(breaker.state, CircuitBreaker.OPEN)
+        ok_(not breaker.allow())
+
+    def test_circuit_breaker_probe(self):
+        # when the reset timeout expires, a single probe is allowed
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=0.01)
+        breaker.record_failure()
+        time.sleep(0.02)
+        ok_(breaker.allow())
+        eq_(breaker.state, CircuitBreaker.HALF_OPEN)
+        ok_(not breaker.allow())
+
+        # a successful probe closes the circuit
+        breaker.record_success()
+        eq_(breaker.state, CircuitBreaker.CLOSED)
+        ok_(breaker.allow())
+
+    def test_circuit_breaker_failed_probe(self):
+        # a failed probe opens the circuit with a longer reset timeout
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=10, max_reset_timeout=15)
+        breaker.record_failure()
+        breaker._open_until = 0
+        ok_(breaker.allow())
+        breaker.record_failure()
+        eq_(breaker.state, CircuitBreaker.OPEN)
+        eq_(breaker._reset_timeout, 15)
+        ok_(breaker._open_until - time.time() > 7)
+
+
+class TestSketch(unittest.TestCase):
+    def _assert_accurate(self, sketch, values, accuracy=0.01):
+        values = sorted(values)
+        for quantile in (0.1, 0.5, 0.9, 0.95, 0.99):
+            expected = values[int(quantile * (len(values) - 1))]
+            ok_(abs(sketch.quantile(quantile) - expected) <= accuracy * expected,
+                (quantile, sketch.quantile(quantile), expected))
+
+    def test_quantiles(self):
+        # quantiles are within the relative accuracy
+        sketch = DDSketch(relative_accuracy=0.01)
+        eq_(sketch.quantile(0.5), None)
+        values = [0.0001 * 1.1 ** i for i in range(200)]
+        for value in values:
+            sketch.add(value)
+        eq_(sketch.count, 200)
+        eq_(sketch.min, values[0])
+        eq_(sketch.max, values[-1])
+        eq_(sketch.quantile(1), values[-1])
+        self._assert_accurate(sketch, values)
+
+    def test_zeros(self):
+        sketch = DDSketch()
+        sketch.add(0)
+        sketch.add(0)
+        sketch.add(1)
+        eq_(sketch.zero_count, 2)
+        eq_(sketch.quantile(0.5), 0.0)
+
+    def test_merge(self):
+        # merged sketches are as accurate as a single one
+        first, second = DDSketch(), DDSketch()
+        values = [0.001 * i for i in range(1, 1001)]
+        for value in values[::2]:
+            first.add(value)
+        for value in values[1::2]:
+            second.add(value)
+        first.merge(second)
+        eq_(first.count, 1000)
+        self._assert_accurate(first, values)
+
+        with self.assertRaises(ValueError):
+            first.merge(DDSketch(relative_accuracy=0.05))
+
+    def test_max_bins(self):
+        # the lowest bins are collapsed first
+        sketch = DDSketch(relative_accuracy=0.01, max_bins=50)
+        values = [1.05 ** i for i in range(200)]
+        for value in values:
+            sketch.add(value)
+        eq_(len(sketch.bins), 50)
+        eq_(sketch.count, 200)
+        ok_(abs(sketch.quantile(0.99) - values[197]) <= 0.01 * values[197])
+
+
+class TestIdGenerator(unittest.TestCase):
+    def test_new_id(self):
+        generator = IdGenerator()
+        ids = set(generator.new_id() for _ in range(1000))
+        eq_(len(ids), 1000)
+        ok_(all(0 <= id_ < 2 ** 64 for id_ in ids))
+
+    def test_threads(self):
+        # each thread has its own generator
+        generator = IdGenerator()
+        ids = []
+
+        def generate():
+            ids.extend(generator.new_id() for _ in range(1000))
+
+        threads = [threading.Thread(target=generate) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        eq_(len(set(ids)), 4000)
+
+    def test_fork(self):
+        # a forked process doesn't generate the same IDs as its parent
+        generator = IdGenerator()
+        generator.new_id()
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            os.write(write_fd, str([generator.new_id() for _ in range(10)]).encode('ascii'))
+            os._exit(0)
+
+        os.close(write_fd)
+        child_ids = os.read(read_fd, 4096).decode('ascii')
+        os.close(read_fd)
+        os.waitpid(pid, 0)
+        ok_(child_ids)
+        ok_(child_ids != str([generator.new_id() for _ in range(10)]))
+
+    def test_global_seed(self):
+        # IDs don't depend on the seed of the global ``random`` module
+        generator = IdGenerator()
+        random.seed(1)
+        first = [generator.new_id() for _ in range(10)]
+        random.seed(1)
+        ok_(first != [generator.new_id() for _ in range(10)])
+
+    def test_pid_check(self):
+        # without ``os.register_at_fork``, forks are detected with the pid
+        with mock.patch('ddtrace.utils.ids._REGISTER_AT_FORK', False):
+            generator = IdGenerator()
+        generator.new_id()
+        with mock.patch.object(generator, '_seed', wraps=generator._seed) as seed:
+            generator.new_id()
+            eq_(seed.call_count, 0)
+            generator._pid = -1
+            generator.new_id()
+            eq_(seed.call_count, 1)
+
+
+@skipUnless(hasattr(os, 'fork'), 'os.fork() is not available')
+class TestForkSafe(unittest.TestCase):
+    def test_locks_held_at_fork(self):
+        # the locks held by another thread, e.g. the flush thread, when the process
+        # is forked are replaced in the child
+        telemetry = WriterTelemetry()
+        sampler = RateByServiceSampler()
+        breaker = CircuitBreaker()
+        locked = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with telemetry._lock, sampler._lock, breaker._lock:
+                locked.set()
+                release.wait()
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        locked.wait()
+        try:
+            pid = os.fork()
+            if pid == 0:
+                # the child is killed if it deadlocks
+                signal.alarm(5)
+                telemetry.count('sent_traces')
+                sampler.set_sample_rate(0.5, service='web')
+                breaker.record_failure()
+                os._exit(0)
+            _, status = os.waitpid(pid, 0)
+        finally:
+            release.set()
+            thread.join()
+        eq_(status, 0)
+
+    def test_zombie(self):
+        # a process that is gone but hasn't been waited for isn't alive
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        try:
+            deadline = time.time() + 5
+            while is_alive(pid) and time.time() < deadline:
+                time.sleep(0.01)
+            if os.path.exists('/proc/self/stat'):
+                ok_(not is_alive(pid))
+        finally:
+            os.waitpid(pid, 0)
+        ok_(not is_alive(pid))
+        ok_(is_alive(os.getpid()))
@@ -1,7 +1,23 @@
+import json
+import mock
+import socket
+import threading
+import time
+
 from unittest import TestCase
 
+from ddtrace.api import Payload
+from ddtrace.constants import SAMPLING_PRIORITY_KEY
+from ddtrace.encoding import JSONEncoder
+from ddtrace.ext.priority import AUTO_KEEP, AUTO_REJECT, USER_KEEP, USER_REJECT
 from ddtrace.span import Span
-from ddtrace.writer import AsyncWorker, Q
+from ddtrace.utils.retry import CircuitBreaker, RetryPolicy
+from ddtrace.writer import (
+    AgentWriter, AsyncWorker, EncodedTrace, Q, SPAN_SIZE_ESTIMATE, TAG_SIZE_ESTIMATE, EVICTION_PRIORITY_LOW,
+    EVICTION_PRIORITY_DEFAULT, EVICTION_PRIORITY_HIGH, _estimate_trace_size, _trace_eviction_priority,
+)
+
+from .util import StandInAgent
 
 class RemoveAllFilter():
     def __init__(self):
@@ -30,14 +46,27 @@ class AddTagFilter():
             span.set_tag(self.tag_name, "A value")
         return trace
 
-class DummmyAPI():
+class DummmyResponse():
+    status = 200
+
+
+class DummmyAPI(object):
     def __init__(self):
         self.traces = []
+        self.hostname = 'localhost'
+        self.port = 8126
 
     def send_traces(self, traces):
         for trace in traces:
             self.traces.append(trace)
 
+    def encode_traces(self, traces):
+        return [Payload(None, traces)]
+
+    def send_payload(self, payload):
+        self.send_traces(payload.traces)
+        return DummmyResponse()
+
 N_TRACES = 11
 
 class AsyncWorkerTests(TestCase):
@@ -87,3 +116,385 @@ class AsyncWorkerTests(TestCase):
         worker.join()
         self.assertEqual(len(self.api.traces), 0)
         self.assertEqual(filtr.filtered_traces, 0)
+
+
+class QTests(TestCase):
+    def test_wait_timeout(self):
+        # without reaching a threshold, wait() blocks until the timeout expires
+        q = Q(flush_size=2)
+        q.add(1)
+        start = time.time()
+        q.wait(0.1)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+
+    def test_wait_flush_size(self):
+        # wait() returns immediately when the queue reaches the flush size
+        q = Q(flush_size=2)
+        q.add(1)
+        q.add(2)
+        start = time.time()
+        q.wait(5)
+        self.assertLess(time.time() - start, 1)
+
+    def test_wait_flush_bytes(self):
+        # wait() returns immediately when the queue reaches the flush bytes
+        q = Q(flush_bytes=10, size_estimator=len)
+        q.add('a' * 5)
+        self.assertFalse(q._is_flush_ready())
+        q.add('a' * 5)
+        start = time.time()
+        q.wait(5)
+        self.assertLess(time.time() - start, 1)
+
+        # the estimated size is reset when the queue is flushed
+        q.pop()
+        self.assertFalse(q._is_flush_ready())
+
+    def test_wait_closed(self):
+        # wait() is woken up when the queue is closed
+        q = Q()
+        t = threading.Timer(0.1, q.close)
+        t.start()
+        start = time.time()
+        q.wait(5)
+        self.assertLess(time.time() - start, 1)
+        t.join()
+
+    def test_estimate_trace_size(self):
+        span = Span(tracer=None, name='name', resource='SELECT 1')
+        span.set_tag('key', 'value')
+        span.set_metric('metric', 1)
+        size = _estimate_trace_size([span, span])
+        self.assertEqual(size, 2 * (SPAN_SIZE_ESTIMATE + len('name') + len('SELECT 1') + 2 * TAG_SIZE_ESTIMATE))
+
+
+class AsyncWorkerFlushTests(TestCase):
+    def test_flush_on_size(self):
+        # traces are sent as soon as the flush size is reached, without waiting
+        # for the flush interval
+        api = DummmyAPI()
+        traces = Q(flush_size=N_TRACES)
+        worker = AsyncWorker(api, traces, Q(), flush_interval=60)
+        for i in range(N_TRACES):
+            traces.add([Span(tracer=None, name="name", trace_id=i)])
+
+        deadline = time.time() + 5
+        while len(api.traces) < N_TRACES and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(api.traces), N_TRACES)
+        self.assertTrue(worker.is_alive())
+        worker.stop()
+        worker.join()
+        self.assertFalse(worker.is_alive())
+
+    def test_shutdown_flushes_queue(self):
+        # the shutdown hook wakes up the worker and waits for the queue to be flushed
+        api = DummmyAPI()
+        traces = Q()
+        worker = AsyncWorker(api, traces, Q(), flush_interval=60)
+        # give the worker the time to go to sleep
+        time.sleep(0.1)
+        for i in range(N_TRACES):
+            traces.add([Span(tracer=None, name="name", trace_id=i)])
+
+        start = time.time()
+        worker._on_shutdown()
+        self.assertLess(time.time() - start, 5)
+        self.assertFalse(worker.is_alive())
+        self.assertEqual(len(api.traces), N_TRACES)
+
+
+def _make_trace(n_spans=1, priority=None, error=0):
+    spans = [Span(tracer=None, name='name', trace_id=1, span_id=i + 1) for i in range(n_spans)]
+    if priority is not None:
+        spans[0].set_metric(SAMPLING_PRIORITY_KEY, priority)
+    spans[-1].error = error
+    return spans
+
+
+class QBytesTests(TestCase):
+    def _queue(self, max_bytes):
+        return Q(
+            max_size=0,
+            max_bytes=max_bytes,
+            size_estimator=len,
+            priority_estimator=_trace_eviction_priority,
+        )
+
+    def test_eviction_priority(self):
+        self.assertEqual(_trace_eviction_priority(_make_trace()), EVICTION_PRIORITY_DEFAULT)
+        self.assertEqual(_trace_eviction_priority(_make_trace(priority=AUTO_KEEP)), EVICTION_PRIORITY_DEFAULT)
+        self.assertEqual(_trace_eviction_priority(_make_trace(priority=AUTO_REJECT)), EVICTION_PRIORITY_LOW)
+        self.assertEqual(_trace_eviction_priority(_make_trace(priority=USER_REJECT)), EVICTION_PRIORITY_LOW)
+        self.assertEqual(_trace_eviction_priority(_make_trace(priority=USER_KEEP)), EVICTION_PRIORITY_HIGH)
+        self.assertEqual(_trace_eviction_priority(_make_trace(2, priority=AUTO_REJECT, error=1)),
+                         EVICTION_PRIORITY_HIGH)
+
+    def test_bounded_by_bytes(self):
+        # the queue accepts traces until their estimated size reaches the limit,
+        # then the oldest ones are replaced
+        q = self._queue(10)
+        first = _make_trace(4)
+        second = _make_trace(6)
+        third = _make_trace(1)
+        self.assertTrue(q.add(first))
+        self.assertTrue(q.add(second))
+        self.assertTrue(q.add(third))
+        self.assertEqual(q.stats(), {
+            'queued_traces': 2,
+            'queued_bytes': 7,
+            'dropped_traces': 1,
+            'dropped_spans': 4,
+        })
+        self.assertEqual(q.pop(), [second, third])
+
+    def test_trace_too_large(self):
+        # a trace larger than the whole budget is dropped without evicting anything
+        q = self._queue(10)
+        q.add(_make_trace(2, priority=AUTO_REJECT))
+        self.assertFalse(q.add(_make_trace(11, error=1)))
+        self.assertEqual(q.size(), 1)
+        self.assertEqual(q.stats()['dropped_spans'], 11)
+
+    def test_evict_low_priority(self):
+        # unsampled traces are evicted to make room for more important ones
+        q = self._queue(10)
+        rejected = _make_trace(3, priority=AUTO_REJECT)
+        kept = _make_trace(3)
+        errored = _make_trace(3, error=1)
+        q.add(rejected)
+        q.add(kept)
+        q.add(errored)
+
+        user_kept = _make_trace(3, priority=USER_KEEP)
+        self.assertTrue(q.add(user_kept))
+        self.assertEqual(q.pop(), [kept, errored, user_kept])
+        self.assertEqual(q.stats()['dropped_traces'], 1)
+        self.assertEqual(q.stats()['dropped_spans'], 3)
+
+    def test_keep_high_priority(self):
+        # traces with errors or kept by the user are never evicted by less important ones
+        q = self._queue(6)
+        errored = _make_trace(3, error=1)
+        user_kept = _make_trace(3, priority=USER_KEEP)
+        q.add(errored)
+        q.add(user_kept)
+
+        self.assertFalse(q.add(_make_trace(1)))
+        self.assertEqual(q.pop(), [errored, user_kept])
+        self.assertEqual(q.stats()['dropped_traces'], 1)
+
+    def test_evict_oldest_same_priority(self):
+        # once the queue is full of important traces, new ones replace the oldest
+        q = self._queue(6)
+        oldest = _make_trace(3, error=1)
+        user_kept = _make_trace(3, priority=USER_KEEP)
+        errored = _make_trace(2, error=1)
+        q.add(oldest)
+        q.add(user_kept)
+
+        self.assertTrue(q.add(errored))
+        self.assertEqual(q.pop(), [user_kept, errored])
+        self.assertEqual(q.stats()['dropped_traces'], 1)
+        self.assertEqual(q.stats()['dropped_spans'], 3)
+
+    def test_not_enough_room(self):
+        # if evicting all the less important traces is not enough, nothing is evicted
+        q = self._queue(10)
+        rejected = _make_trace(2, priority=AUTO_REJECT)
+        errored = _make_trace(8, error=1)
+        q.add(rejected)
+        q.add(errored)
+
+        self.assertFalse(q.add(_make_trace(3)))
+        self.assertEqual(q.pop(), [rejected, errored])
+
+    def test_count_overwrite_dropped(self):
+        # traces overwritten when the queue reaches its max size are counted
+        q = Q(max_size=2)
+        q.add(_make_trace(1))
+        q.add(_make_trace(1))
+        q.add(_make_trace(1))
+        self.assertEqual(q.size(), 2)
+        self.assertEqual(q.stats()['dropped_traces'], 1)
+        self.assertEqual(q.stats()['dropped_spans'], 1)
+
+
+class AgentWriterStatsTests(TestCase):
+    @mock.patch('ddtrace.writer.AsyncWorker')
+    def test_stats(self, worker):
+        # no worker is started, so that the traces stay in the queue
+        writer = AgentWriter(max_queued_bytes=3 * SPAN_SIZE_ESTIMATE, flush_interval=60)
+        stats = writer.stats()
+        self.assertEqual(stats['dropped_traces'], 0)
+        self.assertEqual(stats['queued_traces'], 0)
+
+        writer.write(spans=[Span(tracer=None, name='', resource='')] * 2)
+        writer.write(spans=[Span(tracer=None, name='', resource='')] * 2)
+        stats = writer.stats()
+        self.assertEqual(stats['queued_traces'], 1)
+        self.assertEqual(stats['queued_bytes'], 2 * SPAN_SIZE_ESTIMATE)
+        self.assertEqual(stats['dropped_traces'], 1)
+        self.assertEqual(stats['dropped_spans'], 2)
+
+    @mock.patch('ddtrace.writer.AsyncWorker')
+    def test_no_estimation_without_limits(self, worker):
+        # traces are not measured in the traced threads when nothing uses their size
+        with mock.patch('ddtrace.writer._estimate_trace_size') as estimate:
+            writer = AgentWriter(flush_bytes=0)
+            writer.write(spans=[Span(tracer=None, name='')])
+        estimate.assert_not_called()
+        self.assertEqual(writer.stats()['queued_traces'], 1)
+
+
+class FailingAPI(DummmyAPI):
+    """Dummy API that fails the first ``failures`` calls"""
+    def __init__(self, failures):
+        super(FailingAPI, self).__init__()
+        self.failures = failures
+        self.encode_calls = 0
+        self.send_calls = 0
+        self.probe_calls = 0
+
+    def encode_traces(self, traces):
+        self.encode_calls += 1
+        return super(FailingAPI, self).encode_traces(traces)
+
+    def send_payload(self, payload):
+        self.send_calls += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise socket.error('connection refused')
+        return super(FailingAPI, self).send_payload(payload)
+
+    def probe(self):
+        self.probe_calls += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise socket.error('connection refused')
+        return DummmyResponse()
+
+
+class AsyncWorkerRetryTests(TestCase):
+    def _worker(self, api, breaker):
+        worker = AsyncWorker(
+            api, Q(), Q(),
+            flush_interval=60,
+            retry_policy=RetryPolicy(max_attempts=3, initial_backoff=0.001),
+            circuit_breaker=breaker,
+        )
+        self.addCleanup(worker.join)
+        self.addCleanup(worker.stop)
+        return worker
+
+    def test_retry(self):
+        # a payload is sent again when it fails
+        api = FailingAPI(failures=2)
+        worker = self._worker(api, CircuitBreaker())
+        worker._send_traces([[Span(tracer=None, name='name')]])
+        self.assertEqual(api.send_calls, 3)
+        self.assertEqual(len(api.traces), 1)
+
+    def test_retry_max_attempts(self):
+        # a payload is dropped after the max number of attempts
+        api = FailingAPI(failures=3)
+        worker = self._worker(api, CircuitBreaker())
+        worker._send_traces([[Span(tracer=None, name='name')]])
+        self.assertEqual(api.send_calls, 3)
+        self.assertEqual(len(api.traces), 0)
+
+    def test_circuit_breaker(self):
+        # when the agent is down traces are not encoded anymore, and a probe
+        # is sent before sending traces again
+        api = FailingAPI(failures=3)
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        worker = self._worker(api, breaker)
+        worker._send_traces([[Span(tracer=None, name='name')]])
+        self.assertEqual(api.send_calls, 2)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        worker._send_traces([[Span(tracer=None, name='name')]])
+        self.assertEqual(api.encode_calls, 1)
+        self.assertEqual(api.send_calls, 2)
+
+        # the reset timeout expires but the probe fails
+        breaker._open_until = 0
+        worker._send_traces([[Span(tracer=None, name='name')]])
+        self.assertEqual(api.probe_calls, 1)
+        self.assertEqual(api.encode_calls, 1)
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+
+        # the agent is back
+        breaker._open_until = 0
+        worker._send_traces([[Span(tracer=None, name='name')]])
+        self.assertEqual(api.probe_calls, 2)
+        self.assertEqual(api.encode_calls, 2)
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        self.assertEqual(len(api.traces), 1)
+
+
+class EncodeOnWriteTests(TestCase):
+    @mock.patch('ddtrace.writer.AsyncWorker')
+    def test_write(self, worker):
+        # traces are filtered and encoded when they're written, and queued with their exact size
+        filtr = AddTagFilter('tag')
+        writer = AgentWriter(filters=[filtr, RemoveAllFilter()], encode_on_write=True, flush_interval=60)
+        writer.write(spans=[Span(tracer=None, name='name')])
+        self.assertEqual(filtr.filtered_traces, 1)
+        self.assertEqual(writer.stats()['queued_traces'], 0)
+
+        writer = AgentWriter(filters=[filtr], encode_on_write=True, flush_interval=60)
+        trace = [Span(tracer=None, name='name'), Span(tracer=None, name='name')]
+        writer.write(spans=trace)
+        encoded = writer._traces.pop()[0]
+        self.assertTrue(isinstance(encoded, EncodedTrace))
+        self.assertEqual(encoded.data, writer.api.encoder.encode_trace(trace))
+        self.assertEqual(len(encoded), 2)
+        self.assertEqual(trace[0].get_tag('tag'), 'A value')
+
+        writer.write(spans=trace)
+        self.assertEqual(writer.stats()['queued_bytes'], len(encoded.data))
+
+    @mock.patch('ddtrace.writer.AsyncWorker')
+    def test_write_not_incremental(self, worker):
+        # traces are queued as they are if the encoder can't encode them one by one
+        writer = AgentWriter(encode_on_write=True, flush_interval=60)
+        writer.api.encoder.incremental = False
+        trace = [Span(tracer=None, name='name')]
+        writer.write(spans=trace)
+        self.assertEqual(writer._traces.pop(), [trace])
+
+    def test_flush(self):
+        # traces encoded on write are joined and sent by the worker
+        with StandInAgent() as agent:
+            with mock.patch('ddtrace.api.get_encoder', JSONEncoder):
+                writer = AgentWriter(agent.hostname, agent.port, encode_on_write=True, flush_interval=60)
+            for i in range(3):
+                writer.write(spans=[Span(tracer=None, name='name.{}'.format(i))])
+            writer._worker.stop()
+            writer._worker.join()
+            writer.api.close()
+
+            self.assertEqual(len(agent.requests), 1)
+            _, path, headers, body = agent.requests[0]
+            self.assertEqual(path, '/v0.3/traces')
+            self.assertEqual(headers['X-Datadog-Trace-Count'], '3')
+            traces = json.loads(body.decode('utf-8'))
+            self.assertEqual([trace[0]['name'] for trace in traces], ['name.0', 'name.1', 'name.2'])
+
+    def test_stale_encoder(self):
+        # traces encoded before a downgrade of the API encoder are dropped
+        api = mock.Mock()
+        api.encoder = JSONEncoder()
+        api.join_traces.return_value = [Payload(b'[]', None, 1)]
+        api.send_payload.return_value = DummmyResponse()
+        worker = AsyncWorker(api, Q(), Q(), flush_interval=60)
+        self.addCleanup(worker.join)
+        self.addCleanup(worker.stop)
+
+        worker._send_encoded_traces([
+            EncodedTrace(b'[1]', mock.Mock, 1, EVICTION_PRIORITY_DEFAULT),
+            EncodedTrace(b'[2]', JSONEncoder, 1, EVICTION_PRIORITY_DEFAULT),
+        ])
+        api.join_traces.assert_called_once_with([b'[2]'])
+        self.assertEqual(api.send_payload.call_count, 1)
@@ -1,12 +1,22 @@
 import os
 import sys
 import mock
+import socket
+import threading
 import ddtrace
 
 from ddtrace import __file__ as root_file
+from ddtrace.utils import ids
 from nose.tools import ok_
 from contextlib import contextmanager
 
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn, UnixStreamServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn, UnixStreamServer
+
 
 class FakeTime(object):
     """"Allow to mock time.time for tests
@@ -39,6 +49,11 @@ def patch_time():
     return mock.patch('time.time', new_callable=FakeTime)
 
 
+def seed_ids(seed):
+    """Seed the generator of trace and span IDs, that doesn't use the global random"""
+    ids._generator._rng.seed(seed)
+
+
 def assert_dict_issuperset(a, b):
     ok_(set(a.items()).issuperset(set(b.items())),
             msg="{a} is not a superset of {b}".format(a=a, b=b))
@@ -100,3 +115,118 @@ def inject_sitecustomize(path):
     python_path = list(sys.path) + [sitecustomize]
     env['PYTHONPATH'] = ':'.join(python_path)[1:]
     return env
+
+
+class _StandInAgentHandler(BaseHTTPRequestHandler):
+    # keep-alive is only supported with HTTP/1.1
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        if self.connection.family != socket.AF_UNIX:
+            # like the trace agent, don't delay small writes
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_PUT(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        with self.server.lock:
+            self.server.requests.append((self.command, self.path, dict(self.headers.items()), body))
+
+        status, content = self.server.response
+        if self.server.endpoints is not None and self.path not in self.server.endpoints:
+            status, content = 404, b'404 page not found'
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        if self.server.chunked:
+            # like the agent does for large responses without a Content-Length
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for i in range(0, len(content), 1024):
+                chunk = content[i:i + 1024]
+                self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+            return
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        # silence the default logging on stderr
+        pass
+
+
+class _StandInAgentServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _StandInAgentUDSServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+class StandInAgent(object):
+    """Local HTTP server that acts as a trace agent. It answers every ``PUT``
+    request with the configured response and records what it received, so that
+    the transport layer can be tested without a real agent. If ``endpoints`` is
+    set, any other path returns a 404 like an outdated agent would do. If
+    ``uds_path`` is set, the agent listens on that Unix domain socket. If
+    ``chunked`` is set, responses are sent with the chunked transfer encoding.
+
+    >>> with StandInAgent() as agent:
+            api = API(agent.hostname, agent.port)
+    """
+    def __init__(self, status=200, content=b'{}', endpoints=None, uds_path=None, chunked=False):
+        if uds_path:
+            self._server = _StandInAgentUDSServer(uds_path, _StandInAgentHandler)
+        else:
+            self._server = _StandInAgentServer(('127.0.0.1', 0), _StandInAgentHandler)
+        self._server.lock = threading.Lock()
+        self._server.connections = 0
+        self._server.requests = []
+        self._server.response = (status, content)
+        self._server.endpoints = endpoints
+        self._server.chunked = chunked
+        self._thread = None
+        self.uds_path = uds_path
+
+    @property
+    def hostname(self):
+        return 'localhost' if self.uds_path else self._server.server_address[0]
+
+    @property
+    def port(self):
+        return 8126 if self.uds_path else self._server.server_address[1]
+
+    @property
+    def connections(self):
+        """Number of TCP connections accepted so far."""
+        with self._server.lock:
+            return self._server.connections
+
+    @property
+    def requests(self):
+        """List of ``(method, path, headers, body)`` received so far."""
+        with self._server.lock:
+            return list(self._server.requests)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+        if self.uds_path:
+            os.unlink(self.uds_path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()